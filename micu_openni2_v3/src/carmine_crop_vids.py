@@ -14,6 +14,7 @@ dependiencies: openni, opencv, numpy
 
 import os, cv2
 import numpy as np
+import session_file
 
 
 p_src ="../data/icuTVframes/" # folder where to get frames
@@ -46,6 +47,26 @@ def flipLRImagesInList(imlist):
     print "Done flipping pixels in images from given list"
 #flipLRImagesInList
 
+
+def flipLRSession(src, dst, level=3):
+    '''Writes a copy of a session container (session_file.py) with every
+    image flipped left to right. Records keep their codec; raw records are
+    read as views of the mapped file (no decoding).'''
+    reader = session_file.SessionReader(src)
+    writer = session_file.SessionWriter(dst, align=reader.header['align'])
+    for entry in reader.index: # file order
+        im = np.fliplr(reader.read_entry(entry))
+        writer.append(int(entry['frame']), session_file.MODALITIES[entry['modality']], im,
+                      float(entry['stamp']), session_file.CODECS[entry['codec']], level)
+    writer.close()
+    reader.close()
+    print "Done flipping pixels in session {} -> {}".format(src, dst)
+#flipLRSession
+
+if session_file.is_session(p_src):
+    flipLRSession(p_src, p_src.replace('.micu', '_fliplr.micu'))
+    raise SystemExit
+
 # use the narturalsorted images to generated video:
 rgbs   = get_natural_imlist(p_src,"rgb")
 depths = get_natural_imlist(p_src,"depth")
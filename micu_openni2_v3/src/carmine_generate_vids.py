@@ -10,8 +10,9 @@ dependiencies: openni, opencv, numpy
 '''
 #!/usr/bin/python
 
-import os, cv2, openni
+import os, cv2, openni, itertools
 import numpy as np
+import session_file
 
 
 p_src ="../data/icudoorframes/" # folder where to get frames
@@ -36,7 +37,7 @@ def get_natural_imlist(path,imtype="rgb"):
 def gen_video(p_src, p_dst, imtype="rgb",fps=10, text=False):
     ''' Generates a .avi video file using the images in the path folder.
     inputs:
-        p_src:= str, path to images/frames folder
+        p_src:= str, path to images/frames folder or to a .micu session file
         p_dst:= str, path to folder where avi will be stored
         imtype:= str, one of 5 types {rgb, mask, depth, skel, all}
         fps:= int, video speed in frames per second
@@ -46,9 +47,15 @@ def gen_video(p_src, p_dst, imtype="rgb",fps=10, text=False):
      '''
     #aviname = imtype+"_test"
     aviname = "tita4BlightOFF"+imtype
-    # use the narturalsorted images to generated video:
-    natural_names = get_natural_imlist(p_src,imtype)
-    im = cv2.imread(natural_names[0])
+    if session_file.is_session(p_src): # frames 2450:2550 of the container
+        frames = session_file.iter_display(p_src, imtype, start=2450, stop=2550)
+        images = (im for f, im in frames)
+    else:
+        # use the narturalsorted images to generated video:
+        natural_names = get_natural_imlist(p_src,imtype)
+        images = (cv2.imread(name) for name in natural_names[2450:2550])
+    im = next(images)
+    images = itertools.chain([im], images)
     h,w= im.shape[0:2]
     x=int(w/2)
     y=int(h/2)
@@ -59,10 +66,10 @@ def gen_video(p_src, p_dst, imtype="rgb",fps=10, text=False):
     writer = cv2.VideoWriter(filename= p_dst+aviname+".avi",
         fourcc=cv2.cv.CV_FOURCC('I','Y','U','V'), fps=10, frameSize=(w,h))
     # go tru the images on the list and create the avi
-    for name in natural_names[2450:2550]:
-        im = cv2.imread(name)
+    for im in images:
         # FLIP IMAGES LEFT-RIGHT
         if text:
+            im = im.copy() # session frames can be read-only views
             cv2.putText(im,"TESTING: "+str(n),(x,y), cv2.FONT_HERSHEY_PLAIN, 2.0, text_color,
                 thickness=1, lineType=cv2.CV_AA)
         writer.write(im) # write to vid file
@@ -4,13 +4,41 @@ Created on Wed Dec  3 14:40:55 2014
 
 tcp_client.py
 
-ref: 
+ref:
     https://docs.python.org/2/library/socketserver.html
 
 Version 2: 03 April 2016
     Using threads to read server-client communications
      - Thx to C wheat.
 
+Version 3: 10 Oct 2016
+    ClientConnect keeps one connection open (TCP keepalive, no Nagle) and
+    reconnects with exponential backoff when it drops. Instead of polling
+    once per second, a "check" is sent as "watch": the server holds the
+    reply until its state changes (e.g. all devices connected -> save) or
+    for at most server_threads.HOLD seconds, so state changes reach the
+    recorder as they happen. Replies are newline terminated.
+    persistent=False keeps the old reconnect-per-poll loop (older servers).
+    protocol='binary' uses the framed messages of wire_protocol.py
+    (coordinator.py only). get_message() gives the last reply typed
+    (wire_protocol.Message: type, server stamp, payload) whatever the
+    protocol; get_command() keeps the text reply for older scripts.
+    Every reply also feeds a clock_sync.ClockSync (a 'sync' request is
+    added every sync_every s); server_time() gives the server time of a
+    local time and its error bound, used to stamp the frames.
+    next_start() asks the coordinator for the scheduled start instant and
+    session length; wait_until() sleeps (no spinning) until a server instant.
+    No per-device port table: every device uses PORT (the servers share the
+    state across their ports). With capabilities the client registers on
+    every (re)connection, and the periodic clock request is a 'heartbeat'
+    that keeps the device in the server's live set (device_registry.py).
+    report() hands recorder numbers (fps, queue, drops, disk) to the thread;
+    they go with the next heartbeat as a 'metrics' request, plus the rtt
+    of the last heartbeat (coordinator metrics endpoint, device_metrics.py).
+
+benchmark (local server, time from the server state change to the client):
+    python client.py
+
 @author: carlos
 """
 import socket
@@ -18,6 +46,11 @@ import threading
 import time
 import errno
 from socket import error as socket_error
+
+import wire_protocol as wire
+import clock_sync
+import device_registry
+import device_metrics
 #import sys
 
 ## ===========================================================================
@@ -26,156 +59,446 @@ from socket import error as socket_error
 
 #HOST = "localhost" # Local network
 HOST = "192.168.0.100" # Local network
+PORT = 50007           # coordinator.PORT, any device
+# Replies answered at once: clock samples (a held "watch"/"start" reply is stamped
+# when the server releases it, up to HOLD s after the request)
+CLOCK_COMMANDS = ('register', 'connect', 'sync', 'heartbeat', 'metrics', 'check')
 
 
 def update_command(request='check'):
     return request
 
+
+def parse_reply(text):
+    """
+    Text reply -> (name, server time), e.g. ('save', 1475000000.125); also the
+    "start_<instant>_<session length>" reply that split("_") cannot unpack.
+    ('unknown', nan) for an empty or unparsable reply.
+    """
+    mtype, stamp = wire.parse_text_reply(text)
+    return wire.NAMES.get(mtype, 'unknown'), stamp
+#parse_reply
+
+
+def keepalive(sock, idle=10, interval=5, count=3):
+    """
+    Enables TCP keepalive (dead peers are detected after idle+interval*count
+    seconds) and disables Nagle (small requests are sent at once).
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    for opt, value in (('TCP_KEEPIDLE', idle), ('TCP_KEEPINTVL', interval), ('TCP_KEEPCNT', count)):
+        if hasattr(socket, opt): # linux only
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, opt), value)
+#keepalive
+
+
 class ClientConnect(threading.Thread):
     """
         spawing a thread to listen for connections
+    inputs:
+        cmd        := str, first command ('connect')
+        dev        := int/str, device number
+        persistent := bool, one long-lived connection (False: reconnect per poll)
+        poll       := float, seconds between requests that are not held by the server
+        backoff    := (float, float), first and longest reconnection wait (s)
+        host, port := server address (default HOST, PORT)
+        protocol   := 'text' or 'binary' (wire_protocol.py)
+        sync_every := float, seconds between heartbeat/clock sync requests (0: none)
+        capabilities:= dict, sent in a 'register' request on every connection
+                       (e.g. {'res': '640x480', 'fps': 30}); None: no registration
+    The last reply is also kept as a wire_protocol.Message in self.reply
+    (type, dev, server time stamp).
     """
 
-    #list of avalable ports
-    dev_dict = {
-        'dev1':{'PORT':50007},
-        'dev2':{'PORT':50008},
-        'dev3':{'PORT':50009},
-        'dev4':{'PORT':50010},               
-        #'dev5':{'PORT':50011},                
-        #'dev6':{'PORT':50012}                
-    } 
-
-    def __init__(self, cmd='connect',dev=1):
+    def __init__(self, cmd='connect',dev=1, persistent=True, poll=1.0, backoff=(0.5, 30.0),
+                 host=None, port=None, protocol='text', sync_every=1.0, capabilities=None):
         """
-            Starts thread 
+            Starts thread
         """
         threading.Thread.__init__(self)
-        self.command = (None, None)
+        self.command = "" # text of the last reply
+        self.message = wire.Message(wire.UNKNOWN, int(dev), float('nan'), '') # ... typed
         self.connected=False
         self.cb = None
         self.done = False;
         self.cmd = cmd
         self.dev = dev
-        devid = "dev{}".format(dev)
-        self.PORT = self.dev_dict[devid]["PORT"] # The same port as used by the server
+        self.persistent = persistent
+        self.poll    = poll
+        self.backoff = backoff
+        self.changed = threading.Event() # set when the command changes
+        self.sock    = None
+        self.buffer  = ''
+        self.protocol = protocol
+        self.decoder = wire.Decoder()
+        self.reply   = None
+        self.clock   = clock_sync.ClockSync()
+        self.sync_every = sync_every
+        self.last_sync  = 0.0
+        self.started    = threading.Event() # set when a start is announced
+        self.start_at   = None              # scheduled start, server time
+        self.session_secs = 0.0
+        self.capabilities = capabilities
+        self.metrics = None # numbers waiting for the next heartbeat
+        self.rtt     = None # s, round trip of the last heartbeat
+        self.replies = 0
+        self.reconnects = 0
+        self.HOST = host or HOST
+        self.PORT = port or PORT
         print "Connecting to PORT: ", self.PORT
-        # Create a socket (SOCK_STREAM means a TCP socket)
-        
-        #self.sock.connect((HOST, self.PORT))
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.settimeout(10)
+        self.sock.connect((self.HOST, self.PORT))
+        keepalive(self.sock)
+        self.buffer    = ''
+        self.decoder   = wire.Decoder()
+        self.connected = True
+        if self.capabilities is not None: # (re)joins the live set
+            self.request('register', device_registry.format_capabilities(self.capabilities))
+    # connect
+
+    def disconnect(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket_error:
+                pass
+        self.sock      = None
+        self.connected = False
+    # disconnect
+
+    def readline(self):
+        """
+        One newline terminated reply (the server may send it in pieces).
+        """
+        while '\n' not in self.buffer:
+            data = self.sock.recv(1024)
+            if not data:
+                raise socket_error(errno.ECONNRESET, "connection closed by the server")
+            self.buffer += data
+        line, self.buffer = self.buffer.split('\n', 1)
+        return line.strip()
+    # readline
+
+    def receive(self):
+        """
+        One reply Message (binary protocol).
+        """
+        messages = []
+        while not messages:
+            data = self.sock.recv(1024)
+            if not data:
+                raise socket_error(errno.ECONNRESET, "connection closed by the server")
+            messages = self.decoder.feed(data)
+        return messages[-1]
+    # receive
+
+    def request(self, cmd, payload=''):
+        """
+        Sends one command and returns the reply on the open connection.
+        """
+        if self.sock is None:
+            self.connect()
+        t0 = time.time()
+        if self.protocol == 'binary':
+            self.sock.sendall(wire.pack(wire.REQUESTS[cmd], int(self.dev), t0, payload))
+            self.reply = self.receive()
+            line = wire.to_text(self.reply, date=False)
+        else:
+            self.sock.sendall("{} {}{}\n".format(self.dev, cmd, " "+payload if payload else ""))
+            line = self.readline()
+            mtype, stamp = wire.parse_text_reply(line)
+            self.reply = wire.Message(mtype, int(self.dev), stamp, wire.text_payload(line))
+        if self.reply.type == wire.START: # stamp := start instant, not the reply time
+            self.start_at     = self.reply.stamp
+            self.session_secs = wire.SESSION.unpack(self.reply.payload)[0] if self.reply.payload else 0.0
+            self.started.set()
+        elif cmd in CLOCK_COMMANDS: # held replies carry the release time
+            self.clock.add(t0, self.reply.stamp, time.time())
+        return line
+    # request
+
     def run(self):
         """
             called after start()
             Connects to server and polls for commands
         """
+        wait = self.backoff[0]
         while not self.done:
-            data = str(self.dev) + " " + self.cmd
+            cmd = self.cmd
             try:
-                # Connect to server and send data
-                #self.sock.close()
-                self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.sock.settimeout(10)
-                self.sock.connect((HOST, self.PORT))
-                self.sock.sendall(data + "\n")
-                
-                # Receive data from the server and shut down
-                received = self.sock.recv(1024)
-                #self.sock.close()
-                self.sock.shutdown(1)
-                #print "Sent:     {}".format(data)
-                #print "Received: {}".format(received)
+                if self.persistent and self.sync_every and time.time()-self.last_sync > self.sync_every:
+                    t0 = time.time()
+                    if self.metrics is not None:
+                        metrics, self.metrics = self.metrics, None
+                        if self.rtt is not None:
+                            metrics['rtt'] = self.rtt*1e3
+                        self.request('metrics', device_metrics.format_report(metrics))
+                    else:
+                        self.request('heartbeat') # keeps the device live; clock sample
+                    self.rtt = time.time()-t0
+                    self.last_sync = time.time()
+                if self.persistent:
+                    # a held 'watch'/'start' returns as soon as the server state changes
+                    received = self.request('watch' if cmd == 'check' else cmd)
+                else: # reconnect per poll
+                    self.connect()
+                    received = self.request(cmd)
+                    self.disconnect()
+                wait = self.backoff[0]
                 self.command = received
+                self.message = self.reply
+                self.replies += 1
+                if cmd == 'start' and self.reply.type not in (wire.START, wire.WAIT):
+                    print "The server does not schedule starts ({})".format(received)
+                    self.started.set() # next_start() gives up (start_at is None)
                 if self.cb: self.cb()
-                if self.cmd == "close":
-                    self.done == True
-                #if self.connected == False:# and self.command == "connect":
-                #    print "Connection successful"
-                #    self.connected = True
-                #    self.update_command("check")
-                    #self.cmd = "check"
-                #else:
-                #    self.command = update_command()
-            #except socket_error as serr:
-            #	if serr.errno != errno.ECONNREFUSED:
-            #		# Not the error we are looking for, re-raise
-            #		raise serr
-            #	print "Connection refused"
-            except socket.timeout:
-                print "Connection timed out"
-                print "Attempting to Reconnect"
-            #finally:
-            #	self.sock.close()
-            time.sleep(1)
-            
-    def callback(self, cb):	
+                if cmd == "close":
+                    self.done = True
+                elif not (self.persistent and cmd in ('check', 'start') and self.reply.type == wire.WAIT):
+                    # only a held "wait" is asked again at once: immediate replies
+                    # (save, terminate, unknown) would spin at network speed
+                    self.changed.wait(self.poll) # wakes up on update_command()
+                    self.changed.clear()
+            except (socket.timeout, socket_error) as e:
+                self.disconnect()
+                self.reconnects += 1
+                print "Connection lost ({}). Reconnecting in {:.1f} s".format(e, wait)
+                time.sleep(wait)
+                wait = min(2*wait, self.backoff[1])
+        self.disconnect()
+
+    def callback(self, cb):
         """
         Set a callback on recieving
         """
-        self.cb()
-            
+        self.cb = cb
+
 
     def check_tcp_server():
         """
-            
+
         """
         return self.command
 
     def get_command(self):
         return self.command
 
+    def get_message(self):
+        """
+        Last reply to the command as a wire_protocol.Message, e.g.
+        reply.type == wire.SAVE, reply.stamp (server time, float); UNKNOWN
+        with a nan stamp before the first reply.
+        """
+        return self.message
+
+    def report(self, **values):
+        """
+        Recorder numbers for the coordinator (device_metrics.FIELDS), sent with
+        the next heartbeat; a newer report replaces one not yet sent.
+        """
+        self.metrics = values
+
+    def next_start(self, timeout=None):
+        """
+        Scheduled start (all devices connected) announced by the coordinator.
+        outputs:
+            start       := float, server time (None on timeout or when the server
+                           does not know "start")
+            session_secs:= float, session length, 0 := no rollover
+        """
+        cmd = self.cmd
+        self.started.clear()
+        self.start_at = None
+        self.update_command('start')
+        end = None if timeout is None else time.time()+timeout
+        while not self.started.is_set() and (end is None or time.time() < end):
+            self.started.wait(1.0) # interruptible (ctrl+c) in python2
+        self.update_command(cmd)
+        if not self.started.is_set() or self.start_at is None: # timeout or not supported
+            return None, 0.0
+        return self.start_at, self.session_secs
+    # next_start
+
+    def wait_until(self, t_server):
+        """
+        Sleeps until server time t_server (local time from the clock
+        estimate, refreshed every second); returns the local wake-up time.
+        """
+        while True:
+            target = self.clock.to_local(t_server) if self.clock.ready() else t_server
+            dt = target - time.time()
+            if dt <= 0:
+                return time.time()
+            time.sleep(min(dt, 1.0))
+    # wait_until
+
+    def session_index(self, t_start, session_secs):
+        """
+        Index of the session running now in the coordinator's schedule (0
+        before t_start, without rollover or without a server time), so a
+        recorder that joins or restarts late goes on with the others.
+        """
+        if not t_start or not session_secs:
+            return 0
+        now = self.server_time()[0]
+        if now != now or now < t_start: # nan: no server time yet
+            return 0
+        return int((now - t_start) // session_secs)
+    # session_index
+
+    def server_time(self, t=None):
+        """
+        Server time of local time t (default now) and its error bound (s);
+        the last reply stamp and nan before the clock has a sample.
+        """
+        if self.clock.ready():
+            return self.clock.to_server(time.time() if t is None else t)
+        return (self.reply.stamp if self.reply else float('nan')), float('nan')
+
     def update_command(self, cmd):
-        self.cmd = cmd
+        if cmd != self.cmd:
+            self.cmd = cmd
+            self.changed.set()
         return self.cmd
 
     def __del__(self):
         """
         On destruction closes thread and conneciton
         """
-        self.done == True
+        self.done = True
         print "Closing Thread"
-        #self.sock.close()
+        self.disconnect()
         print "Closing Socket"
 
 
-def check_tcp_server(cmd='check', dev=1):
+def check_tcp_server(cmd='check', dev=1, host=None, port=None):
     """
 	Check the server (the status of other devices).
     (str, str) -> (str)
     cmd   = str that can take one of three values: check, connect, disconnect
-    devid = str that can take various values that must be included in the 
-    server. E.g., dev1, dev2, or dev3. Each computer should have a 
+    devid = str that can take various values that must be included in the
+    server. E.g., dev1, dev2, or dev3. Each computer should have a
     unique dev<#>.
     received = a list of connected devices
 	"""
     # ====== Client Variables:
     #HOST = "localhost"
-    HOST = "192.168.0.100"
+    host = host or HOST
+    port = port or PORT # any device, see ClientConnect
     received =""
-    devid    = "dev{}".format(dev)
-    dev_dict = {'dev1':{'PORT':50007},
-                'dev2':{'PORT':50008},
-                'dev3':{'PORT':50009},
-				'dev4':{'PORT':50010},
-				## 'dev5':{'PORT':50011},
-				## 'dev6':{'PORT':50012}
-                }    
-    PORT = dev_dict[devid]["PORT"] # The same port as used by the server
     # Create a socket (SOCK_STREAM means a TCP socket)
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     data = str(dev) + " " + cmd
     try:
         # Connect to server and send data
-        sock.connect((HOST, PORT))
+        sock.connect((host, port))
         sock.sendall(data + "\n")
         # Receive data from the server and shut down
-        received = sock.recv(1024)
+        received = sock.recv(1024).strip()
         #print "Sent:     {}".format(data)
         #print "Received: {}".format(received)
     except:
         pass
-        
-#    finally:
-#        sock.close()
-        
+    finally:
+        sock.close()
+
     return received
 #check_tcp_server()
+
+
+if __name__ == "__main__":
+    # Benchmark: dev1 waits for 'save' while dev2 connects at a random instant;
+    # latency from dev2's connect to dev1 seeing 'save', persistent vs. polling
+    import random
+    import server_threads
+    server = server_threads.ServerThread('dev1', HOST='localhost', PORT=0)
+    server.setDaemon(True)
+    server.start()
+    port = server.server.server_address[1]
+    server_threads.registry = server_threads.device_registry.DeviceRegistry(['dev1', 'dev2'], min_devices=2)
+
+    for persistent in (False, True):
+        seen   = threading.Event()
+        thread = ClientConnect('check', 1, persistent=persistent, host='localhost', port=port)
+        thread.callback(lambda: thread.get_message().type == wire.SAVE and seen.set())
+        with server_threads.lock: # dev1 already connected
+            server_threads.devs[:] = ['dev1']
+            server_threads.save    = False
+        thread.setDaemon(True)
+        thread.start()
+        latency = []
+        for trial in range(10):
+            time.sleep(random.uniform(0.2, 1.2))
+            seen.clear()
+            tic = time.time()
+            check_tcp_server('connect', 2, host='localhost', port=port)
+            seen.wait(5)
+            latency.append(time.time()-tic)
+            with server_threads.lock: # back to: dev1 connected, waiting for dev2
+                server_threads.devs[:] = ['dev1']
+                server_threads.save    = False
+                server_threads.conc    = True
+        thread.done = True
+        thread.update_command('close')
+        latency.sort()
+        print "{}: save seen after median {:.1f} ms, max {:.1f} ms ({} replies, {} reconnects)".format(
+            'persistent' if persistent else 'poll/reconnect', latency[len(latency)//2]*1e3,
+            latency[-1]*1e3, thread.replies, thread.reconnects)
+    server.server.shutdown()
+
+    # Scheduled start: 4 recorders sleep until the announced instant
+    import coordinator
+    coord = coordinator.Coordinator(['dev{}'.format(d) for d in range(1, 5)], session_secs=600.0)
+    port  = coord.listen('localhost', 0)
+    loop  = threading.Thread(target=coord.serve)
+    loop.setDaemon(True)
+    loop.start()
+    woke = {}
+    def recorder(d):
+        rec = ClientConnect('connect', d, host='localhost', port=port, protocol='binary')
+        rec.setDaemon(True)
+        rec.start()
+        time.sleep(0.1*d) # launched at different times
+        start, session_secs = rec.next_start(timeout=10)
+        woke[d] = rec.wait_until(start) - start
+    recs = [threading.Thread(target=recorder, args=(d,)) for d in range(1, 5)]
+    for r in recs:
+        r.start()
+    for r in recs:
+        r.join()
+    print "scheduled start: wake-up error per device (ms):", ", ".join(
+        "{:.2f}".format(woke[d]*1e3) for d in sorted(woke))
+
+    # Registry: 3 recorders (any ids) register, one dies; after the heartbeat
+    # timeout the other two are the live set and get 'save' without it
+    coord = coordinator.Coordinator(min_devices=3, timeout=2.5)
+    port  = coord.listen('localhost', 0)
+    loop  = threading.Thread(target=coord.serve)
+    loop.setDaemon(True)
+    loop.start()
+    saved = set()
+    recs  = [ClientConnect('connect', d, host='localhost', port=port,
+                           capabilities={'res': '640x480', 'fps': 30}) for d in (5, 12, 21)]
+    for rec in recs:
+        rec.callback(lambda rec=rec: rec.get_message().type == wire.SAVE and saved.add(rec.dev))
+        rec.setDaemon(True)
+        rec.start()
+    time.sleep(0.5)
+    assert coord.start_at is not None and coord.registry.live() == set(['dev5', 'dev12', 'dev21'])
+    recs[2].done = True # dev21 stops sending
+    time.sleep(4.0)
+    for rec in recs[:2]:
+        rec.update_command('check')
+    time.sleep(0.5)
+    print "registry: live {} after eviction, saved {}".format(sorted(coord.registry.live()), sorted(saved))
+    assert coord.registry.live() == set(['dev5', 'dev12']) and saved == set([5, 12])
+
+    # Metrics: a report goes with the next heartbeat (rtt added by the client)
+    recs[0].report(fps=29.9, queue=2, drops=0, disk=device_metrics.disk_free_gb('.'))
+    time.sleep(1.5)
+    print "metrics:", coord.metrics.devices['dev5'].summary()
+    assert coord.metrics.devices['dev5'].rings['fps'][-1] == 29.9 and coord.metrics.devices['dev5'].rings['rtt']
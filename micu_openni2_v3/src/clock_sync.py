@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 14Oct2016
+
+clock_sync.py
+
+NTP style estimate of the coordinator clock on a recorder, so frames are
+stamped in server time instead of "last reply received" time.
+
+Every request/reply gives one sample (client send t0, server stamp ts,
+client receive t1):
+    offset = ts - (t0+t1)/2        true offset within +-rtt/2, rtt = t1-t0
+Network queueing only makes rtt longer, so per bucket (BUCKET s) only the
+sample with the smallest rtt is kept (min-RTT filter). Replies the server
+holds ("watch", "start") are not samples at all: their stamp is the release
+time, not the middle of the round trip; the client only adds unheld ones
+(client.CLOCK_COMMANDS). A line fitted to the kept samples of the closed
+buckets of the last WINDOW s gives the offset and the drift (s/s) of the
+local clock:
+    server(t) = t + a + b*(t - tref)
+    error     = min rtt/2 of the kept samples + rms residual of the fit
+
+Pure python (the client thread does not need numpy).
+
+usage:
+    clock = ClockSync()
+    clock.add(t0, server_stamp, t1)      # after every reply
+    server_t, err = clock.to_server(time.time())
+    t_local = clock.to_local(server_start)  # e.g. sleep until a server instant
+
+benchmark (simulated 4 devices, 6 hours, drifting clocks, jittery network):
+    python clock_sync.py
+
+@author: carlos
+"""
+import math
+
+WINDOW = 3600.0 # s, samples used by the fit
+BUCKET = 30.0   # s, one (min rtt) sample kept per bucket
+
+
+class ClockSync(object):
+    """
+    Offset/drift of the local clock against the server clock.
+    inputs:
+        window:= float, seconds of samples used by the fit
+        bucket:= float, seconds per min-RTT bucket
+    """
+    def __init__(self, window=WINDOW, bucket=BUCKET):
+        self.window  = window
+        self.bucket  = bucket
+        self.samples = []   # kept (mid, offset, rtt), one per closed bucket
+        self.current = None # (bucket, mid, offset, rtt) best of the open bucket
+        self.count   = 0    # samples seen
+        self.a, self.b, self.tref = 0.0, 0.0, 0.0
+        self.rms, self.rtt = 0.0, float('inf')
+
+    def ready(self):
+        return self.current is not None
+    # ready
+
+    def add(self, t0, server_t, t1):
+        """
+        One request/reply: local send time, server stamp, local receive time.
+        """
+        rtt = t1 - t0
+        if rtt < 0 or server_t != server_t: # clock step or no stamp (nan)
+            return
+        self.count += 1
+        mid = 0.5*(t0 + t1)
+        b   = int(mid // self.bucket)
+        if self.current is not None and self.current[0] == b:
+            if rtt >= self.current[3]:
+                return
+        elif self.current is not None: # bucket closed
+            self.samples.append(self.current[1:])
+            while self.samples and self.samples[0][0] < mid - self.window:
+                self.samples.pop(0)
+        closed = self.current is not None and self.current[0] != b
+        self.current = (b, mid, server_t - mid, rtt)
+        if closed or not self.samples:
+            self.fit()
+    # add
+
+    def fit(self):
+        """
+        Least squares line through the kept samples of the closed buckets;
+        the best sample of the open bucket only until one bucket is closed
+        (its first samples may still be poor ones).
+        """
+        pts  = self.samples or [self.current[1:]]
+        n    = len(pts)
+        self.tref = pts[-1][0]
+        self.rtt  = min(p[2] for p in pts[-4:]) # recent min rtt
+        if n < 3: # not enough for a drift: best offset
+            self.a, self.b, self.rms = min(pts, key=lambda p: p[2])[1], 0.0, 0.0
+            return
+        mx  = sum(p[0]-self.tref for p in pts)/n
+        my  = sum(p[1] for p in pts)/n
+        sxx = sum((p[0]-self.tref-mx)**2 for p in pts)
+        sxy = sum((p[0]-self.tref-mx)*(p[1]-my) for p in pts)
+        self.b = sxy/sxx if sxx > 0 else 0.0
+        self.a = my - self.b*mx
+        self.rms = math.sqrt(sum((p[1]-self.a-self.b*(p[0]-self.tref))**2 for p in pts)/n)
+    # fit
+
+    def offset(self, t):
+        return self.a + self.b*(t - self.tref)
+    # offset
+
+    def to_server(self, t):
+        """
+        Server time of local time t and its error bound (s); (nan, nan)
+        before the first sample.
+        """
+        if not self.ready():
+            return float('nan'), float('nan')
+        return t + self.offset(t), 0.5*self.rtt + self.rms
+    # to_server
+
+    def to_local(self, server_t):
+        """
+        Local time of server time server_t (inverse of to_server).
+        """
+        t = server_t - self.offset(server_t)
+        return server_t - self.offset(t)
+    # to_local
+
+    def summary(self):
+        return "offset {:+.3f} ms, drift {:+.1f} ppm, error {:.3f} ms ({} samples, {} kept)".format(
+            self.a*1e3, self.b*1e6, (0.5*self.rtt + self.rms)*1e3, self.count, len(self.samples))
+    # summary
+#ClockSync()
+
+
+if __name__ == "__main__":
+    import random
+    random.seed(0)
+    hours   = 6
+    period  = 1.0   # s between sync requests
+    ndev    = 4
+    # local(s) = s*(1+drift) + offset: up to 0.5 s offset, +-50 ppm drift
+    clocks  = [(random.uniform(-0.5, 0.5), random.uniform(-50e-6, 50e-6)) for d in range(ndev)]
+    local   = lambda s, (o, d): s*(1+d) + o
+    syncs   = [ClockSync() for d in range(ndev)]
+    phase   = [random.random()*period for d in range(ndev)] # devices poll at their own pace
+    stamps  = [(0.0, 0.0)]*ndev # (previous, last) reply stamps: what the recorders wrote so far
+    delay   = lambda: 0.0002 + random.expovariate(1/0.002) # one way, 2 ms mean jitter
+    err_est, err_last, bound_ok, n = [], [], 0, 0
+    s = 0.0
+    while s < hours*3600:
+        for d in range(ndev):
+            up, down = delay(), delay()
+            ts = s + phase[d]
+            syncs[d].add(local(ts-up, clocks[d]), ts, local(ts+down, clocks[d]))
+            stamps[d] = (stamps[d][1], ts)
+        # a frame captured on every device at server time e
+        e   = s + period*random.random()
+        est = []
+        for d in range(ndev):
+            t_srv, bound = syncs[d].to_server(local(e, clocks[d]))
+            est.append(t_srv)
+            bound_ok += abs(t_srv - e) <= bound
+            n += 1
+        last = [l if l <= e else p for p, l in stamps]
+        err_est.append(max(est)-min(est))
+        err_last.append(max(last)-min(last))
+        s += period
+    err_est.sort()
+    err_last.sort()
+    pct = lambda v, q: v[int(q*(len(v)-1))]*1e3
+    print "{} devices, {} h, sync every {} s".format(ndev, hours, period)
+    for d in range(ndev):
+        print "\tdev{}: true offset {:+.3f} ms drift {:+.1f} ppm | {}".format(
+            d+1, clocks[d][0]*1e3, clocks[d][1]*1e6, syncs[d].summary())
+    print "cross-device alignment error (ms): median {:.3f}, p99 {:.3f}, max {:.3f}".format(
+        pct(err_est, 0.5), pct(err_est, 0.99), err_est[-1]*1e3)
+    print "last-reply stamps instead       : median {:.3f}, p99 {:.3f}, max {:.3f}".format(
+        pct(err_last, 0.5), pct(err_last, 0.99), err_last[-1]*1e3)
+    print "error within the reported bound: {:.1%}".format(bound_ok/float(n))
@@ -12,6 +12,8 @@ dependiencies: openni, opencv, numpy
 
 import os, cv2, openni
 import numpy as np
+import session_file
+import depth_display
 
 
 p_src ="../data/icudoorframes/" # folder where to get frames
@@ -35,11 +37,38 @@ def get_natural_imlist(path,imtype="rgb"):
     return sorted(names, key=lambda x:int(x.split("_")[1].split(".")[0]))
 #get_natural_imlist
 
+def session_frames(path, s, e):
+    '''
+    Yields the (rgb, depth, mask, skel) images of the stored frames s:e of a
+    session container (session_file.py). The depth is colorized from the raw
+    depth and missing modalities are black.
+    '''
+    session = session_file.SessionReader(path)
+    stored  = session.modalities()
+    rgbs    = session['rgb']
+    others  = [(m, session[m] if m in stored else None) for m in ('depth','mask','skel')]
+    colorizer = depth_display.DepthColorizer()
+    for i in range(s, min(e, len(rgbs))):
+        ims = [rgbs[i]]
+        for m, stream in others:
+            im = stream.frame(rgbs.frames[i]) if stream else None
+            if im is None:
+                im = np.zeros_like(ims[0])
+            elif m == 'depth':
+                im = colorizer.colorize(im)
+            elif im.ndim == 2:
+                im = cv2.cvtColor(im,cv2.COLOR_GRAY2RGB)
+            ims.append(im)
+        yield ims
+    session.close()
+#session_frames
+
 def gen_video(p_src, p_dst,s,e, imtype="rgb",fps=10, aviname='test', text=''):
     ''' Generates a .avi video file using the images in the path folder.
     inputs:
-        p_src:= str, path to images/frames folder
+        p_src:= str, path to images/frames folder or to a .micu session file
         p_dst:= str, path to folder where avi will be stored
+        s, e := int, first and last (excluded) frame positions
         imtype:= str, one of 5 types {rgb, mask, depth, skel, all}
         fps:= int, video speed in frames per second
         text= bool, generate video w text message "TESTING: +'frame #'"
@@ -48,8 +77,13 @@ def gen_video(p_src, p_dst,s,e, imtype="rgb",fps=10, aviname='test', text=''):
      '''
     #aviname = imtype+"_test"
     #aviname = "tita4BlightOFF"+imtype
-    # use the narturalsorted images to generated video:
-    natural_names = get_natural_imlist(p_src,"rgb")
+    if session_file.is_session(p_src): # seeks straight to frame s
+        frames = session_frames(p_src, s, e)
+    else:
+        # use the narturalsorted images to generated video:
+        natural_names = get_natural_imlist(p_src,"rgb")
+        frames = ([cv2.imread(name.replace('rgb', m)) for m in ('rgb','depth','mask','skel')]
+                  for name in natural_names[s:e])
 
 ##    im = cv2.imread(natural_names[0])
     h,w= rgbdm.shape[0:2]
@@ -61,11 +95,7 @@ def gen_video(p_src, p_dst,s,e, imtype="rgb",fps=10, aviname='test', text=''):
     writer = cv2.VideoWriter(filename= p_dst+aviname+".avi",
         fourcc=cv2.cv.CV_FOURCC('I','Y','U','V'), fps=10, frameSize=(w,h))
     # go tru the images on the list and create the avi
-    for name in natural_names[s:e]:
-        rgb = cv2.imread(name)
-        mask= cv2.imread(name.replace('rgb', 'mask'))
-        depth = cv2.imread(name.replace('rgb', 'depth'))
-        skel  = cv2.imread(name.replace('rgb','skel'))
+    for rgb, depth, mask, skel in frames:
 
         rgbdm[:,0:640]    = rgb
         rgbdm[:,640:1280] = depth #cv2.cvtColor(depth4display,cv2.COLOR_GRAY2RGB)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 19Sep2016
+
+compositor.py
+
+Preview canvas for the capture scripts. Replaces the per-frame
+    rgbdm = np.hstack((rgb,d4d,dmap)); cv2.resize(rgbdm,(960,240))
+which allocates a 480x1920x3 array and resizes it on every captured frame.
+
+The Compositor owns one fixed canvas of ntiles side by side tiles and each
+modality is resized directly into its tile slice (no hstack, no full size
+intermediate). Gray images (e.g., masks) go through a small tile-sized
+scratch buffer. The preview runs at its own rate (max_fps): the capture
+loop asks due() and only composes/shows when a refresh is needed.
+
+usage:
+    preview = Compositor(3, tile_size=(320,240), captions=['rgb','depth','dmap'], max_fps=10)
+    ...
+    if preview.due():
+        cv2.imshow("1:4 scale", preview.compose((rgb, d4d, dmap)))
+        key = cv2.waitKey(1) & 255
+
+@author: carlos
+"""
+import time
+import numpy as np
+import cv2
+
+
+class Compositor(object):
+    """
+    Fixed canvas of side by side tiles.
+    inputs:
+        ntiles       := int, number of images shown side by side
+        tile_size    := (width, height) of each tile in the canvas
+        captions     := list of str (one per tile) or None
+        max_fps      := float, preview refresh rate; 0 or None refreshes on
+                        every call to due()
+        interpolation:= opencv resize interpolation flag
+    """
+    caption_color = (0,255,0)
+
+    def __init__(self, ntiles, tile_size=(320,240), captions=None, max_fps=10,
+                 interpolation=cv2.INTER_LINEAR):
+        tw, th = tile_size
+        self.ntiles    = ntiles
+        self.tile_size = (tw, th)
+        self.canvas    = np.zeros((th, tw*ntiles, 3), dtype=np.uint8)
+        self.tiles     = [self.canvas[:, i*tw:(i+1)*tw] for i in range(ntiles)]
+        self.gray      = np.zeros((th, tw), dtype=np.uint8)
+        self.captions  = captions
+        self.period    = 1.0/max_fps if max_fps else 0.0
+        self.interp    = interpolation
+        self.last      = 0.0
+        self.shown     = 0 # frames composed so far
+
+    def due(self, now=None):
+        """
+        True when the preview should be refreshed (max_fps not exceeded).
+        """
+        if now is None:
+            now = time.time()
+        return (now - self.last) >= self.period
+    # due
+
+    def draw(self, i, image):
+        """
+        Resizes image straight into tile i of the canvas.
+        """
+        tile = self.tiles[i]
+        if image.ndim == 2 or image.shape[2] == 1:
+            gray = cv2.resize(image, self.tile_size, dst=self.gray, interpolation=self.interp)
+            res  = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR, dst=tile)
+        else:
+            res  = cv2.resize(image, self.tile_size, dst=tile, interpolation=self.interp)
+        if res is not tile: # opencv could not write into the slice
+            tile[...] = res
+        if self.captions and self.captions[i]:
+            cv2.putText(tile, self.captions[i], (5, 15), cv2.FONT_HERSHEY_PLAIN, 1.0,
+                        self.caption_color, thickness=1)
+        return tile
+    # draw
+
+    def compose(self, images, now=None):
+        """
+        Draws every image into its tile and returns the canvas (not a copy).
+        """
+        for i, image in enumerate(images):
+            self.draw(i, image)
+        self.last   = time.time() if now is None else now
+        self.shown += 1
+        return self.canvas
+    # compose
+#Compositor()
@@ -0,0 +1,501 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 12Oct2016
+
+coordinator.py
+
+Single threaded recording coordinator: replaces the ServerThread per device
+(server_threads.py, one TCPServer thread and port per camera) with one
+select() loop that multiplexes every connection, and keeps the state of all
+devices in one Coordinator object instead of module globals.
+(python2 has no asyncio; select is the same event loop without coroutines.)
+
+Wire compatible with server_threads.py and client.py:
+    request  "<devid> <cmd>\\n"   cmd := connect, sync, check, watch, close, start,
+                                  register <capabilities>, heartbeat
+    reply    "<msg>_<tic>=<local time>\\n"
+    any number of requests per connection; "watch" is held until the state
+    changes (at most HOLD s)
+or the framed binary messages of wire_protocol.py (same requests/replies,
+numeric time stamps); each connection is one or the other.
+
+Scheduled start: when the last device connects, the coordinator fixes the
+start instant LEAD s ahead in its own clock. "start" is answered with that
+instant and the session length ("start_<instant>_<length>"); it is held
+like "watch" until all devices are connected. The recorders sleep until
+the instant (client.ClientConnect.wait_until) and roll over every length s.
+Strict mode, faster path: with a frame_trigger.TriggerSender the coordinator
+also multicasts a numbered trigger (one UDP datagram for all devices) when
+all devices are connected, before the "save" answers go out.
+Devices (device_registry.py): any device id may register (DEVICES limits
+them); every request is a heartbeat and a device silent for timeout s is
+evicted. "All connected" means every live device; MIN_DEVICES must be live
+before the first start.
+Metrics: recorders report fps, queue depth, drops, disk free and rtt with
+their heartbeat ("metrics" request); the last values are kept in ring
+buffers (device_metrics.py) and served as text or json on a local HTTP port
+(listen_http, same select loop). Nothing is printed per request.
+The coordinator listens on PORT and, by default, also on the old per-device
+ports, so the clients do not need to change (any device may use any port).
+
+usage:
+    python coordinator.py                 # serve on HOST, ports 50007-50010
+    python coordinator.py benchmark       # request throughput, 4/16/64 devices
+    python device_metrics.py              # live view of METRICS_PORT
+
+    coord = Coordinator(min_devices=20)   # any device id, start when 20 are up
+    coord.listen(HOST, PORT)
+    coord.serve()                         # returns after the last device closed
+
+@author: carlos
+"""
+import os
+import sys
+import time
+import errno
+import socket
+import select
+from time import strftime, localtime
+
+import wire_protocol as wire
+import frame_trigger
+import device_registry
+import device_metrics
+
+HOST         = "192.168.0.100" # Local net
+PORT         = 50007
+LEGACY_PORTS = [50008, 50009, 50010]
+HOLD         = 0.5    # s, longest wait of a "watch" request
+LEAD         = 0.5    # s, from the last device connected to the scheduled start
+SESSION_SECS = 3600.0 # s, announced session length (0: no rollover)
+MULTICAST    = True   # UDP trigger on frame_trigger.GROUP:PORT (strict mode)
+IDLE         = 120.0  # s, a silent connection is closed
+DEVICES      = None   # allowed devices, e.g. ['dev1', 'dev2']; None: any device may register
+MIN_DEVICES  = 4      # live devices needed before the first start
+METRICS_PORT = 50080  # http://localhost:50080/metrics (device_metrics.py)
+
+
+class Connection(object):
+    """
+    Buffers of one client socket.
+    """
+    def __init__(self, sock, address):
+        self.sock    = sock
+        self.address = address
+        self.inbuf   = ''
+        self.outbuf  = ''
+        self.held    = None # (request, deadline) of a held "watch"/"start"
+        self.http    = False # metrics endpoint connection
+        self.closing = False # close once outbuf is sent
+        self.binary  = None # framing, known after the first bytes
+        self.decoder = wire.Decoder()
+        self.last    = time.time()
+#Connection()
+
+
+class Coordinator(object):
+    """
+    State of every device and the select loop serving them.
+    inputs:
+        devices     := list of str, allowed devices ('dev1', 'dev2', ...); None: any
+        session_secs:= float, announced session length (0: no rollover)
+        lead        := float, seconds from all connected to the start
+        trigger     := frame_trigger.TriggerSender or None
+        min_devices := int, live devices needed for the first start (default:
+                       all the allowed devices, 1 if any device may register)
+        timeout     := float, seconds without a request before a device is evicted
+    """
+    def __init__(self, devices=None, session_secs=0.0, lead=LEAD, trigger=None,
+                 min_devices=None, timeout=device_registry.TIMEOUT):
+        if min_devices is None:
+            min_devices = len(devices) if devices else 1
+        self.registry  = device_registry.DeviceRegistry(devices, timeout, min_devices)
+        self.trigger   = trigger
+        self.session_secs = session_secs
+        self.lead      = lead
+        self.start_at  = None  # scheduled start, server time
+        self.devs      = set() # connected, not yet saved
+        self.remaining = set() # live devices not yet told to terminate
+        self.last_evict = 0.0
+        self.metrics   = device_metrics.MetricsStore()
+        self.since     = time.time()
+        self.conc      = True  # flag for connecting
+        self.save      = False # flag to save
+        self.terminate = False
+        self.done      = False
+        self.requests  = 0
+        self.listeners = []
+        self.http_listeners = []
+        self.conns     = {}    # socket -> Connection
+
+    ## --- protocol -----------------------------------------------------------
+    def command(self, devid, cmd, tic, payload=''):
+        """
+        Applies one request (same rules as server_threads.MyTCPHandler);
+        every request is a heartbeat of its device.
+        output:
+            reply name (a wire_protocol.REPLIES key)
+        """
+        self.requests += 1
+        cmd  = "check" if cmd == "watch" else cmd
+        dev  = "dev{}".format(devid)
+        kind = "unknown"
+        if cmd == "register":
+            known = self.registry.register(dev, device_registry.parse_capabilities(payload), tic)
+        else:
+            known = self.registry.heartbeat(dev, tic)
+        if not known:
+            kind = "rejected"
+        elif not self.terminate:
+            if cmd == "register":
+                kind = "registered"
+            elif self.conc and cmd == "connect":
+                if dev in self.devs:
+                    kind = "ready"
+                else:
+                    self.devs.add(dev)
+                    kind = "connected"
+                    print "{} connected ({}/{})".format(dev, len(self.devs), len(self.registry))
+            elif cmd in ("sync", "heartbeat", "metrics"):
+                if cmd == "metrics":
+                    self.metrics.report(dev, device_metrics.parse_report(payload), tic)
+                kind = "sync"
+            elif cmd == "start":
+                kind = "wait" if self.start_at is None else "start"
+            elif cmd == "check":
+                if self.save and dev in self.devs:
+                    kind = "save"
+                    self.devs.discard(dev)
+                else:
+                    kind = "wait"
+            elif cmd == "close":
+                print "{} closed: terminating all devices".format(dev)
+                self.remaining = self.registry.live() - set([dev])
+                kind = "close"
+                self.terminate = True
+        else: # terminating: every live device is told once, the loop ends after the last
+            self.remaining.discard(dev)
+            kind = "close" if cmd == "close" else "terminate"
+        self.update(tic)
+        return kind
+    # command
+
+    def update(self, tic):
+        """
+        Connecting/saving flags from the live set of devices.
+        """
+        if self.terminate and not self.remaining:
+            self.done = True
+        if self.registry.all_connected(self.devs, started=self.start_at is not None):
+            if not self.save:
+                if self.trigger:
+                    self.trigger.send(tic)
+                print "All CONNECTED"
+            if self.start_at is None:
+                self.start_at = tic + self.lead
+                print "Start scheduled at {!r} (in {} s)".format(self.start_at, self.lead)
+            self.conc, self.save = False, True
+        elif not self.devs:
+            self.conc, self.save = True, False
+    # update
+
+    def evict(self, now):
+        """
+        Drops the devices without heartbeat (at most once per second); True
+        if the state changed.
+        """
+        if now - self.last_evict < 1.0:
+            return False
+        self.last_evict = now
+        gone = self.registry.evict(now)
+        if not gone:
+            return False
+        state = (self.save, self.terminate, self.done)
+        self.devs.difference_update(gone)
+        self.remaining.difference_update(gone)
+        self.update(now)
+        return (self.save, self.terminate, self.done) != state
+    # evict
+
+    def respond(self, conn, request, now):
+        """
+        Reply bytes to a request (text line or wire_protocol.Message) in the
+        framing of the connection.
+        output:
+            (data, reply name)
+        """
+        if conn.binary:
+            dev, cmd, payload = request.dev, wire.NAMES.get(request.type, ''), request.payload
+        else:
+            data = request.strip().split(" ")
+            if len(data) < 2:
+                return "unknown="+strftime("%a, %d %b %Y %H:%M:%S +0000", localtime())+'\n', "unknown"
+            dev, cmd, payload = data[0], data[1].lower(), " ".join(data[2:])
+        kind = self.command(dev, cmd, now, payload)
+        stamp, payload = now, ''
+        if kind == "start":
+            stamp, payload = self.start_at, wire.SESSION.pack(self.session_secs)
+        reply = wire.Message(wire.REPLIES[kind], dev, stamp, payload)
+        if conn.binary:
+            return wire.pack(reply.type, dev, stamp, payload), kind
+        return wire.to_text(reply)+'\n', kind
+    # respond
+
+    ## --- event loop ---------------------------------------------------------
+    def listen(self, host=HOST, port=PORT):
+        """
+        Adds a listening socket; returns its port (port=0 picks a free one).
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(128)
+        sock.setblocking(0)
+        self.listeners.append(sock)
+        return sock.getsockname()[1]
+    # listen
+
+    def listen_http(self, host='localhost', port=METRICS_PORT):
+        """
+        Adds the metrics endpoint (GET /metrics, /metrics.json); returns its port.
+        """
+        port = self.listen(host, port)
+        self.http_listeners.append(self.listeners.pop())
+        return port
+    # listen_http
+
+    def accept(self, listener):
+        try:
+            sock, address = listener.accept()
+        except socket.error:
+            return
+        sock.setblocking(0)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.conns[sock] = Connection(sock, address)
+        self.conns[sock].http = listener in self.http_listeners
+    # accept
+
+    def stats(self, now):
+        return {'requests': self.requests, 'live': len(self.registry),
+                'connections': len(self.conns), 'uptime_s': int(now-self.since)}
+    # stats
+
+    def serve_http(self, conn, data, now):
+        """
+        Answers one metrics GET and closes the connection.
+        """
+        conn.inbuf += data
+        if '\r\n\r\n' not in conn.inbuf and '\n\n' not in conn.inbuf:
+            if len(conn.inbuf) > 8192:
+                self.drop(conn)
+            return
+        head = conn.inbuf.split(' ')
+        path = head[1] if len(head) > 1 and head[0] == 'GET' else ''
+        conn.outbuf += device_metrics.http_response(path, self.metrics, self.registry, self.stats(now))
+        conn.inbuf   = ''
+        conn.closing = True
+        self.send(conn)
+    # serve_http
+
+    def drop(self, conn):
+        self.conns.pop(conn.sock, None)
+        conn.sock.close()
+    # drop
+
+    def receive(self, conn, now):
+        """
+        Reads what the client sent and answers every complete request.
+        """
+        try:
+            data = conn.sock.recv(65536)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            data = ''
+        if conn.http:
+            if data:
+                self.serve_http(conn, data, now)
+            else:
+                self.drop(conn)
+            return False
+        if not data: # closed (a last request without newline is answered)
+            if not conn.binary and conn.inbuf.strip():
+                conn.outbuf += self.respond(conn, conn.inbuf, now)[0]
+                self.send(conn)
+            self.drop(conn)
+            return False
+        conn.last = now
+        if conn.binary is None: # the first bytes tell the framing
+            conn.binary = wire.is_binary(data)
+        if conn.binary:
+            try:
+                requests = conn.decoder.feed(data)
+            except wire.ProtocolError as e:
+                print "{}: {}, closing".format(conn.address, e)
+                self.drop(conn)
+                return False
+            watch = lambda r: r.type in (wire.WATCH, wire.SCHEDULE)
+        else:
+            lines       = (conn.inbuf+data).split('\n')
+            conn.inbuf  = lines.pop()
+            requests    = [l for l in lines if l.strip()]
+            watch = lambda r: r.split()[-1].lower() in ('watch', 'start')
+        if conn.held and requests: # the client sent again: answer the held request first
+            conn.outbuf += self.respond(conn, conn.held[0], now)[0]
+            conn.held    = None
+        changed = False
+        for i, request in enumerate(requests):
+            state = (self.save, self.terminate)
+            reply, kind = self.respond(conn, request, now)
+            changed |= (self.save, self.terminate) != state
+            if watch(request) and kind == 'wait' and i == len(requests)-1:
+                self.requests -= 1 # counted when answered
+                conn.held = (request, now+HOLD)
+            else:
+                conn.outbuf += reply
+        return changed
+    # receive
+
+    def send(self, conn):
+        try:
+            sent = conn.sock.send(conn.outbuf)
+            conn.outbuf = conn.outbuf[sent:]
+            if conn.closing and not conn.outbuf:
+                self.drop(conn)
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.drop(conn)
+    # send
+
+    def release(self, now, changed):
+        """
+        Answers the held "watch" requests whose time is up, or all of them
+        when the state changed.
+        """
+        for conn in self.conns.values():
+            if conn.held and (changed or now >= conn.held[1]):
+                conn.outbuf += self.respond(conn, conn.held[0], now)[0]
+                conn.held    = None
+            if conn.outbuf:
+                self.send(conn)
+    # release
+
+    def step(self, timeout=1.0):
+        """
+        One select() round.
+        """
+        now      = time.time()
+        deadline = [c.held[1] for c in self.conns.itervalues() if c.held]
+        if deadline:
+            timeout = max(0.0, min(timeout, min(deadline)-now))
+        writers = [s for s, c in self.conns.iteritems() if c.outbuf]
+        readable, writable, _ = select.select(self.listeners+self.http_listeners+self.conns.keys(),
+                                              writers, [], timeout)
+        now     = time.time()
+        changed = False
+        for sock in readable:
+            if sock in self.listeners or sock in self.http_listeners:
+                self.accept(sock)
+            elif sock in self.conns:
+                changed |= self.receive(self.conns[sock], now)
+        changed |= self.evict(now)
+        for sock in writable:
+            if sock in self.conns and self.conns[sock].outbuf:
+                self.send(self.conns[sock])
+        self.release(now, changed)
+        for conn in [c for c in self.conns.values() if now-c.last > IDLE and not c.outbuf]:
+            self.drop(conn)
+    # step
+
+    def serve(self, stop=None):
+        """
+        Runs the loop until every device closed (or stop() is true).
+        """
+        while not self.done and not (stop and stop()):
+            self.step()
+        for conn in self.conns.values(): # last replies
+            self.send(conn)
+            self.drop(conn)
+        for sock in self.listeners+self.http_listeners:
+            sock.close()
+        self.listeners, self.http_listeners = [], []
+    # serve
+#Coordinator()
+
+
+def drive(host, port, ndev, secs):
+    """
+    Benchmark client: ndev persistent connections, each sending 'check' as
+    soon as it has its previous reply; returns the replies per second.
+    """
+    socks = []
+    for d in range(ndev):
+        s = socket.create_connection((host, port))
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        s.sendall("{} check\n".format(d+1))
+        socks.append(s)
+    ids     = dict((s, d+1) for d, s in enumerate(socks))
+    replies = 0
+    tic     = time.time()
+    while time.time()-tic < secs:
+        for s in select.select(socks, [], [], 1.0)[0]:
+            data = s.recv(65536)
+            n    = data.count('\n')
+            replies += n
+            s.sendall("{} check\n".format(ids[s])*n)
+    for s in socks:
+        s.close()
+    return replies/(time.time()-tic)
+#drive
+
+
+def run_server(kind, port, ndev, quiet=True):
+    """
+    Benchmark server process: 'coordinator' or 'threads' (server_threads).
+    """
+    if quiet:
+        sys.stdout = open(os.devnull, 'w')
+    devices = ['dev{}'.format(d+1) for d in range(ndev)]
+    if kind == 'coordinator':
+        coord = Coordinator(devices)
+        coord.listen('localhost', port)
+        coord.serve()
+    else:
+        import server_threads
+        server_threads.registry = server_threads.device_registry.DeviceRegistry(devices, min_devices=ndev)
+        server_threads.ServerThread('dev1', HOST='localhost', PORT=port).run()
+#run_server
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        import multiprocessing
+        for ndev in (4, 16, 64):
+            for kind in ('threads', 'coordinator'):
+                probe = socket.socket()
+                probe.bind(('localhost', 0))
+                port  = probe.getsockname()[1]
+                probe.close()
+                proc  = multiprocessing.Process(target=run_server, args=(kind, port, ndev))
+                proc.daemon = True
+                proc.start()
+                time.sleep(0.5)
+                rate = drive('localhost', port, ndev, 3.0)
+                proc.terminate()
+                proc.join()
+                print "{:3d} devices, {:11s}: {:8.0f} requests/s".format(ndev, kind, rate)
+        sys.exit(0)
+
+    time.sleep(5) # secs pause!
+    print " ====== COORDINATOR -- RUNNING ====== "
+    trigger = frame_trigger.TriggerSender() if MULTICAST else None
+    coord = Coordinator(DEVICES, session_secs=SESSION_SECS, trigger=trigger, min_devices=MIN_DEVICES)
+    coord.listen(HOST, PORT)
+    for port in LEGACY_PORTS: # unchanged clients use their old port
+        coord.listen(HOST, port)
+    coord.listen_http('localhost', METRICS_PORT)
+    try:
+        coord.serve()
+    except KeyboardInterrupt:
+        pass
+    print "CLOSED!"
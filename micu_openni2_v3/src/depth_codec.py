@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 12Sep2016
+
+depth_codec.py
+
+Lossless packing of the raw uint16 depth (mm) into the 3-channel uint8
+"dmap" images saved by the recorders (png / avi friendly):
+    channel 0 (B) := low  byte, depth & 0xFF
+    channel 1 (G) := high byte, depth >> 8
+    channel 2 (R) := 0
+The encoder is one pass over the frame (the uint16 buffer is viewed as
+byte pairs, no temporaries) and decode_dmap recovers the exact depth.
+
+NOTE:
+    dmaps saved before this codec used (low, high-256, low) with the
+    values >255 zeroed, which is lossy and cannot be decoded.
+
+usage:
+    dmap  = encode_dmap(depth)          # or encode_dmap(depth, out=slot.dmap)
+    depth = decode_dmap(cv2.imread(p+'/dmap/dmap_0.png'))
+
+@author: carlos
+"""
+import numpy as np
+
+
+def encode_dmap(depth, out=None):
+    """
+    Packs a uint16 depth map into a 3-channel uint8 dmap.
+    inputs:
+        depth:= (h,w) uint16 ndarray, raw depth in mm
+        out  := (h,w,3) uint8 ndarray to fill, allocated when None
+    output:
+        out
+    """
+    h, w = depth.shape
+    if out is None:
+        out = np.zeros((h,w,3), dtype=np.uint8)
+    else:
+        out[:,:,2] = 0
+    # little endian uint16 == (low, high) byte pairs
+    pairs = np.ascontiguousarray(depth, dtype='<u2').view(np.uint8).reshape(h,w,2)
+    np.copyto(out[:,:,:2], pairs)
+    return out
+#encode_dmap
+
+
+def decode_dmap(dmap, out=None):
+    """
+    Recovers the uint16 depth map (mm) from an encode_dmap image.
+    inputs:
+        dmap:= (h,w,3) uint8 ndarray, e.g. cv2.imread of a dmap png
+        out := (h,w) uint16 ndarray to fill, allocated when None
+    output:
+        out
+    """
+    h, w = dmap.shape[:2]
+    if out is None:
+        out = np.empty((h,w), dtype='<u2')
+    if out.dtype.byteorder == '>' or not out.flags['C_CONTIGUOUS']:
+        raise ValueError("out must be a C contiguous little endian uint16 array")
+    np.copyto(out.view(np.uint8).reshape(h,w,2), dmap[:,:,:2])
+    return out
+#decode_dmap
+
+
+if __name__ == "__main__":
+    # Round trip check over the full 16 bit range and a 12 bit depth frame
+    full = np.arange(2**16, dtype=np.uint16).reshape(256,256)
+    assert np.array_equal(decode_dmap(encode_dmap(full)), full)
+
+    depth = np.random.randint(0, 2**12, size=(480,640)).astype(np.uint16)
+    dmap  = np.ones((480,640,3), dtype=np.uint8) # dirty reusable buffer
+    back  = np.empty((480,640), dtype=np.uint16)
+    encode_dmap(depth, out=dmap)
+    assert not dmap[:,:,2].any()
+    assert np.array_equal(decode_dmap(dmap, out=back), depth)
+    assert np.array_equal(decode_dmap(dmap[:,::-1])[:,::-1], depth) # strided input
+
+    # png round trip, when opencv is available
+    try:
+        import cv2
+        ok, png = cv2.imencode('.png', dmap)
+        assert np.array_equal(decode_dmap(cv2.imdecode(png, 1)), depth)
+    except ImportError:
+        pass
+    print "depth_codec round trip OK"
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 22Sep2016
+
+depth_store.py
+
+Storage of the raw uint16 depth (mm) exactly as read from
+depth_stream.read_frame(), instead of the 8-bit 3-channel dmap pngs.
+
+Storage modes (DepthStore):
+    'png16'  := one 16-bit single channel png per frame
+                    <folder>/depth16_<frame>.png
+    'chunks' := chunk_frames frames per zlib compressed numpy chunk
+                    <folder>/depth16_<smallest frame>.npz.z
+                the chunk holds two npy records: frame numbers, (n,h,w) uint16
+Both modes take a compression level (png: 0-9, zlib: 0-9).
+
+Reader API (returns the original millimetre values):
+    depth          = read_depth(path)           # png16 (or packed dmap png)
+    frames, depths = read_depth_chunk(path)     # chunk file
+    for frame, depth in iter_depth(folder): ... # whole folder, frame order
+
+usage:
+    store = DepthStore(mode='chunks', level=1, chunk_frames=30)
+    store.save(folder4frames+'/dmap/', frame, depth)
+    ...
+    store.close() # writes the partial chunks
+
+@author: carlos
+"""
+import os
+import io
+import zlib
+import threading
+import numpy as np
+import cv2
+
+import depth_codec
+
+PNG_COMPRESSION = getattr(cv2, 'IMWRITE_PNG_COMPRESSION', 16)
+CHUNK_EXT       = '.npz.z'
+
+
+def save_depth_png(path, depth, level=3):
+    """
+    Writes depth (uint16, mm) as a 16-bit single channel png.
+    """
+    if depth.dtype != np.uint16:
+        raise ValueError("depth must be uint16, got {}".format(depth.dtype))
+    if not cv2.imwrite(path, depth, [PNG_COMPRESSION, level]):
+        raise IOError("Could not write {}".format(path))
+#save_depth_png
+
+
+def read_depth(path):
+    """
+    Returns the uint16 depth (mm) stored in a png.
+    Accepts 16-bit single channel pngs and depth_codec packed dmap pngs.
+    """
+    im = cv2.imread(path, -1) # -1 := IMREAD_UNCHANGED, keeps 16 bits
+    if im is None:
+        raise IOError("Could not read {}".format(path))
+    if im.dtype == np.uint16 and im.ndim == 2:
+        return im
+    if im.dtype == np.uint8 and im.ndim == 3:
+        return depth_codec.decode_dmap(im)
+    raise ValueError("{} is not a depth image ({}, {})".format(path, im.dtype, im.shape))
+#read_depth
+
+
+def write_depth_chunk(path, frames, depths, level=1):
+    """
+    Writes frame numbers and an (n,h,w) uint16 stack as one zlib chunk.
+    The chunk is written to path+'.tmp' and renamed, so a crash never
+    leaves a truncated chunk behind.
+    """
+    buf = io.BytesIO()
+    np.save(buf, np.asarray(frames, dtype=np.int64))
+    np.save(buf, np.asarray(depths, dtype=np.uint16))
+    with open(path+'.tmp', 'wb') as fp:
+        fp.write(zlib.compress(buf.getvalue(), level))
+    os.rename(path+'.tmp', path)
+#write_depth_chunk
+
+
+def read_depth_chunk(path):
+    """
+    Returns (frames, depths) from a chunk file:
+        frames:= (n,) int64 ndarray, frame numbers
+        depths:= (n,h,w) uint16 ndarray, depth in mm
+    """
+    with open(path, 'rb') as fp:
+        buf = io.BytesIO(zlib.decompress(fp.read()))
+    frames = np.load(buf)
+    depths = np.load(buf)
+    return frames, depths
+#read_depth_chunk
+
+
+def iter_depth(folder):
+    """
+    Yields (frame, depth) for every depth16 png and chunk in folder, in
+    frame order.
+    """
+    items = []
+    for name in os.listdir(folder):
+        if not name.startswith('depth16_'):
+            continue
+        if name.endswith('.png'):
+            items.append((int(name[8:-4]), os.path.join(folder, name)))
+        elif name.endswith(CHUNK_EXT):
+            items.append((int(name[8:-len(CHUNK_EXT)]), os.path.join(folder, name)))
+    pending = []
+    for first, path in sorted(items):
+        if path.endswith('.png'):
+            pending.append((first, read_depth(path)))
+        else:
+            frames, depths = read_depth_chunk(path)
+            pending.extend(zip(frames.tolist(), depths))
+        # chunks can interleave a few frames (several writer threads)
+        pending.sort(key=lambda x: x[0])
+        while pending and pending[0][0] <= first:
+            yield pending.pop(0)
+    for item in pending:
+        yield item
+#iter_depth
+
+
+class DepthChunkWriter(object):
+    """
+    Accumulates up to chunk_frames depth frames and writes them as a chunk.
+    """
+    def __init__(self, folder, chunk_frames=30, level=1):
+        self.folder       = folder
+        self.chunk_frames = chunk_frames
+        self.level        = level
+        self.frames       = []
+        self.depths       = None
+        self.chunks       = 0
+
+    def add(self, frame, depth):
+        """
+        Copies depth into the chunk; returns a full chunk (frames, depths)
+        ready to be written, or None.
+        """
+        if self.depths is None:
+            self.depths = np.empty((self.chunk_frames,)+depth.shape, dtype=np.uint16)
+        self.depths[len(self.frames)] = depth
+        self.frames.append(frame)
+        if len(self.frames) == self.chunk_frames:
+            return self.take()
+        return None
+    # add
+
+    def take(self):
+        """
+        Detaches the current (possibly partial) chunk.
+        """
+        if not self.frames:
+            return None
+        chunk = (self.frames, self.depths[:len(self.frames)])
+        self.frames = []
+        self.depths = None
+        self.chunks += 1
+        return chunk
+    # take
+
+    def write(self, chunk):
+        frames, depths = chunk
+        # named after the smallest frame so iter_depth can merge in order
+        path = os.path.join(self.folder, 'depth16_{}{}'.format(min(frames), CHUNK_EXT))
+        write_depth_chunk(path, frames, depths, self.level)
+    # write
+#DepthChunkWriter()
+
+
+class DepthStore(object):
+    """
+    Thread-safe raw depth writer used by the recorders' save_frames.
+    inputs:
+        mode        := str, 'png16' or 'chunks'
+        level       := int, png or zlib compression level (0-9)
+        chunk_frames:= int, frames per chunk ('chunks' mode)
+    Chunks of a previous session folder are closed as soon as a frame for a
+    new folder arrives; compression runs outside the lock.
+    """
+    modes = ('png16', 'chunks')
+
+    def __init__(self, mode='png16', level=3, chunk_frames=30):
+        if mode not in self.modes:
+            raise ValueError("Unknown depth storage mode {}. Use one of {}".format(mode, self.modes))
+        self.mode         = mode
+        self.level        = level
+        self.chunk_frames = chunk_frames
+        self.writers      = {} # folder -> DepthChunkWriter
+        self.lock         = threading.Lock()
+
+    def save(self, folder, frame, depth):
+        if self.mode == 'png16':
+            save_depth_png(os.path.join(folder, 'depth16_{}.png'.format(frame)), depth, self.level)
+            return
+        todo = []
+        with self.lock:
+            if folder not in self.writers:
+                for old in self.writers.keys(): # session rollover
+                    writer = self.writers.pop(old)
+                    todo.append((writer, writer.take()))
+                self.writers[folder] = DepthChunkWriter(folder, self.chunk_frames, self.level)
+            writer = self.writers[folder]
+            todo.append((writer, writer.add(frame, depth)))
+        for writer, chunk in todo:
+            if chunk is not None:
+                writer.write(chunk)
+    # save
+
+    def close(self):
+        """
+        Writes every partial chunk.
+        """
+        with self.lock:
+            todo = [(w, w.take()) for w in self.writers.values()]
+            self.writers = {}
+        for writer, chunk in todo:
+            if chunk is not None:
+                writer.write(chunk)
+    # close
+#DepthStore()
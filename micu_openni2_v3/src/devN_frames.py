@@ -25,15 +25,38 @@ Current features:
     3) Displays the images: normal, medium, or small
         rgb and depth
 
-    4) Create a csv file via pandas
-        name: 'ICU_dev<#>.csv'
+    4) Per-frame time stamp journal per session (see timestamp_journal.py)
+        csv export is an offline step: python timestamp_journal.py <.tsj>
+        name: 'dev<#>_times<session>.tsj', includes the device frame stamps/indices
+        dropped device frames are printed per session, the coordinator gets the
+        running total (see frame_gaps.py)
+        frames are stamped in server time +- error bound (client.server_time(), clock_sync.py)
     
     5) Threaded tcp client and server
         devid: dev1, dev2, ..devN
-        Add/Remove access by removing/adding devs from server_threads.py
+        any number of devices: each registers (id + capabilities) and sends
+        heartbeats, see device_registry.py; no server edits to add one
         
-            client  commands: connect, check, close
-            servers response: save, wait
+            client  commands: connect, check, close, start
+            servers response: save, wait, start_<instant>_<session length>
+        scheduled_start: the recorders sleep until the start instant announced
+        by the coordinator (coordinator.py) and roll over at its session length
+        udp_trigger: in strict mode a multicast trigger from the coordinator
+        (frame_trigger.py) also saves the frame; missed triggers are counted
+        fps, writer queue, drops and free disk go to the coordinator every
+        report_every s (live view: python device_metrics.py)
+
+    6) Frame writer threads (see frame_pipeline.py)
+        the capture loop only queues frames; nwriters threads encode the pngs
+            queue_policy = 'drop_oldest' or 'block'
+
+    7) Pre-roll history in strict mode (see frame_history.py)
+        the last frames (history_mb budget) are dumped to session_<n>/preroll/
+        in the background every time the server answers save
+
+    8) Session container (see session_file.py)
+        frame_storage = 'session' appends rgb and raw depth of every frame to
+        one file per session, session_<n>/dev<N>.micu, instead of pngs
 
 Execution:
 NETWORKING
@@ -50,11 +73,25 @@ python dev1_videos.py # second terminal
 from primesense import openni2
 from primesense import _openni2 as c_api
 import cv2, cv, sys, time, os, csv
+import itertools
 import numpy as np
 import pandas as pd
 from time import localtime, strftime, gmtime
 import pickle
 import client
+import wire_protocol as wire
+import frame_pipeline
+import frame_ring
+import depth_codec
+import depth_store
+import depth_display
+import frame_history
+import compositor
+import frame_gaps
+import session_file
+import timestamp_journal
+import frame_trigger
+import device_metrics
 
 import serial
 
@@ -124,44 +161,59 @@ dev.set_image_registration_mode(openni2.IMAGE_REGISTRATION_DEPTH_TO_COLOR)
 
 
 
-def get_rgb():
+## Depth for display through a lookup table (see depth_display.py)
+colorizer = depth_display.DepthColorizer(near=0, far=2**12-1, colormap='gray')
+
+
+def get_rgb(rgb=None):
     """
-    Returns numpy 3L ndarray to represent the rgb image.
+    Returns numpy 3L ndarray to represent the rgb image and the device frame
+    metadata, frame_gaps.FrameInfo(index, timestamp).
+    Input:
+        rgb:= preallocated (h,w,3) uint8 ndarray to fill (e.g., a frame_ring
+              slot). A new array is allocated when None.
     """
-    bgr   = np.fromstring(rgb_stream.read_frame().get_buffer_as_uint8(),dtype=np.uint8).reshape(h,w,3)
-    rgb   = cv2.cvtColor(bgr,cv2.COLOR_BGR2RGB)
-    return rgb    
+    if rgb is None:
+        rgb = np.empty((h,w,3), dtype=np.uint8)
+    frame = rgb_stream.read_frame()
+    frame_ring.frame_to_array(frame.get_buffer_as_uint8(), rgb, swap_rb=True)
+    return rgb, frame_gaps.frame_info(frame)
 #get_rgb
 
 
-def get_depth():
+def get_depth(depth=None, dmap=None, d4d=None):
     """
     Returns numpy ndarrays representing the raw and ranged depth images.
+    Inputs (preallocated, e.g. frame_ring slots; allocated when None):
+        depth:= raw depth in mm, (h,w) uint16 ndarray
+        dmap := (h,w,3) uint8 ndarray
+        d4d  := (h,w,3) uint8 ndarray
     Outputs:
-        dmap:= distancemap in mm, 1L ndarray, dtype=uint16, min=0, max=2**12-1
+        dmap:= distancemap in mm packed losslessly (see depth_codec.py),
+               3L ndarray, dtype=uint8, B=low byte, G=high byte, R=0
         d4d := depth for dislay, 3L ndarray, dtype=uint8, min=0, max=255    
+        info:= frame_gaps.FrameInfo(index, timestamp) of the device frame
     Note1: 
-        fromstring is faster than asarray or frombuffer
+        the OpenNI buffer is copied once into depth; every conversion
+        writes into the given buffers
     Note2:     
         .reshape(120,160) #smaller image for faster response 
                 OMAP/ARM default video configuration
         .reshape(240,320) # Used to MATCH RGB Image (OMAP/ARM)
                 Requires .set_video_mode
     """
+    if depth is None:
+        depth = np.empty((h,w), dtype=np.uint16)
+    if dmap is None:
+        dmap = np.empty((h,w,3), dtype=np.uint8)
+    if d4d is None:
+        d4d = np.empty((h,w,3), dtype=np.uint8)
     depth_frame = depth_stream.read_frame()
-    dmap = np.fromstring(depth_frame.get_buffer_as_uint16(),dtype=np.uint16).reshape(h,w)  # Works & It's FAST
-    d4d  = dmap.astype(float) *255/ 2**12-1 # Correct the range. Depth images are 12bits
-    d4d  = cv2.cvtColor(np.uint8(d4d),cv2.COLOR_GRAY2RGB)
-    
-    temp1 = np.zeros(dmap.shape,dtype=np.uint8)
-    temp1 = dmap - 2**8 #most significant: 2**8-2**15
-
-    temp2 = dmap.copy() #least significant: 2**0-2**7
-    temp1[temp1<0]=0
-    temp2[temp2>255] = 0
-    dmap = np.uint8(np.dstack((temp2,temp1,temp2)))
-    #print dmap.shape, type(dmap), dmap.dtype
-    return dmap, d4d
+    frame_ring.frame_to_array(depth_frame.get_buffer_as_uint16(), depth)
+    colorizer.colorize(depth, out=d4d) # 12bit depth -> 3L uint8 (lut)
+    # lossless single pass packing: (low byte, high byte, 0)
+    depth_codec.encode_dmap(depth, out=dmap)
+    return dmap, d4d, frame_gaps.frame_info(depth_frame)
 #get_depth
 
 
@@ -177,9 +229,13 @@ def createSessionFolders(folder,session=0):
     folder4frames = folder +"/session_{}".format(session)
 
     folder4csv= folder4frames + '/csv/'
-    os.makedirs(folder4frames + '/rgb/')
-    os.makedirs(folder4frames + '/depth/')
-    os.makedirs(folder4frames + '/dmap/')            
+    if frame_storage == 'pngs':
+        os.makedirs(folder4frames + '/rgb/')
+        os.makedirs(folder4frames + '/depth/')
+        os.makedirs(folder4frames + '/dmap/')
+    else:
+        os.makedirs(folder4frames)
+    os.makedirs(folder4frames + '/preroll/')
     os.makedirs(folder4csv)
 
     return folder4frames,folder4csv
@@ -241,19 +297,65 @@ def createActorFolder(actor='patient_0', save2sdcard=False):
 ## createActorFolder()
 
 
-def save_frames(frame, rgb, depth, dmap, p="../data/frames/"):
+## Raw depth storage in the dmap folder (see depth_store.py)
+##   'dmap'   := packed 3-channel uint8 pngs     dmap_<n>.png
+##   'png16'  := 16-bit single channel pngs      depth16_<n>.png
+##   'chunks' := zlib compressed uint16 chunks   depth16_<first>.npz.z
+depth_storage = 'png16'
+depth_level   = 3  # png/zlib compression level 0-9
+raw_store = None
+if depth_storage != 'dmap':
+    raw_store = depth_store.DepthStore(mode=depth_storage, level=depth_level)
+
+## Frame storage
+##   'pngs'    := rgb/, depth/ and dmap/ png files (see depth_storage above)
+##   'session' := one container per session, session_<n>/dev<N>.micu
+##                (rgb png + raw uint16 depth records, the d4d and dmap
+##                 images are rebuilt from the depth when reading)
+frame_storage = 'session'
+session_store = None
+if frame_storage == 'session':
+    # raw depth records are memory mapped by the readers (zero-copy); use
+    # ('raw', 0) for rgb too when disk space allows
+    session_store = session_file.SessionStore(name="dev{}.micu".format(devN),
+                                              codecs={'rgb'  : ('png', depth_level),
+                                                      'depth': ('raw', 0)})
+
+
+def save_frames(frame, rgb, depth, dmap, p="../data/frames/", raw=None, stamp=0.0):
     """
     Saves the images to as lossless pngs and appends the frame number n
+    raw  := uint16 depth in mm, stored instead of dmap unless depth_storage='dmap'
+    stamp:= float, local time stamp (session container index)
     """
+    if session_store is not None:
+        session_store.save(p, frame, stamp, {'rgb': rgb, 'depth': raw})
+        return
     # save te images to the path
     print "Saving image {} to {}".format(frame, p)
     cv2.imwrite(p+'/rgb/'  +"rgb_"  + str(frame)+".png",rgb)
     cv2.imwrite(p+'/depth/'+"depth_"+ str(frame)+".png",depth)
-    cv2.imwrite(p+'/dmap/' +"dmap_"+ str(frame)+".png",dmap)
+    if raw_store is None or raw is None:
+        cv2.imwrite(p+'/dmap/' +"dmap_"+ str(frame)+".png",dmap)
+    else:
+        raw_store.save(p+'/dmap/', frame, raw)
     return
 # save_frames
 
 
+def save_preroll(frame, stamp, slot, p="../data/frames/preroll/"):
+    """
+    Saves one pre-roll (history) frame: rgb png and raw uint16 depth png.
+    The frame number and its local time stamp are appended to preroll.csv
+    """
+    cv2.imwrite(p+"rgb_"    +str(frame)+".png",slot.rgb)
+    depth_store.save_depth_png(p+"depth16_"+str(frame)+".png",slot.depth, depth_level)
+    with open(p+"preroll.csv", 'a') as fp:
+        fp.write("{},{}\n".format(frame, stamp))
+    return
+# save_preroll
+
+
 def talk2server(cmd='connect', devN=1):
     """
     Communicate with server 'if active'
@@ -261,17 +363,12 @@ def talk2server(cmd='connect', devN=1):
         cmd = str 'connect' ,'check' , 'sync' or 'close'
         devN = int 1, 2, ... n, (must be declared in server_threads.py)
     outputs:
-        server_reponse = str, server response
-        server_time = str, server timestamp
+        server_reponse = str, server response ('unknown' without server)
+        server_time = float, server timestamp (nan without server)
     usage:
     server_response, server_time = talk2server(cmd='connect',devN=1)
     """
-    try:
-        server_response, server_time = client.check_tcp_server(cmd=cmd,dev=devN).split("_")
-        server_response,server_time = clientConnectThread.get_command()        
-    except: # noserver response
-        server_time="na"
-        server_response="none"
+    server_response, server_time = client.parse_reply(client.check_tcp_server(cmd=cmd,dev=devN))
     # print "server reponse: {} and timestamp: {}".format(server_response, server_time)
     return server_response, server_time
     
@@ -314,13 +411,8 @@ def run_old_loop():
     clientConnectThread.setDaemon(True)
     clientConnectThread.start() #launching thread
     #time.sleep(1)    
-    server_time = 0.0
-    server_response="none"
-    response = clientConnectThread.get_command()
-    if "_" in response:
-        server_response,server_time  = response.split("_")
-    else: server_reponse = response
-    # print(server_response, server_time)
+    reply = clientConnectThread.get_message() # typed reply (wire_protocol.Message)
+    server_time = reply.stamp
     
     ## Create a pandas dataframe to hold the information (index starts at 1)
     cols = ["frameN","localtime","servertime"]
@@ -347,8 +439,8 @@ def run_old_loop():
     done     = False
     while not done: # view <= nviews
         ## RGB-D Streams
-        rgb   = get_rgb()
-        dmap, d4d = get_depth()
+        rgb, _ = get_rgb()
+        dmap, d4d, _ = get_depth()
 
         if vis_frames: # Display the streams
             rgbdm = np.hstack((rgb,d4d,dmap))
@@ -364,17 +456,15 @@ def run_old_loop():
                 done = True        
         #Poll the server:
         clientConnectThread.update_command("check")
-        sresponse = clientConnectThread.get_command()
-        if "_" in response:
-            server_response,server_time  = response.split("_")
-        else: server_reponse = response
+        reply = clientConnectThread.get_message()
+        server_time = reply.stamp
     
         run_time = time.time()-tic
         print "Processing {} session and frame number {}".format(vid_num,f)
         
         ## === check synchronization type
         if synctype =='strict':
-            if server_response == 'save':
+            if reply.type == wire.SAVE:
                 video_rgb.write(rgb)    # --> rgb vid file
                 video_depth.write(d4d)  # --> depth vid file
                 video_dmap.write(dmap)  # --> dmap vid file
@@ -479,13 +569,8 @@ def save_videos(folder4frames,c, vid_num, tic, nf=360):
     clientConnectThread.setDaemon(True)
     clientConnectThread.start() #launching thread
     #time.sleep(1)    
-    server_time = 0.0
-    server_response="none"
-    response = clientConnectThread.get_command()
-    if "_" in response:
-        server_response,server_time  = response.split("_")
-    else: server_reponse = response
-    # print(server_response, server_time)
+    reply = clientConnectThread.get_message() # typed reply (wire_protocol.Message)
+    server_time = reply.stamp
     
     ## Create a pandas dataframe to hold the information (index starts at 1)
     cols = ["frameN","localtime","servertime"]
@@ -503,8 +588,8 @@ def save_videos(folder4frames,c, vid_num, tic, nf=360):
     for f in range(nf):
         openni2.wait_for_any_stream()
         ## RGB-D Streams
-        rgb   = get_rgb()
-        dmap, d4d = get_depth()
+        rgb, _ = get_rgb()
+        dmap, d4d, _ = get_depth()
         #if vis_frames: # Display the streams
         rgbdm = np.hstack((rgb,d4d,dmap))
         rgbdm_small = cv2.resize(rgbdm,(960,240)) # smallest
@@ -529,10 +614,8 @@ def save_videos(folder4frames,c, vid_num, tic, nf=360):
 
         #Poll the server:
         clientConnectThread.update_command("check")
-        sresponse = clientConnectThread.get_command()
-        if "_" in response:
-            server_response,server_time  = response.split("_")
-        else: server_reponse = response
+        reply = clientConnectThread.get_message()
+        server_time = reply.stamp
     
         run_time = time.time()-tic
         print "\t Processing {} session and frame number {} -- {}".format(vid_num,f, (vid_num*nf) + f)
@@ -584,71 +667,166 @@ if __name__ == "__main__":
     vis_frames       = True  # True   # display frames
     save_frames_flag = False  # save all frames
     test_flag        = True
+    preview_fps      = 10    # display refresh rate, independent of capture
+    gap_report       = 300   # print the dropped device frames every n frames
+    scheduled_start  = True  # start/roll over at the coordinator's instants (coordinator.py)
+    start_timeout    = 600   # s, start anyway when no start is announced
+    udp_trigger      = True  # strict: also save on the coordinator's multicast trigger (frame_trigger.py)
+    report_every     = 1.0   # s, fps/queue/drops/disk to the coordinator metrics (device_metrics.py)
 
     test_frames  = 50000000
     num_sessions = 10000 #0000 #1000000
-    nf  = 3600 # 3600 at ~1fps := 1 hr clips |172800# 60*60*24*2 # Number of video frames in each videoclip
+    nf  = 3600 # frames per session without a scheduled start (else session_secs from the coordinator)
     c = 0      # global frame counter
+
+    ## Frame writers: png encoding runs off the capture loop
+    nwriters     = 2             # encoder/writer threads
+    queue_size   = 30            # max frames waiting to be written
+    queue_policy = 'drop_oldest' # or 'block' to never lose a frame
+
+    ## Pre-roll history (strict mode): last frames dumped when the server says save
+    history_mb   = 512           # memory budget for both history banks
     
     ## The folders for all data
     folder4frames,folder4csv=createActorFolder(actorname)
+    frame_queue = frame_pipeline.FrameQueue(maxsize=queue_size, policy=queue_policy)
+    writer_pool = frame_pipeline.FrameWriterPool(frame_queue, save_frames, nworkers=nwriters).start()
+    ## Preallocated frames: a slot is not reused while queued for the writers
+    ring = frame_ring.FrameRing(nslots=queue_size+nwriters+2,
+                                rgb   = ((h,w,3), np.uint8),
+                                depth = ((h,w),   np.uint16),
+                                dmap  = ((h,w,3), np.uint8),
+                                d4d   = ((h,w,3), np.uint8))
+    print "Frame ring: {} slots, {:.1f} MB".format(ring.nslots, ring.nbytes()/2.0**20)
+    ## Preview canvas: rgb || d4d || dmap at 1:2 scale each
+    preview = compositor.Compositor(3, tile_size=(w/2,h/2), captions=['rgb','depth','dmap'],
+                                    max_fps=preview_fps)
+    history = None
+    if synctype == 'strict':
+        history = frame_history.FrameHistory.from_budget(history_mb,
+                                rgb   = ((h,w,3), np.uint8),
+                                depth = ((h,w),   np.uint16))
+        # live frames are queued from the history slots
+        assert history.nframes >= ring.nslots, "history_mb too small for the writer queue"
+        print "Pre-roll history: {} frames, {:.1f} MB".format(history.nframes, history.nbytes()/2.0**20)
+    triggers = None
+    if synctype == 'strict' and udp_trigger: # one datagram for all devices, before the tcp answer
+        triggers = frame_trigger.TriggerListener().start()
 
     #print "Folder for frames: ", folder4frames
     ## TCP communication
-    ## Start the client thread:
-    clientConnectThread = client.ClientConnect("connect", "{}".format(devN))
+    ## Start the client thread: registers with the capabilities below (device_registry.py)
+    clientConnectThread = client.ClientConnect("connect", "{}".format(devN),
+                                 capabilities={'res': '{}x{}'.format(w,h), 'fps': 30,
+                                               'sync': synctype, 'storage': frame_storage})
     clientConnectThread.setDaemon(True)
     clientConnectThread.start() #launching thread
     #time.sleep(1)    
-    server_time = 0.0
-    server_response="none"
-    response = clientConnectThread.get_command()
-    if "_" in response:
-        server_response,server_time  = response.split("_")
-    else: server_reponse = response
-    # print(server_response, server_time)
+    reply = clientConnectThread.get_message() # typed reply (wire_protocol.Message)
+    t_start, session_secs = None, 0.0
+    if scheduled_start: # every device sleeps until the same server instant
+        t_start, session_secs = clientConnectThread.next_start(timeout=start_timeout)
+        if t_start is None:
+            print "No start announced, starting now"
+        else:
+            clientConnectThread.wait_until(t_start)
 
     tic = time.time()
+    t_report, c_report = tic, c
+    was_saving = False # strict: previous frame saved (pre-roll flushed on the edge)
     #start_t = tic
-    for session in range(0, num_sessions):
+    first = clientConnectThread.session_index(t_start, session_secs) # late join or restart
+    if first:
+        print "Joining the schedule at session {}".format(first)
+    ## Dropped/duplicated device frames (see frame_gaps.py): kept across sessions
+    ## so gaps at the boundary are seen and total_dropped only grows
+    rgb_gaps   = frame_gaps.GapDetector('rgb')
+    depth_gaps = frame_gaps.GapDetector('depth')
+    for session in range(first, num_sessions):
         folder4frames,folder4csv = createSessionFolders(folder4frames, session=session)
-        ## Create a pandas dataframe to hold the information (index starts at 1)
-        cols = ["frameN","localtime","servertime"]
-        df   = pd.DataFrame(columns=cols)
-        df.loc[c] =[0,server_time,time.time()]
-
-        for f in range(nf):
+        ## Per-frame time stamps: binary journal, fsynced in batches (see timestamp_journal.py)
+        journal = timestamp_journal.TimestampJournal(folder4csv+"dev"+str(devN)+'_times'+str(session)+'.tsj')
+        rgb_gaps.reset_counts()
+        depth_gaps.reset_counts()
+
+        # Scheduled: the session ends at the coordinator's rollover instant (nf is
+        # ignored, every device changes session together); otherwise after nf frames
+        scheduled = bool(t_start and session_secs)
+        for f in (itertools.count() if scheduled else range(nf)):
+            if scheduled and \
+               clientConnectThread.server_time()[0] >= t_start + (session+1)*session_secs:
+                break # session rollover announced by the coordinator
             run_time = time.time()-tic
             ## RGB-D Streams
-            rgb   = get_rgb()
-            dmap, d4d = get_depth()
-            #if vis_frames: # Display the streams
-            rgbdm = np.hstack((rgb,d4d,dmap))
-            rgbdm_small = cv2.resize(rgbdm,(960,240)) # smallest
-            cv2.imshow("1:4 scale", rgbdm_small)
-            ## === Keyboard Commands ===
-            key = cv2.waitKey(1) & 255
+            slot  = ring.next()
+            if history: # acquire straight into the history (no copy)
+                hslot = history.next()
+                rgb, rgb_info = get_rgb(hslot.rgb)
+                dmap, d4d, depth_info = get_depth(hslot.depth, slot.dmap, slot.d4d)
+                raw   = hslot.depth
+            else:
+                rgb, rgb_info = get_rgb(slot.rgb)
+                dmap, d4d, depth_info = get_depth(slot.depth, slot.dmap, slot.d4d)
+                raw   = slot.depth
+            rgb_gaps.update(*rgb_info)
+            depth_gaps.update(*depth_info)
+            if f % gap_report == gap_report-1:
+                print "\t{} | {}".format(rgb_gaps.summary(), depth_gaps.summary())
+            if time.time()-t_report >= report_every: # sent with the next heartbeat
+                clientConnectThread.report(fps=(c-c_report)/(time.time()-t_report), queue=frame_queue.depth(),
+                                           drops=frame_queue.dropped+rgb_gaps.total_dropped+depth_gaps.total_dropped,
+                                           disk=device_metrics.disk_free_gb(folder4frames))
+                t_report, c_report = time.time(), c
+            key = 255
+            if vis_frames and preview.due(): # Display the streams at preview_fps
+                cv2.imshow("1:4 scale", preview.compose((rgb,d4d,dmap))) # smallest
+                ## === Keyboard Commands ===
+                key = cv2.waitKey(1) & 255
             if key == 27:
                 print "\n\t ====> ESC detected. Terminating code!"
-                df.loc[c] =[f, run_time,server_time]
+                server_ts, server_err = clientConnectThread.server_time()
+                journal.append(f, server_ts,
+                               depth_info.timestamp, depth_info.index, rgb_info.timestamp, rgb_info.index,
+                               server_err=server_err)
                 ##saveframes
-                save_frames(f, rgb, d4d, dmap, p=folder4frames)
-                # Write data to csv
-                df.to_csv(folder4csv+"dev"+str(devN)+'_data'+str(session)+'.csv')
+                frame_queue.put((f, rgb, d4d, dmap, folder4frames, raw, run_time))
+                writer_pool.stop() # write the queued frames
+                if raw_store:
+                    raw_store.close()
+                if session_store:
+                    session_store.close() # finalizes the session index
+                if history:
+                    history.join()
+                # Write the buffered records
+                journal.close()
                 #done = True
                 sys.exit(0)
 
             #Poll the server:
             clientConnectThread.update_command("check")
-            sresponse = clientConnectThread.get_command()
-            if "_" in response:
-                server_response,server_time  = response.split("_")
-            else: server_reponse = response
-            df.loc[c] = [f, run_time,server_time]
+            reply = clientConnectThread.get_message()
+            server_ts, server_err = clientConnectThread.server_time()
+            journal.append(f, server_ts,
+                           depth_info.timestamp, depth_info.index, rgb_info.timestamp, rgb_info.index,
+                           server_err=server_err)
+            ##saveframes -- queued for the writer threads
+            if synctype == 'strict':
+                saving = reply.type == wire.SAVE or bool(triggers and triggers.pending())
+                if saving and not was_saving: # wait -> save: dump the pre-roll once, in the background
+                    history.flush(save_preroll, folder4frames+'/preroll/')
+                elif not saving: # frames queued below are not kept for the next pre-roll
+                    history.commit(hslot, c, run_time)
+                was_saving = saving
+                if saving:
+                    frame_queue.put((f, rgb, d4d, dmap, folder4frames, raw, run_time))
+            else:
+                frame_queue.put((f, rgb, d4d, dmap, folder4frames, raw, run_time))
             c +=1
-            ##saveframes
-            save_frames(f, rgb, d4d, dmap, p=folder4frames)          
-        df.to_csv(folder4csv+"dev"+str(devN)+'_data'+str(session)+'.csv')
+        journal.close()
+        print "Session {} writer stats: {}".format(session, writer_pool.stats())
+        print "Session {} device frames: {} | {}".format(session, rgb_gaps.summary(), depth_gaps.summary())
+        if triggers:
+            print "Session {} {}".format(session, triggers.summary())
 
         #print "Collecting and Saving Video Number: {}".format(vid_num)
         #c, run_time = save_videos(folder4frames, c, session, tic, nf=nf)
@@ -658,6 +836,16 @@ if __name__ == "__main__":
 
     # TERMINATE
     print "=== Terminating code. After recording {} Total Video Clips! ===".format(num_sessions)
+    print "==== Writing the queued frames"
+    writer_pool.stop()
+    if raw_store:
+        raw_store.close()
+    if session_store:
+        session_store.close()
+    print "\twriter stats: {}".format(writer_pool.stats())
+    if history:
+        history.join()
+        print "\tpre-roll frames saved: {}, triggers skipped: {}".format(history.flushed, history.skipped)
     # Close carmine context and stop device    
     print "==== Closing carmine context"    
     rgb_stream.stop()
@@ -1,4 +1,5 @@
 import client
+import wire_protocol as wire
 import time, sys
 
 done = False
@@ -9,17 +10,17 @@ if __name__=='__main__':
     clientConnectThread.start() #launching thread
     while not done: # view <= nviews
         clientConnectThread.update_command('check')
-        server_response = clientConnectThread.get_command()
-        if "save" in server_response:
+        reply = clientConnectThread.get_message()
+        if reply.type == wire.SAVE:
             print "RECEIVED FLAG TO SAVE DATA"
             time.sleep(5)            
-        elif "close"in server_response:
+        elif reply.type in (wire.CLOSED, wire.TERMINATE):
             print ('Closing the connection')
             clientConnectThread.update_command('close')
             time.sleep(5)
             done = True
         else:
             print "\t doing other stuff"        
-        print server_response
+        print clientConnectThread.get_command()
         time.sleep(2)
 sys.exit(1)
@@ -20,15 +20,25 @@ Current features:
     3) Displays the images: normal, medium, or small
         rgb and depth
 
-    4) Create a csv file via pandas
-        name: 'ICU_dev<#>.csv'
+    4) Per-frame time stamp journal per session (see timestamp_journal.py)
+        csv export is an offline step: python timestamp_journal.py <.tsj>
+        name: 'dev<#>_times<session>.tsj', includes the device frame stamps/indices
+        dropped device frames are reported per session (see frame_gaps.py)
+        frames are stamped in server time +- error bound (client.server_time(), clock_sync.py)
     
     5) Threaded tcp client and server
         devid: dev1, dev2, ..devN
-        Add/Remove access by removing/adding devs from server_threads.py
+        any number of devices: each registers (id + capabilities) and sends
+        heartbeats, see device_registry.py; no server edits to add one
         
-            client  commands: connect, check, close
-            servers response: save, wait
+            client  commands: connect, check, close, start
+            servers response: save, wait, start_<instant>_<session length>
+        scheduled_start: the recorders sleep until the start instant announced
+        by the coordinator (coordinator.py) and roll over at its session length
+        udp_trigger: in strict mode a multicast trigger from the coordinator
+        (frame_trigger.py) also saves the frame; missed triggers are counted
+        fps, drops and free disk go to the coordinator with the fps print
+        (live view: python device_metrics.py)
 
 test started at 22:50pm 17Aug2016
 
@@ -80,10 +90,18 @@ from primesense import _openni2 as c_api
 import cv2#, cv, 
 import time, csv
 import numpy as np
-import pandas as pd
 from time import localtime, strftime, gmtime
 import pickle
 import client
+import wire_protocol as wire
+import frame_ring
+import depth_codec
+import depth_display
+import compositor
+import frame_gaps
+import timestamp_journal
+import frame_trigger
+import device_metrics
 
 
 ## Drawing
@@ -166,43 +184,59 @@ else:
 
 
 
-def get_rgb():
+## Depth for display through a lookup table (see depth_display.py)
+colorizer = depth_display.DepthColorizer(near=0, far=2**12-1, colormap='gray')
+
+
+def get_rgb(rgb=None):
     """
-    Returns numpy 3L ndarray to represent the rgb image.
+    Returns numpy 3L ndarray to represent the rgb image and the device frame
+    metadata, frame_gaps.FrameInfo(index, timestamp).
+    Input:
+        rgb:= preallocated (h,w,3) uint8 ndarray to fill (e.g., a frame_ring
+              slot). A new array is allocated when None.
     """
-    bgr   = np.fromstring(rgb_stream.read_frame().get_buffer_as_uint8(),dtype=np.uint8).reshape(h,w,3)
-    rgb   = cv2.cvtColor(bgr,cv2.COLOR_BGR2RGB)
-    return rgb    
+    if rgb is None:
+        rgb = np.empty((h,w,3), dtype=np.uint8)
+    frame = rgb_stream.read_frame()
+    frame_ring.frame_to_array(frame.get_buffer_as_uint8(), rgb, swap_rb=True)
+    return rgb, frame_gaps.frame_info(frame)
 #get_rgb
 
 
-def get_depth():
+def get_depth(depth=None, dmap=None, d4d=None):
     """
     Returns numpy ndarrays representing the raw and ranged depth images.
+    Inputs (preallocated, e.g. frame_ring slots; allocated when None):
+        depth:= raw depth in mm, (h,w) uint16 ndarray
+        dmap := (h,w,3) uint8 ndarray
+        d4d  := (h,w,3) uint8 ndarray
     Outputs:
-        dmap:= distancemap in mm, 1L ndarray, dtype=uint16, min=0, max=2**12-1
+        dmap:= distancemap in mm packed losslessly (see depth_codec.py),
+               3L ndarray, dtype=uint8, B=low byte, G=high byte, R=0
         d4d := depth for dislay, 3L ndarray, dtype=uint8, min=0, max=255    
+        info:= frame_gaps.FrameInfo(index, timestamp) of the device frame
     Note1: 
-        fromstring is faster than asarray or frombuffer
+        the OpenNI buffer is copied once into depth; every conversion
+        writes into the given buffers
     Note2:     
         .reshape(120,160) #smaller image for faster response 
                 OMAP/ARM default video configuration
         .reshape(240,320) # Used to MATCH RGB Image (OMAP/ARM)
                 Requires .set_video_mode
     """
-    dmap = np.fromstring(depth_stream.read_frame().get_buffer_as_uint16(),dtype=np.uint16).reshape(h,w)  # Works & It's FAST
-    d4d  = dmap.astype(float) *255/ 2**12-1 # Correct the range. Depth images are 12bits
-    d4d  = cv2.cvtColor(np.uint8(d4d),cv2.COLOR_GRAY2RGB)
-    
-    temp1 = np.zeros(dmap.shape,dtype=np.uint8)
-    temp1 = dmap - 2**8 #most significant: 2**8-2**15
-
-    temp2 = dmap.copy() #least significant: 2**0-2**7
-    temp1[temp1<0]=0
-    temp2[temp2>255] = 0
-    dmap = np.uint8(np.dstack((temp2,temp1,temp2)))
-    #print dmap.shape, type(dmap), dmap.dtype
-    return dmap, d4d
+    if depth is None:
+        depth = np.empty((h,w), dtype=np.uint16)
+    if dmap is None:
+        dmap = np.empty((h,w,3), dtype=np.uint8)
+    if d4d is None:
+        d4d = np.empty((h,w,3), dtype=np.uint8)
+    depth_frame = depth_stream.read_frame()
+    frame_ring.frame_to_array(depth_frame.get_buffer_as_uint16(), depth)
+    colorizer.colorize(depth, out=d4d) # 12bit depth -> 3L uint8 (lut)
+    # lossless single pass packing: (low byte, high byte, 0)
+    depth_codec.encode_dmap(depth, out=dmap)
+    return dmap, d4d, frame_gaps.frame_info(depth_frame)
 #get_depth
 
 
@@ -283,17 +317,12 @@ def talk2server(cmd='connect', devN=1):
         cmd = str 'connect' ,'check' , 'sync' or 'close'
         devN = int 1, 2, ... n, (must be declared in server_threads.py)
     outputs:
-        server_reponse = str, server response
-        server_time = str, server timestamp
+        server_reponse = str, server response ('unknown' without server)
+        server_time = float, server timestamp (nan without server)
     usage:
     server_response, server_time = talk2server(cmd='connect',devN=1)
     """
-    try:
-        server_response, server_time = client.check_tcp_server(cmd=cmd,dev=devN).split("_")
-        server_response,server_time = clientConnectThread.get_command()        
-    except: # noserver response
-        server_time="na"
-        server_response="none"
+    server_response, server_time = client.parse_reply(client.check_tcp_server(cmd=cmd,dev=devN))
     # print "server reponse: {} and timestamp: {}".format(server_response, server_time)
     return server_response, server_time
     
@@ -309,6 +338,11 @@ if __name__ == "__main__":
 
     ## Flags
     vis_frames       = False  # True   # display frames
+    preview_fps      = 10     # display refresh rate, independent of capture
+    gap_report       = 300    # print the dropped device frames every n frames
+    scheduled_start  = True   # start/roll over at the coordinator's instants (coordinator.py)
+    start_timeout    = 600    # s, start anyway when no start is announced
+    udp_trigger      = True   # strict: also save on the coordinator's multicast trigger (frame_trigger.py)
     save_frames_flag = False  # save all frames
     test_flag        = True
 
@@ -316,7 +350,7 @@ if __name__ == "__main__":
     fps = 10
     c=0
     ## Runtime and Controls
-    nf  = 3600#172800# 60*60*24*2 # Number of video frames in each clip and video
+    nf  = 3600#172800# 60*60*24*2 # Number of video frames in each clip and video (unscheduled only)
     f   = 1  # frame counter
     tic = 0
     run_time   = 0
@@ -327,23 +361,23 @@ if __name__ == "__main__":
     done = False
 
     ## TCP communication
-    ## Start the client thread:
-    clientConnectThread = client.ClientConnect("connect", "{}".format(devN))
+    ## Start the client thread: registers with the capabilities below (device_registry.py)
+    clientConnectThread = client.ClientConnect("connect", "{}".format(devN),
+                                 capabilities={'res': '{}x{}'.format(w,h), 'fps': fps,
+                                               'sync': synctype, 'rgb_only': only_rgb})
     clientConnectThread.setDaemon(True)
     clientConnectThread.start() #launching thread
     #time.sleep(1)    
-    server_time = 0.0
-    server_response="none"
-    response = clientConnectThread.get_command()
-    if "_" in response:
-        server_response,server_time  = response.split("_")
-    else: server_reponse = response
-    # print(server_response, server_time)
+    reply = clientConnectThread.get_message() # typed reply (wire_protocol.Message)
+    t_start, session_secs = None, 0.0
+    if scheduled_start: # every device sleeps until the same server instant
+        t_start, session_secs = clientConnectThread.next_start(timeout=start_timeout)
+        if t_start is None:
+            print "No start announced, starting now"
+    triggers = None
+    if synctype == 'strict' and udp_trigger: # one datagram for all devices, before the tcp answer
+        triggers = frame_trigger.TriggerListener().start()
     
-    ## Create a pandas dataframe to hold the information (index starts at 1)
-    cols = ["frameN","localtime","servertime"]
-    df   = pd.DataFrame(columns=cols)
-    df.loc[c] =[0,time.time(),server_time] 
     
 
 
@@ -352,12 +386,29 @@ if __name__ == "__main__":
     folder4frames,folder4csv=createFolders(actorname)
     print "Creating Video Headers"
     ## Initialize the videowriter
-    vid_num=0
+    vid_num = clientConnectThread.session_index(t_start, session_secs) # late join or restart
+    if vid_num:
+        print "Joining the schedule at session {}".format(vid_num)
+    journal = timestamp_journal.TimestampJournal(folder4csv+"dev"+str(devN)+'_times'+'%03d'%vid_num+'.tsj')
+    ## Dropped/duplicated device frames (see frame_gaps.py)
+    rgb_gaps   = frame_gaps.GapDetector('rgb')
+    depth_gaps = frame_gaps.GapDetector('depth')
     video_rgb   = cv2.VideoWriter(folder4frames+"/rgb/dev"  +str(devN)+"rgb"  +'%03d'%vid_num+".avi",fourcc, fps=fps, frameSize=(w,h))
     if not only_rgb:
         video_depth = cv2.VideoWriter(folder4frames+"/depth/dev"+str(devN)+"depth"+'%03d'%vid_num+".avi",fourcc, fps=fps, frameSize=(w,h))
         video_dmap  = cv2.VideoWriter(folder4frames+"/dmap/dev" +str(devN)+"dmap" +'%03d'%vid_num+".avi",fourcc, fps=fps, frameSize=(w,h)) 
     print 'Video Writer creation done'
+    ## Preallocated frames (written synchronously, two slots are enough)
+    ring = frame_ring.FrameRing(nslots=2,
+                                rgb   = ((h,w,3), np.uint8),
+                                depth = ((h,w),   np.uint16),
+                                dmap  = ((h,w,3), np.uint8),
+                                d4d   = ((h,w,3), np.uint8))
+    ## Preview canvas: 1:2 scale tiles, rgb (|| d4d || dmap)
+    preview = compositor.Compositor(1 if only_rgb else 3, tile_size=(w/2,h/2),
+                                    max_fps=preview_fps)
+    if t_start: # sleep until the coordinator's start instant
+        clientConnectThread.wait_until(t_start)
     # Get the first timestamp
     tic = time.time()
     start_t = tic
@@ -368,22 +419,19 @@ if __name__ == "__main__":
     fps_t1 = time.time()
     while not done: # view <= nviews
         ## RGB-D Streams
-        rgb   = get_rgb()
+        slot  = ring.next()
+        rgb, rgb_info = get_rgb(slot.rgb)
+        rgb_gaps.update(*rgb_info)
+        depth_info = frame_gaps.FrameInfo(-1, 0)
         if not only_rgb:
-            dmap, d4d = get_depth()
+            dmap, d4d, depth_info = get_depth(slot.depth, slot.dmap, slot.d4d)
+            depth_gaps.update(*depth_info)
 
-        if vis_frames: # Display the streams
+        if vis_frames and preview.due(): # Display the streams at preview_fps
             if only_rgb:
-                rgbdm = np.hstack((rgb))
+                rgbdm_small = preview.compose((rgb,)) # smallest
             else:
-                rgbdm = np.hstack((rgb,d4d,dmap))
-            #rgbdm_small = rgbdm # orginal size
-            #rgbdm_small = cv2.resize(rgbdm,(1280,240)) # medium
-            #rgbdm_small = cv2.resize(rgbdm,(640,240)) # smallest
-            if only_rgb:
-                rgbdm_small = cv2.resize(rgbdm,(320,240)) # smallest
-            else:
-                rgbdm_small = cv2.resize(rgbdm,(960,240)) # smallest
+                rgbdm_small = preview.compose((rgb,d4d,dmap)) # smallest
 
             cv2.imshow("1:4 scale", rgbdm_small)
             ## === Keyboard Commands ===
@@ -393,22 +441,22 @@ if __name__ == "__main__":
                 done = True        
         #Poll the server:
         clientConnectThread.update_command("check")
-        response = clientConnectThread.get_command()
-        if "_" in response:
-            server_response,server_time  = response.split("_")
-        else: server_reponse = response
+        reply = clientConnectThread.get_message()
     
         run_time = time.time()-tic
         #print "Processing frame number {}".format(f)
         ## === check synchronization type
         if synctype =='strict':
-            if server_response == 'save':
+            if reply.type == wire.SAVE or (triggers and triggers.pending()):
                 video_rgb.write(rgb)    # --> rgb vid file
                 if not only_rgb:
                     video_depth.write(d4d)  # --> depth vid file
                     video_dmap.write(dmap)  # --> dmap vid file
                 # Write Datarows
-                df.loc[c] =[f,strftime("%a, %d %b %Y %H:%M:%S +0000", gmtime()), server_time]             
+                server_ts, server_err = clientConnectThread.server_time()
+                journal.append(f, server_ts,
+                               depth_info.timestamp, depth_info.index, rgb_info.timestamp, rgb_info.index,
+                               server_err=server_err)
                 f+=1
                 c+=1
         elif synctype == 'relaxed':            
@@ -418,7 +466,10 @@ if __name__ == "__main__":
                 video_dmap.write(dmap)  # --> dmap vid file
 
             # Write Datarows
-            df.loc[c] =[f, run_time,server_time]            
+            server_ts, server_err = clientConnectThread.server_time()
+            journal.append(f, server_ts,
+                           depth_info.timestamp, depth_info.index, rgb_info.timestamp, rgb_info.index,
+                           server_err=server_err)
             f+=1
             c+=1
         else:
@@ -429,22 +480,31 @@ if __name__ == "__main__":
             print "Terminating code!"
             done = True
             
-        if np.mod(f,nf) == 0: # close and create new csv and video
-            df.to_csv(folder4csv+"dev"+str(devN)+'_data'+'%03d'%vid_num+'.csv')
+        if t_start and session_secs: # scheduled: sessions end on the coordinator's instants (nf ignored)
+            rollover = clientConnectThread.server_time()[0] >= t_start + (vid_num+1)*session_secs
+        else:
+            rollover = np.mod(f,nf) == 0
+        if rollover: # close and create new csv and video
+            journal.close()
             # release video writers
             video_rgb.release()
             if not only_rgb:
                 video_depth.release()
                 video_dmap.release()
             print "session {} saved".format(vid_num)
+            print "\tdevice frames: {} | {}".format(rgb_gaps.summary(), depth_gaps.summary())
+            if triggers:
+                print "\t{}".format(triggers.summary())
+            rgb_gaps.reset_counts()
+            depth_gaps.reset_counts()
             vid_num+=1
             ## Create new video writers 
             video_rgb   = cv2.VideoWriter(folder4frames+"/rgb/dev"  +str(devN)+"rgb"  +'%03d'%vid_num+".avi",fourcc, fps=fps, frameSize=(w,h))
             if not only_rgb:
                 video_depth = cv2.VideoWriter(folder4frames+"/depth/dev"+str(devN)+"depth"+'%03d'%vid_num+".avi",fourcc, fps=fps, frameSize=(w,h))
                 video_dmap  = cv2.VideoWriter(folder4frames+"/dmap/dev" +str(devN)+"dmap" +'%03d'%vid_num+".avi",fourcc, fps=fps, frameSize=(w,h))    
-            # reset pandas dataframe
-            df = pd.DataFrame(columns=cols)
+            # next session journal
+            journal = timestamp_journal.TimestampJournal(folder4csv+"dev"+str(devN)+'_times'+'%03d'%vid_num+'.tsj')
             c=0
             ##done = True #stop after the first recording.
         if vid_num == 70:
@@ -458,6 +518,10 @@ if __name__ == "__main__":
             fps_calc = fps_fcount/(time.time()- fps_t1)
             fps_t1 = time.time()
             print 'FPS calculated : %.3f'%fps_calc 
+            clientConnectThread.report(fps=fps_calc, drops=rgb_gaps.total_dropped+depth_gaps.total_dropped,
+                                       disk=device_metrics.disk_free_gb(folder4frames))
+        if rgb_gaps.frames % gap_report == 0:
+            print "\t{} | {}".format(rgb_gaps.summary(), depth_gaps.summary())
     # while
    
     # TERMINATE
@@ -471,14 +535,16 @@ if __name__ == "__main__":
     openni2.unload()
     # write last datapoints
     print "==== Writing last portions of data."
-    vid_num=+1
-    df.loc[c] =[f, run_time,server_time]
+    server_ts, server_err = clientConnectThread.server_time()
+    journal.append(f, server_ts,
+                   depth_info.timestamp, depth_info.index, rgb_info.timestamp, rgb_info.index,
+                   server_err=server_err)
     video_rgb.write(rgb)    # write to vid file
     if not only_rgb:
         video_depth.write(d4d)  # write to vid file
         video_dmap.write(dmap)
-    # Write data to csv
-    df.to_csv(folder4csv+"dev"+str(devN)+'_data'+'%03d'%vid_num+'.csv')        
+    # Write the buffered records of the current session
+    journal.close()
     # release video writers
     print "==== Releasing the video writers"
     video_rgb.release()
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 18Oct2016
+
+device_metrics.py
+
+Live metrics of the recorders, aggregated by the coordinator. A recorder
+reports its numbers with its heartbeat ("<dev> metrics fps=29.8,queue=3,...",
+client.ClientConnect.report()); the coordinator keeps the last RING values
+of every field per device in fixed size ring buffers (no growth over weeks
+of recording) and serves them on a local HTTP port:
+    GET /metrics        text table (one line per device)
+    GET /metrics.json   the same numbers as json
+Fields (FIELDS):
+    fps   := capture frames per second
+    queue := frames waiting for the writer threads
+    drops := frames lost so far (writer queue + device gaps)
+    disk  := GB free on the recording disk
+    rtt   := ms, heartbeat round trip (percentiles + histogram, RTT_BINS)
+plus the heartbeat age of every live device (device_registry.py).
+
+usage:
+    store = MetricsStore()
+    store.report('dev2', parse_report("fps=29.8,rtt=0.4"), time.time())
+    print store.text(registry)
+
+CLI view of a running coordinator (refreshed every period s):
+    python device_metrics.py [http://localhost:50080/metrics] [period]
+    python device_metrics.py benchmark
+
+@author: carlos
+"""
+import os
+import json
+import time
+from collections import deque
+
+import device_registry
+
+FIELDS   = ('fps', 'queue', 'drops', 'disk', 'rtt')
+RING     = 300 # values kept per field and device (5 min at one report per second)
+RTT_BINS = (0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0) # ms, upper bin edges (+ overflow)
+URL      = "http://localhost:50080/metrics"
+
+
+def parse_report(text):
+    """
+    "fps=29.8,queue=3" -> {'fps': 29.8, 'queue': 3.0}; unknown fields and
+    bad numbers are skipped.
+    """
+    values = {}
+    for key, value in device_registry.parse_capabilities(text).iteritems():
+        if key in FIELDS:
+            try:
+                values[key] = float(value)
+            except ValueError:
+                pass
+    return values
+#parse_report
+
+
+def format_report(values):
+    return ",".join("{}={:.6g}".format(k, float(v)) for k, v in sorted(values.items()) if k in FIELDS)
+#format_report
+
+
+def disk_free_gb(path):
+    """
+    Free space (GB) of the disk holding path; nan where statvfs is missing.
+    """
+    try:
+        st = os.statvfs(path)
+    except (AttributeError, OSError):
+        return float('nan')
+    return st.f_bavail*st.f_frsize/1e9
+#disk_free_gb
+
+
+def percentile(values, q):
+    """
+    q-th quantile (0..1) of a list, nan if empty.
+    """
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[int(q*(len(values)-1))]
+#percentile
+
+
+def histogram(values, bins=RTT_BINS):
+    """
+    Counts per bin: values <= bins[0], <= bins[1], ..., > bins[-1].
+    """
+    counts = [0]*(len(bins)+1)
+    for v in values:
+        i = 0
+        while i < len(bins) and v > bins[i]:
+            i += 1
+        counts[i] += 1
+    return counts
+#histogram
+
+
+class DeviceMetrics(object):
+    """
+    Ring buffers of one device.
+    inputs:
+        size:= int, values kept per field
+    """
+    def __init__(self, name, size=RING):
+        self.name    = name
+        self.rings   = dict((f, deque(maxlen=size)) for f in FIELDS)
+        self.reports = 0
+        self.last    = 0.0 # time of the last report
+
+    def add(self, values, now):
+        for key, value in values.iteritems():
+            if key in self.rings:
+                self.rings[key].append(value)
+        self.reports += 1
+        self.last     = now
+    # add
+
+    def summary(self):
+        """
+        Per field: last, mean, min, max over the ring; rtt also p50, p99 and
+        the histogram.
+        """
+        out = {'reports': self.reports}
+        for key, ring in self.rings.iteritems():
+            if not ring:
+                continue
+            values = list(ring)
+            out[key] = {'last': values[-1], 'mean': sum(values)/len(values),
+                        'min': min(values), 'max': max(values)}
+        rtt = list(self.rings['rtt'])
+        if rtt:
+            out['rtt'].update({'p50': percentile(rtt, 0.5), 'p99': percentile(rtt, 0.99),
+                               'hist': histogram(rtt)})
+        return out
+    # summary
+#DeviceMetrics()
+
+
+class MetricsStore(object):
+    """
+    Metrics of every device that reported.
+    """
+    def __init__(self, size=RING):
+        self.size    = size
+        self.devices = {} # name -> DeviceMetrics
+
+    def report(self, name, values, now=None):
+        dev = self.devices.get(name)
+        if dev is None:
+            dev = self.devices[name] = DeviceMetrics(name, self.size)
+        dev.add(values, time.time() if now is None else now)
+    # report
+
+    def snapshot(self, registry=None, now=None, extra=None):
+        """
+        Dictionary of the summaries (json endpoint); registry adds the live
+        devices, their heartbeat age and capabilities.
+        """
+        now   = time.time() if now is None else now
+        names = set(self.devices)
+        live  = registry.live() if registry is not None else names
+        out   = {'time': now, 'devices': {}, 'bins_ms': list(RTT_BINS)}
+        if extra:
+            out.update(extra)
+        for name in names | live:
+            dev = self.devices.get(name)
+            row = dev.summary() if dev else {'reports': 0}
+            row['live'] = name in live
+            if registry is not None and name in registry:
+                row['heartbeat_age']  = now - registry.devices[name].last
+                row['capabilities'] = registry.capabilities(name)
+            if dev:
+                row['report_age'] = now - dev.last
+            out['devices'][name] = row
+        return out
+    # snapshot
+
+    def text(self, registry=None, now=None, extra=None):
+        """
+        Text table of snapshot().
+        """
+        snap  = self.snapshot(registry, now, extra)
+        fmt   = "{:8s} {:>5s} {:>7s} {:>11s} {:>7s} {:>7s} {:>15s}  {}"
+        num   = lambda row, key, stat, f="{:.1f}": f.format(row[key][stat]) if key in row else "-"
+        lines = [" ".join("{}={}".format(k, v) for k, v in sorted((extra or {}).items())),
+                 fmt.format("device", "live", "beat s", "fps now/avg", "queue", "drops", "rtt p50/p99 ms",
+                            "rtt histogram <=" + "/".join("{:g}".format(b) for b in RTT_BINS) + "/more")]
+        for name, row in sorted(snap['devices'].items(), key=lambda i: (len(i[0]), i[0])):
+            lines.append(fmt.format(
+                name, "yes" if row['live'] else "no",
+                "{:.1f}".format(row['heartbeat_age']) if 'heartbeat_age' in row else "-",
+                num(row, 'fps', 'last') + "/" + num(row, 'fps', 'mean'),
+                num(row, 'queue', 'last', "{:.0f}"),
+                num(row, 'drops', 'last', "{:.0f}"),
+                num(row, 'rtt', 'p50', "{:.2f}") + "/" + num(row, 'rtt', 'p99', "{:.2f}"),
+                " ".join(str(c) for c in row['rtt']['hist']) if 'rtt' in row else "") +
+                ("  disk {:.1f} GB".format(row['disk']['last']) if 'disk' in row else ""))
+        return "\n".join(lines) + "\n"
+    # text
+#MetricsStore()
+
+
+def http_response(path, store, registry=None, extra=None):
+    """
+    Full HTTP/1.0 response to a GET of path.
+    """
+    if path.startswith('/metrics.json'):
+        status, ctype = "200 OK", "application/json"
+        body = json.dumps(store.snapshot(registry, extra=extra), sort_keys=True)
+    elif path.startswith('/metrics') or path == '/':
+        status, ctype = "200 OK", "text/plain"
+        body = store.text(registry, extra=extra)
+    else:
+        status, ctype, body = "404 Not Found", "text/plain", "use /metrics or /metrics.json\n"
+    return "HTTP/1.0 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n{}".format(
+        status, ctype, len(body), body)
+#http_response
+
+
+if __name__ == "__main__":
+    import sys
+    import urllib2
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        # Coordinator, 20 devices sending 'metrics' heartbeats: request rate
+        # and endpoint latency with full rings
+        import socket
+        import threading
+        import coordinator
+        coord = coordinator.Coordinator(min_devices=20)
+        port  = coord.listen('localhost', 0)
+        http  = coord.listen_http('localhost', 0)
+        stop  = threading.Event()
+        loop  = threading.Thread(target=coord.serve, args=(stop.is_set,))
+        loop.start()
+        socks = [socket.create_connection(('localhost', port)) for d in range(20)]
+        tic   = time.time()
+        for i in range(RING):
+            for d, s in enumerate(socks):
+                s.sendall("{} metrics {}\n".format(d+1, format_report(
+                    {'fps': 29.9-d*0.1, 'queue': i % 7, 'drops': i//50, 'disk': 812.5,
+                     'rtt': 0.2+(i*d % 13)*0.1})))
+            for s in socks:
+                s.recv(1024)
+        n = RING*len(socks)
+        print "metrics requests: {:.0f}/s ({} devices)".format(n/(time.time()-tic), len(socks))
+        tic = time.time()
+        for i in range(20):
+            page = urllib2.urlopen("http://localhost:{}/metrics".format(http)).read()
+        print "GET /metrics: {:.2f} ms, 20 devices x {} values".format((time.time()-tic)/20*1e3, RING)
+        data = json.loads(urllib2.urlopen("http://localhost:{}/metrics.json".format(http)).read())
+        assert len(data['devices']) == 20 and data['devices']['dev3']['live']
+        assert data['devices']['dev3']['rtt']['hist'] and data['requests'] == n
+        stop.set()
+        loop.join()
+        print page
+        sys.exit(0)
+
+    url    = sys.argv[1] if len(sys.argv) > 1 else URL
+    period = float(sys.argv[2]) if len(sys.argv) > 2 else 2.0
+    while True:
+        try:
+            page = urllib2.urlopen(url, timeout=5).read()
+        except (urllib2.URLError, IOError) as e:
+            page = "{}: {}\n".format(url, e)
+        sys.stdout.write("\x1b[2J\x1b[H" + time.strftime("%H:%M:%S ") + page) # clear screen
+        sys.stdout.flush()
+        try:
+            time.sleep(period)
+        except KeyboardInterrupt:
+            break
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 17Oct2016
+
+device_registry.py
+
+Live set of recorders for the coordinator (coordinator.py) and the threaded
+server (server_threads.py), instead of the hard-coded dev_list, dev_dict and
+terminate_list. A device registers with its id and capabilities ("register"
+request, e.g. "5 register res=640x480,fps=30"), every request it sends is a
+heartbeat, and a device silent for more than timeout s is evicted. Old
+clients that never register are added on their first request.
+
+"All connected -> save" uses the live set: save when every live device is
+connected. Before the first start at least min_devices must be live, so the
+first devices up do not start recording alone; afterwards a dead camera is
+evicted and the others go on. allowed=None lets any device id in (no code
+edits to add the 21st camera); a list keeps the old closed set.
+
+usage:
+    registry = DeviceRegistry(min_devices=4)
+    registry.register('dev5', parse_capabilities('res=640x480,fps=30'), now)
+    registry.heartbeat('dev5', now)      # on every request
+    for dev in registry.evict(now): ...  # silent devices
+    registry.live()                      # set of device names
+
+@author: carlos
+"""
+import time
+
+TIMEOUT = 10.0 # s, a device without requests for this long is evicted
+
+
+def parse_capabilities(text):
+    """
+    "res=640x480,fps=30" -> {'res': '640x480', 'fps': '30'}
+    """
+    caps = {}
+    for item in text.replace(';', ',').split(','):
+        key, _, value = item.strip().partition('=')
+        if key:
+            caps[key] = value
+    return caps
+#parse_capabilities
+
+
+def format_capabilities(caps):
+    """
+    {'res': '640x480', 'fps': 30} -> "fps=30,res=640x480" (no spaces: one token
+    of the text protocol).
+    """
+    return ",".join("{}={}".format(k, str(v).replace(' ', '')) for k, v in sorted(caps.items()))
+#format_capabilities
+
+
+class Device(object):
+    """
+    One registered recorder.
+    """
+    def __init__(self, name, capabilities, now, address=None):
+        self.name         = name
+        self.capabilities = capabilities
+        self.address      = address
+        self.registered   = now
+        self.last         = now # last request (heartbeat)
+#Device()
+
+
+class DeviceRegistry(object):
+    """
+    Registered devices, their capabilities and heartbeats.
+    inputs:
+        allowed    := list of str, allowed device names (None: any device)
+        timeout    := float, seconds without a request before eviction
+        min_devices:= int, live devices needed for the first start
+    """
+    def __init__(self, allowed=None, timeout=TIMEOUT, min_devices=1):
+        self.allowed     = set(allowed) if allowed is not None else None
+        self.timeout     = timeout
+        self.min_devices = min_devices
+        self.devices     = {} # name -> Device
+        self.evicted     = 0
+
+    def allows(self, name):
+        return self.allowed is None or name in self.allowed
+    # allows
+
+    def register(self, name, capabilities=None, now=None, address=None):
+        """
+        Adds (or updates) a device; returns False if it is not allowed.
+        """
+        if not self.allows(name):
+            return False
+        now = time.time() if now is None else now
+        dev = self.devices.get(name)
+        if dev is None:
+            self.devices[name] = Device(name, capabilities or {}, now, address)
+            print "{} registered ({} live) {}".format(name, len(self.devices),
+                                                       format_capabilities(capabilities or {}))
+        else:
+            if capabilities is not None:
+                dev.capabilities = capabilities
+            dev.address = address or dev.address
+            dev.last    = now
+        return True
+    # register
+
+    def heartbeat(self, name, now=None, address=None):
+        """
+        Any request of a device; unknown (allowed) devices are registered
+        without capabilities. Returns False if the device is not allowed.
+        """
+        dev = self.devices.get(name)
+        if dev is None:
+            return self.register(name, None, now, address)
+        dev.last = time.time() if now is None else now
+        return True
+    # heartbeat
+
+    def evict(self, now=None):
+        """
+        Removes the devices silent for more than timeout; returns their names.
+        """
+        now  = time.time() if now is None else now
+        gone = [n for n, d in self.devices.iteritems() if now - d.last > self.timeout]
+        for name in gone:
+            print "{} evicted: no heartbeat for {:.1f} s".format(name, now - self.devices[name].last)
+            del self.devices[name]
+        self.evicted += len(gone)
+        return gone
+    # evict
+
+    def remove(self, name):
+        self.devices.pop(name, None)
+    # remove
+
+    def live(self):
+        return set(self.devices)
+    # live
+
+    def capabilities(self, name):
+        return self.devices[name].capabilities if name in self.devices else {}
+    # capabilities
+
+    def all_connected(self, connected, started=True):
+        """
+        True when every live device is in connected (and, before the first
+        start, at least min_devices are live).
+        """
+        live = self.live()
+        if not live or not live <= set(connected):
+            return False
+        return started or len(live) >= self.min_devices
+    # all_connected
+
+    def __contains__(self, name):
+        return name in self.devices
+
+    def __len__(self):
+        return len(self.devices)
+
+    def table(self, now=None):
+        """
+        One line per device: name, heartbeat age, capabilities.
+        """
+        now = time.time() if now is None else now
+        return ["{:8s} {:6.1f} s  {}".format(n, now - d.last, format_capabilities(d.capabilities))
+                for n, d in sorted(self.devices.items())]
+    # table
+#DeviceRegistry()
+
+
+if __name__ == "__main__":
+    import sys
+    reg = DeviceRegistry(min_devices=3, timeout=5.0)
+    t   = 1000.0
+    for d in range(1, 4):
+        reg.register('dev{}'.format(d), parse_capabilities('res=640x480,fps=30'), t+d)
+    assert not reg.all_connected(['dev1', 'dev2'], started=False)
+    assert reg.all_connected(['dev1', 'dev2', 'dev3'], started=False)
+    reg.heartbeat('dev4', t+4) # an old client: registered on its first request
+    assert reg.live() == set(['dev1', 'dev2', 'dev3', 'dev4']) and reg.capabilities('dev4') == {}
+    for d in (1, 2, 4):
+        reg.heartbeat('dev{}'.format(d), t+8)
+    assert reg.evict(t+9) == ['dev3']
+    assert reg.all_connected(['dev1', 'dev2', 'dev4']) # started: a dead camera does not stall
+    assert not DeviceRegistry(['dev1']).register('dev2')
+    print "\n".join(reg.table(t+9))
+
+    # Cost per request at ward scale
+    for n in (4, 20, 100):
+        reg = DeviceRegistry()
+        names = ['dev{}'.format(d) for d in range(n)]
+        for name in names: # (register() prints)
+            reg.devices[name] = Device(name, {'fps': 30}, time.time())
+        tic = time.time()
+        for i in range(100000):
+            reg.heartbeat(names[i % n], tic)
+        t_beat = (time.time()-tic)/100000
+        tic = time.time()
+        for i in range(1000):
+            reg.evict(tic)
+            reg.all_connected(names)
+        t_scan = (time.time()-tic)/1000
+        print "{:3d} devices: heartbeat {:.2f} us, evict+all_connected {:.1f} us".format(
+            n, t_beat*1e6, t_scan*1e6)
+    sys.exit(0)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 03Oct2016
+
+frame_gaps.py
+
+Device frame metadata and a dropped/duplicated frame detector.
+
+read_frame() returns an OpenNI VideoFrame whose device time stamp
+(timestamp, us) and frame counter (frameIndex) are the best signals for
+spotting lost frames and for aligning rgb to depth. frame_info() keeps
+both, and GapDetector checks every new frame against the previous one:
+    index step 1      := ok
+    index step n > 1  := drop, n-1 frames lost
+    same index/stamp  := duplicate
+    index goes back   := reset (stream restarted)
+When the driver leaves frameIndex at 0 the time stamp step is used
+instead (step / nominal period).
+
+usage:
+    gaps = GapDetector('depth', fps=30)
+    dmap, d4d, info = get_depth(...)
+    if gaps.update(info.index, info.timestamp) == 'drop': ...
+    print gaps.summary()
+    gaps.reset_counts()   # next session: per-session counts start over,
+                          # gaps.total_dropped and the last frame are kept
+
+@author: carlos
+"""
+from collections import namedtuple
+
+FrameInfo = namedtuple('FrameInfo', ['index', 'timestamp']) # frameIndex, device us
+
+
+def frame_info(frame):
+    """
+    FrameInfo of an OpenNI VideoFrame (index/timestamp -1 when missing).
+    """
+    return FrameInfo(int(getattr(frame, 'frameIndex', -1)), int(getattr(frame, 'timestamp', -1)))
+#frame_info
+
+
+class GapDetector(object):
+    """
+    Counts dropped, duplicated and reset device frames of one stream.
+    inputs:
+        name:= str, stream name used in the summary
+        fps := float, nominal frame rate (time stamp fallback)
+    """
+    def __init__(self, name='depth', fps=30):
+        self.name   = name
+        self.period = 1e6/fps # us
+        self.last   = None    # (index, timestamp)
+        self.total_dropped = 0 # dropped frames since the stream opened
+        self.reset_counts()
+
+    def reset_counts(self):
+        """
+        Starts the per-session counts over. The last frame and total_dropped
+        are kept, so a gap across the session boundary is still counted.
+        """
+        self.frames     = 0    # frames received
+        self.dropped    = 0    # device frames never received
+        self.duplicates = 0
+        self.resets     = 0
+        self.max_gap    = 0    # longest run of dropped frames
+    # reset_counts
+
+    def update(self, index, timestamp):
+        """
+        Checks one frame; returns 'first', 'ok', 'drop', 'duplicate' or 'reset'.
+        """
+        self.frames += 1
+        last = self.last
+        self.last = (index, timestamp)
+        if last is None:
+            return 'first'
+        if index > 0 or last[0] > 0:
+            step = index - last[0]
+        else: # no frame counter from the driver, use the time stamps
+            step = int(round((timestamp - last[1])/self.period))
+        if step == 1:
+            return 'ok'
+        if step > 1:
+            self.dropped += step - 1
+            self.total_dropped += step - 1
+            self.max_gap  = max(self.max_gap, step - 1)
+            return 'drop'
+        if step == 0 or timestamp == last[1]:
+            self.duplicates += 1
+            return 'duplicate'
+        self.resets += 1
+        return 'reset'
+    # update
+
+    def drop_rate(self):
+        """
+        Fraction of the device frames that were never received.
+        """
+        expected = self.frames - self.duplicates + self.dropped
+        return self.dropped/float(expected) if expected else 0.0
+    # drop_rate
+
+    def summary(self):
+        return "{}: {} frames, {} dropped ({:.2%}, longest gap {}), {} duplicated, {} resets".format(
+            self.name, self.frames, self.dropped, self.drop_rate(), self.max_gap,
+            self.duplicates, self.resets)
+    # summary
+#GapDetector()
+
+
+if __name__ == "__main__":
+    # Simulated stream: drops at 10 (x2) and 50, a duplicate at 30, a restart at 80
+    gaps  = GapDetector('sim', fps=30)
+    index = [i for i in range(100) if i not in (10, 11, 50)]
+    index.insert(index.index(30), 30)
+    index = index[:75] + list(range(0, 10))
+    events = [gaps.update(i, i*33333) for i in index]
+    assert (gaps.dropped, gaps.duplicates, gaps.resets, gaps.max_gap) == (3, 1, 1, 2), events
+    # no frame counter: time stamps only
+    stamps = GapDetector('stamps', fps=30)
+    for t in [0, 33333, 66666, 166666, 200000]:
+        stamps.update(0, t)
+    assert stamps.dropped == 2
+    # session boundary: a gap across it counts in the new session and the total
+    gaps.reset_counts()
+    for i in [11, 12]:
+        gaps.update(i, i*33333)
+    assert (gaps.dropped, gaps.total_dropped) == (1, 4), (gaps.dropped, gaps.total_dropped)
+    print gaps.summary()
+    print stamps.summary()
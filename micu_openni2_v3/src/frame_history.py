@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 08Sep2016
+
+frame_history.py
+
+Pre-trigger (pre-roll) history of the last N frames for strict sync mode.
+The capture loop acquires every frame directly into a history slot (see
+frame_ring.py), so inserting a frame into the history costs no copy. When
+the server answers "save" the history is flushed to disk by a background
+thread while live capture continues.
+
+Memory budget:
+    The history owns two banks of nframes slots each. On a trigger the
+    active bank is frozen and handed to the flush thread, and capture
+    switches to the other bank. A trigger that arrives while the other
+    bank is still being flushed is skipped (and counted), so memory never
+    grows beyond the two preallocated banks.
+
+usage:
+    history = FrameHistory.from_budget(budget_mb=256, rgb=((480,640,3), np.uint8),
+                                       depth=((480,640), np.uint16))
+    slot = history.next()
+    get_rgb(slot.rgb); get_depth(slot.depth, ...)
+    ...
+    if saving and not was_saving: # once, on the wait -> save edge
+        history.flush(save_preroll, folder4frames+'/preroll/')
+    elif not saving: # frames saved live are not kept for the next pre-roll
+        history.commit(slot, frame=c, stamp=run_time)
+
+@author: carlos
+"""
+import threading
+from collections import deque
+
+import frame_ring
+
+
+class FrameHistory(object):
+    """
+    Circular history of the last nframes frames held in preallocated slots.
+    inputs:
+        nframes   := int, frames kept in the history (per bank)
+        **buffers := name=(shape, dtype) for each buffer held by a slot
+    Counters:
+        flushed := int, frames written by the flush threads
+        skipped := int, triggers ignored because both banks were busy
+    """
+    def __init__(self, nframes, **buffers):
+        self.nframes = nframes
+        self.banks   = [frame_ring.FrameRing(nframes, **buffers),
+                        frame_ring.FrameRing(nframes, **buffers)]
+        self.entries = [deque(maxlen=nframes), deque(maxlen=nframes)]
+        self.busy    = [threading.Event(), threading.Event()]
+        self.active  = 0
+        self.lock    = threading.Lock()
+        self.threads = []
+        self.flushed = 0
+        self.skipped = 0
+
+    @classmethod
+    def from_budget(cls, budget_mb, **buffers):
+        """
+        Sizes the history so both banks fit in budget_mb megabytes.
+        """
+        import numpy as np
+        frame_bytes = sum(int(np.prod(shape))*np.dtype(dtype).itemsize
+                          for shape, dtype in buffers.values())
+        nframes = int(budget_mb*2**20 // (2*frame_bytes))
+        if nframes < 1:
+            raise ValueError("A budget of {} MB cannot hold one frame per bank".format(budget_mb))
+        return cls(nframes, **buffers)
+    # from_budget
+
+    def next(self):
+        """
+        Returns the slot to acquire the next frame into (overwrites the
+        oldest frame of the active bank, its entry is dropped). Frames that
+        are not committed leave no entry behind.
+        """
+        slot    = self.banks[self.active].next()
+        entries = self.entries[self.active]
+        if entries and entries[0][2] is slot:
+            entries.popleft()
+        return slot
+    # next
+
+    def commit(self, slot, frame, stamp):
+        """
+        Records that slot now holds frame number frame taken at time stamp.
+        """
+        self.entries[self.active].append((frame, stamp, slot))
+    # commit
+
+    def nbytes(self):
+        return sum(bank.nbytes() for bank in self.banks)
+
+    def flush(self, save, *args):
+        """
+        Freezes the active bank and writes its frames, oldest first, from a
+        background thread with save(frame, stamp, slot, *args).
+        Returns False (trigger skipped) if the other bank is still flushing.
+        """
+        with self.lock:
+            frozen = self.active
+            other  = 1 - frozen
+            if self.busy[other].is_set():
+                self.skipped += 1
+                return False
+            if not self.entries[frozen]:
+                return True
+            self.busy[frozen].set()
+            self.active = other
+        t = threading.Thread(target=self.run_flush, args=(frozen, save, args))
+        t.setDaemon(True)
+        t.start()
+        self.threads = [th for th in self.threads if th.is_alive()] + [t]
+        return True
+    # flush
+
+    def run_flush(self, bank, save, args):
+        entries = self.entries[bank]
+        try:
+            while entries:
+                frame, stamp, slot = entries.popleft()
+                try:
+                    save(frame, stamp, slot, *args)
+                    self.flushed += 1
+                except Exception as e:
+                    print "Pre-roll frame {} not saved: {}".format(frame, e)
+        finally:
+            entries.clear()
+            self.busy[bank].clear()
+    # run_flush
+
+    def join(self, timeout=None):
+        """
+        Waits for the running flushes to finish.
+        """
+        for t in self.threads:
+            t.join(timeout)
+        self.threads = []
+    # join
+#FrameHistory()
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 02Sep2016
+
+frame_pipeline.py
+
+Decouples frame capture from png encoding/disk writes.
+ - the capture loop only acquires frames and pushes them into a bounded
+   FrameQueue (cheap, never touches the disk)
+ - a FrameWriterPool of encoder/writer threads drains the queue and calls
+   the (slow) save function, e.g. devN_frames.save_frames
+
+Queue policies when the writers fall behind:
+    'block'       := capture waits until a slot is free (no frame is lost)
+    'drop_oldest' := the oldest queued frame is discarded (capture never waits)
+
+usage:
+    queue = FrameQueue(maxsize=30, policy='drop_oldest')
+    pool  = FrameWriterPool(queue, save_frames, nworkers=2)
+    pool.start()
+    ...
+    queue.put((f, rgb, d4d, dmap, folder4frames)) # args for save_frames
+    ...
+    pool.stop() # drains the queue and joins the writers
+    print queue.stats()
+
+@author: carlos
+"""
+import threading
+import time
+from collections import deque
+
+
+class FrameQueue(object):
+    """
+    Bounded, thread-safe FIFO of frames with an explicit overflow policy.
+    Counters:
+        put_count := int, frames offered by the capture loop
+        dropped   := int, frames discarded by the 'drop_oldest' policy
+        blocked   := int, times the capture loop waited on a full queue
+        max_depth := int, high-water mark of the queue depth
+    """
+    policies = ('block', 'drop_oldest')
+
+    def __init__(self, maxsize=30, policy='drop_oldest'):
+        if policy not in self.policies:
+            raise ValueError("Unknown queue policy {}. Use one of {}".format(policy, self.policies))
+        if maxsize < 1:
+            raise ValueError("maxsize must be >= 1")
+        self.maxsize   = maxsize
+        self.policy    = policy
+        self.items     = deque()
+        self.cond      = threading.Condition(threading.Lock())
+        self.closed    = False
+        self.put_count = 0
+        self.dropped   = 0
+        self.blocked   = 0
+        self.max_depth = 0
+
+    def put(self, item):
+        """
+        Adds item to the queue following the overflow policy.
+        Returns False if the queue has been closed, True otherwise.
+        """
+        with self.cond:
+            if self.closed:
+                return False
+            self.put_count += 1
+            if len(self.items) >= self.maxsize:
+                if self.policy == 'drop_oldest':
+                    self.items.popleft()
+                    self.dropped += 1
+                else: # block
+                    self.blocked += 1
+                    while len(self.items) >= self.maxsize and not self.closed:
+                        self.cond.wait()
+                    if self.closed:
+                        return False
+            self.items.append(item)
+            if len(self.items) > self.max_depth:
+                self.max_depth = len(self.items)
+            self.cond.notify_all()
+        return True
+    # put
+
+    def get(self, timeout=None):
+        """
+        Removes and returns the oldest item.
+        Returns None once the queue is closed and empty (or on timeout).
+        """
+        with self.cond:
+            if timeout is not None:
+                end = time.time() + timeout
+            while not self.items and not self.closed:
+                if timeout is None:
+                    self.cond.wait()
+                else:
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        return None
+                    self.cond.wait(remaining)
+            if not self.items:
+                return None
+            item = self.items.popleft()
+            self.cond.notify_all()
+        return item
+    # get
+
+    def close(self):
+        """
+        No more frames are accepted; writers finish what is already queued.
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+    # close
+
+    def depth(self):
+        """
+        Current number of queued frames.
+        """
+        return len(self.items)
+
+    def stats(self):
+        """
+        Returns a dictionary with the queue counters.
+        """
+        with self.cond:
+            return {'depth':     len(self.items),
+                    'max_depth': self.max_depth,
+                    'put':       self.put_count,
+                    'dropped':   self.dropped,
+                    'blocked':   self.blocked}
+    # stats
+#FrameQueue()
+
+
+class FrameWriterPool(object):
+    """
+    Pool of encoder/writer threads that drain a FrameQueue.
+    inputs:
+        queue    := FrameQueue, source of the frames
+        save     := callable, invoked as save(*item) for every queued item
+        nworkers := int, number of writer threads
+    """
+    def __init__(self, queue, save, nworkers=2):
+        self.queue    = queue
+        self.save     = save
+        self.nworkers = nworkers
+        self.threads  = []
+        self.lock     = threading.Lock()
+        self.written  = 0
+        self.errors   = 0
+
+    def start(self):
+        for n in range(self.nworkers):
+            t = threading.Thread(target=self.run, name="frame_writer{}".format(n))
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+        return self
+    # start
+
+    def run(self):
+        """
+        Worker loop: encode/write frames until the queue is closed and empty.
+        """
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self.save(*item)
+                with self.lock:
+                    self.written += 1
+            except Exception as e:
+                with self.lock:
+                    self.errors += 1
+                print "Frame writer error: {}".format(e)
+    # run
+
+    def stop(self, timeout=None):
+        """
+        Closes the queue, waits for the queued frames to be written and joins
+        the threads.
+        """
+        self.queue.close()
+        for t in self.threads:
+            t.join(timeout)
+        self.threads = []
+    # stop
+
+    def stats(self):
+        """
+        Returns the queue counters plus the writer counters.
+        """
+        stats = self.queue.stats()
+        with self.lock:
+            stats['written'] = self.written
+            stats['errors']  = self.errors
+        return stats
+    # stats
+#FrameWriterPool()
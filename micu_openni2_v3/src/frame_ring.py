@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 05Sep2016
+
+frame_ring.py
+
+Preallocated ring of frame buffers for the OpenNI capture loops.
+Each OpenNI frame buffer is copied exactly once into the next slot of the
+ring and every downstream conversion (rgb swap, d4d, dmap) writes into the
+same slot, so the capture loop allocates no full-frame arrays and memory
+stays flat over multi-day recordings.
+
+NOTE:
+    A slot is reused after nslots frames. When the slots are handed to the
+    frame writers (frame_pipeline.py) use
+        nslots >= queue_size + nwriters + 2
+    so a queued frame is never overwritten before it is saved.
+
+usage:
+    ring = FrameRing(nslots=4, rgb=((480,640,3), np.uint8), depth=((480,640), np.uint16))
+    slot = ring.next()
+    frame_to_array(rgb_stream.read_frame().get_buffer_as_uint8(), slot.rgb, swap_rb=True)
+
+@author: carlos
+"""
+import numpy as np
+
+
+class FrameSlot(object):
+    """
+    One ring entry. The buffers are attributes named after the FrameRing
+    keyword arguments, e.g. slot.rgb, slot.depth.
+    """
+    def __init__(self, index, buffers):
+        self.index = index
+        self.names = sorted(buffers.keys())
+        for name in self.names:
+            shape, dtype = buffers[name]
+            setattr(self, name, np.zeros(shape, dtype=dtype))
+    # __init__
+
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.names)
+#FrameSlot()
+
+
+class FrameRing(object):
+    """
+    Fixed ring of preallocated FrameSlots.
+    inputs:
+        nslots    := int, number of slots in the ring
+        **buffers := name=(shape, dtype) for each buffer held by a slot
+    """
+    def __init__(self, nslots=4, **buffers):
+        if nslots < 1:
+            raise ValueError("nslots must be >= 1")
+        self.nslots = nslots
+        self.slots  = [FrameSlot(i, buffers) for i in range(nslots)]
+        self.count  = 0 # slots handed out so far
+
+    def next(self):
+        """
+        Returns the next (oldest) slot of the ring.
+        """
+        slot = self.slots[self.count % self.nslots]
+        self.count += 1
+        return slot
+    # next
+
+    def nbytes(self):
+        """
+        Total memory held by the ring.
+        """
+        return sum(slot.nbytes() for slot in self.slots)
+#FrameRing()
+
+
+def frame_to_array(buf, out, swap_rb=False):
+    """
+    Copies an OpenNI frame buffer into the preallocated array out.
+    inputs:
+        buf     := ctypes array from VideoFrame.get_buffer_as_uint8/uint16
+        out     := ndarray, destination (its shape and dtype describe buf)
+        swap_rb := bool, reverse the channel order (bgr <-> rgb) in the
+                   same pass, replaces the cv2.cvtColor(BGR2RGB) copy
+    Note: frombuffer only wraps buf (no copy); copyto is the single copy.
+    """
+    src = np.frombuffer(buf, dtype=out.dtype, count=out.size).reshape(out.shape)
+    if swap_rb:
+        src = src[..., ::-1]
+    np.copyto(out, src)
+    return out
+#frame_to_array
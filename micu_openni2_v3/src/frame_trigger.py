@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 16Oct2016
+
+frame_trigger.py
+
+UDP multicast trigger channel for strict synchronization. In strict mode a
+recorder saves a frame when its TCP poll is answered "save": one round trip
+per device and per trigger, serialized by the server. Here the coordinator
+sends one datagram (wire_protocol TRIGGER: sequence number + server time)
+to a multicast group and every recorder listening on the group gets it at
+once, whatever the number of devices.
+
+UDP may lose a datagram: the listeners count the missed triggers from the
+gaps in the sequence numbers (repeat > 1 sends every trigger more than
+once, the copies are discarded). The TCP "save" answer is still there, a
+trigger only adds a faster path.
+
+Broadcast instead of multicast: group='<broadcast>' or a x.x.x.255 address.
+
+usage:
+    sender = TriggerSender()             # coordinator side
+    sender.send(time.time())
+    listener = TriggerListener().start() # recorder side (background thread)
+    if listener.pending(): ...           # new triggers since the last call
+    msg = listener.wait(timeout=1.0)     # or block until the next one
+
+benchmark (loopback, trigger latency vs. the coordinator TCP "save" path):
+    python frame_trigger.py
+
+@author: carlos
+"""
+import time
+import socket
+import select
+import threading
+
+import wire_protocol as wire
+
+GROUP = '239.255.0.7' # administratively scoped multicast
+PORT  = 50011
+IFACE = '0.0.0.0'     # interface address, '0.0.0.0' := default route
+TTL   = 1             # do not leave the local net
+
+
+def is_broadcast(group):
+    return group == '<broadcast>' or group.endswith('.255')
+#is_broadcast
+
+
+def listen_socket(group=GROUP, port=PORT, iface=IFACE):
+    """
+    UDP socket bound to port and joined to the multicast group (several
+    listeners on one computer may share the port).
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, 'SO_REUSEPORT'):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('', port))
+    if not is_broadcast(group):
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                        socket.inet_aton(group) + socket.inet_aton(iface))
+    return sock
+#listen_socket
+
+
+def decode(data):
+    """
+    Datagram -> (sequence, wire_protocol.Message); None if not a trigger.
+    """
+    try:
+        msgs = wire.Decoder().feed(data)
+    except wire.ProtocolError:
+        return None
+    if len(msgs) != 1 or msgs[0].type != wire.TRIGGER or len(msgs[0].payload) != wire.SEQUENCE.size:
+        return None
+    return wire.SEQUENCE.unpack(msgs[0].payload)[0], msgs[0]
+#decode
+
+
+class TriggerSender(object):
+    """
+    Coordinator side: numbered trigger datagrams to the group.
+    inputs:
+        group, port:= multicast (or broadcast) address
+        iface      := str, address of the sending interface
+        repeat     := int, copies of every trigger (against loss)
+    """
+    def __init__(self, group=GROUP, port=PORT, iface=IFACE, ttl=TTL, repeat=1):
+        self.address = (group, port)
+        self.repeat  = repeat
+        self.seq     = 0
+        self.sock    = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if is_broadcast(group):
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        else:
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1) # recorders on this computer
+            if iface != IFACE:
+                self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(iface))
+
+    def send(self, stamp=None):
+        """
+        Sends the next trigger; returns its sequence number.
+        """
+        self.seq += 1
+        data = wire.pack(wire.TRIGGER, 0, time.time() if stamp is None else stamp,
+                         wire.SEQUENCE.pack(self.seq))
+        for r in range(self.repeat):
+            try:
+                self.sock.sendto(data, self.address)
+            except socket.error as e: # no route yet: the listeners see the gap
+                print "trigger {} not sent: {}".format(self.seq, e)
+        return self.seq
+    # send
+
+    def close(self):
+        self.sock.close()
+    # close
+#TriggerSender()
+
+
+class TriggerListener(threading.Thread):
+    """
+    Recorder side: receives the triggers in a background thread.
+    inputs:
+        group, port:= multicast (or broadcast) address
+        iface      := str, address of the interface joined to the group
+    The last trigger is kept in self.last (wire_protocol.Message) and its
+    local arrival time in self.arrival.
+    """
+    def __init__(self, group=GROUP, port=PORT, iface=IFACE):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.sock       = listen_socket(group, port, iface)
+        self.done       = False
+        self.lock       = threading.Lock()
+        self.event      = threading.Event() # set on every new trigger
+        self.seq        = None
+        self.last       = None
+        self.arrival    = 0.0
+        self.new        = 0 # triggers not yet taken by pending()
+        self.received   = 0
+        self.missed     = 0
+        self.duplicates = 0
+        self.restarts   = 0
+
+    def start(self):
+        threading.Thread.start(self)
+        return self
+
+    def update(self, seq, msg, now):
+        """
+        Sequence bookkeeping of one trigger; False for a copy or a late one.
+        """
+        with self.lock:
+            if self.seq is not None and seq <= self.seq:
+                if seq == self.seq or msg.stamp <= self.last.stamp:
+                    self.duplicates += 1
+                    return False
+                self.restarts += 1 # the coordinator started over
+            elif self.seq is not None:
+                self.missed += seq - self.seq - 1
+            self.seq, self.last, self.arrival = seq, msg, now
+            self.received += 1
+            self.new      += 1
+            self.event.set()
+        return True
+    # update
+
+    def run(self):
+        while not self.done:
+            if not select.select([self.sock], [], [], 1.0)[0]: # lets stop() end the thread
+                continue
+            try:
+                data = self.sock.recv(2048)
+            except socket.error:
+                continue
+            now = time.time()
+            trigger = decode(data)
+            if trigger:
+                self.update(trigger[0], trigger[1], now)
+        self.sock.close()
+    # run
+
+    def pending(self):
+        """
+        Number of new triggers since the last call.
+        """
+        with self.lock:
+            n, self.new = self.new, 0
+        return n
+    # pending
+
+    def wait(self, timeout=None):
+        """
+        Blocks until a new trigger arrives; returns it (None on timeout).
+        """
+        end = None if timeout is None else time.time()+timeout
+        while not self.event.is_set():
+            left = 1.0 if end is None else min(1.0, end-time.time())
+            if left <= 0:
+                return None
+            self.event.wait(left) # interruptible (ctrl+c) in python2
+        with self.lock:
+            self.event.clear()
+            self.new = 0
+            return self.last
+    # wait
+
+    def stop(self):
+        self.done = True
+    # stop
+
+    def summary(self):
+        return "{} triggers received, {} missed, {} duplicates, {} restarts".format(
+            self.received, self.missed, self.duplicates, self.restarts)
+    # summary
+#TriggerListener()
+
+
+## --- benchmark ---------------------------------------------------------------
+def tcp_rounds(port, ndev, rounds):
+    """
+    Coordinator TCP path: devices 1..ndev-1 hold a "watch", device ndev
+    connects; latency from that connect to every watcher reading "save".
+    """
+    socks = [socket.create_connection(('localhost', port)) for d in range(ndev)]
+    for s in socks:
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    ask = lambda d, cmd: socks[d].sendall("{} {}\n".format(d+1, cmd))
+    def line(d):
+        data = ''
+        while not data.endswith('\n'):
+            data += socks[d].recv(1024)
+        return data
+    latency = []
+    for r in range(rounds):
+        for d in range(ndev-1):
+            ask(d, 'connect')
+            line(d)
+            ask(d, 'watch') # held until all devices are connected
+        time.sleep(0.002)
+        tic = time.time()
+        ask(ndev-1, 'connect')
+        waiting = dict((socks[d], d) for d in range(ndev-1))
+        got     = []
+        while waiting:
+            for s in select.select(waiting.keys(), [], [], 5.0)[0]:
+                now = time.time()
+                if s.recv(1024).startswith('save'):
+                    got.append(now-tic)
+                waiting.pop(s)
+        latency.append(max(got))
+        line(ndev-1)
+        ask(ndev-1, 'check') # last save: the coordinator is back to connecting
+        line(ndev-1)
+    for s in socks:
+        s.close()
+    return latency
+#tcp_rounds
+
+
+def udp_rounds(port, ndev, rounds):
+    """
+    Multicast path: one send, latency to the last of ndev listening sockets.
+    """
+    sender  = TriggerSender('239.255.0.7', port, iface='127.0.0.1')
+    socks   = [listen_socket('239.255.0.7', port, '127.0.0.1') for d in range(ndev)]
+    latency = []
+    for r in range(rounds):
+        time.sleep(0.002)
+        tic = time.time()
+        sender.send(tic)
+        waiting = set(socks)
+        got     = []
+        while waiting:
+            ready = select.select(list(waiting), [], [], 1.0)[0]
+            if not ready: # lost
+                break
+            for s in ready:
+                now = time.time()
+                s.recv(2048)
+                got.append(now-tic)
+                waiting.discard(s)
+        if not waiting:
+            latency.append(max(got))
+    sender.close()
+    for s in socks:
+        s.close()
+    return latency
+#udp_rounds
+
+
+if __name__ == "__main__":
+    import sys
+    import multiprocessing
+    import coordinator
+
+    def port_of(kind):
+        probe = socket.socket(socket.AF_INET, kind)
+        probe.bind(('localhost', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        return port
+
+    # Sequence gaps: the sender skips 3 triggers (lost), repeats one (copy)
+    port     = port_of(socket.SOCK_DGRAM)
+    listener = TriggerListener('239.255.0.7', port, '127.0.0.1').start()
+    sender   = TriggerSender('239.255.0.7', port, iface='127.0.0.1')
+    for i in range(10):
+        if i in (4, 5, 7):
+            sender.seq += 1 # "lost"
+            continue
+        sender.send()
+        assert listener.wait(1.0) is not None
+    sender.sock.sendto(wire.pack(wire.TRIGGER, 0, time.time(), wire.SEQUENCE.pack(sender.seq)), sender.address)
+    time.sleep(0.1)
+    assert (listener.received, listener.missed, listener.duplicates) == (7, 3, 1), listener.summary()
+    print "gap detection:", listener.summary()
+    listener.stop()
+    sender.close()
+
+    # Fan-out latency, loopback
+    rounds = 200
+    pct = lambda v, q: sorted(v)[int(q*(len(v)-1))]*1e3
+    for ndev in (4, 16, 64):
+        port = port_of(socket.SOCK_STREAM)
+        proc = multiprocessing.Process(target=coordinator.run_server, args=('coordinator', port, ndev))
+        proc.daemon = True
+        proc.start()
+        time.sleep(0.5)
+        tcp = tcp_rounds(port, ndev, rounds)
+        proc.terminate()
+        proc.join()
+        udp = udp_rounds(port_of(socket.SOCK_DGRAM), ndev, rounds)
+        print "{:3d} devices, last device triggered after (ms): tcp save median {:.3f} p99 {:.3f} | " \
+              "udp trigger median {:.3f} p99 {:.3f} ({} lost)".format(
+              ndev, pct(tcp, 0.5), pct(tcp, 0.99), pct(udp, 0.5), pct(udp, 0.99), rounds-len(udp))
+    sys.exit(0)
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 29Sep2016
+
+metadata_log.py
+
+Streaming per-frame metadata (csv) for the recorders. Replaces
+    df.loc[c] = [f, run_time, server_time]   # reallocates the DataFrame
+    df.to_csv(path)                          # once, at the end of a session
+with a constant cost per frame: rows are formatted into a small buffer and
+written every flush_rows rows or flush_secs seconds, so a crash loses at
+most one buffer instead of the whole session.
+
+The file has the same layout as DataFrame.to_csv (index column first), so
+    pd.read_csv(path, index_col=0)
+reads old and new session csv files alike.
+
+usage:
+    log = MetadataLog(folder4csv+'dev1_data0.csv', ["frameN","localtime","servertime"])
+    log.append(c, f, run_time, server_time)
+    ...
+    log.close()
+
+benchmark:
+    python metadata_log.py
+
+@author: carlos
+"""
+import os
+import time
+
+
+def format_value(value):
+    """
+    Full precision floats (repr), str() for anything else; quoted like
+    DataFrame.to_csv (csv.QUOTE_MINIMAL) when it holds a comma, a quote or
+    a line break, e.g. strftime("%a, %d %b %Y %H:%M:%S").
+    """
+    if isinstance(value, float):
+        return repr(value)
+    text = str(value)
+    if ',' in text or '"' in text or '\n' in text or '\r' in text:
+        return '"' + text.replace('"', '""') + '"'
+    return text
+#format_value
+
+
+class MetadataLog(object):
+    """
+    Buffered csv writer, one row per frame.
+    inputs:
+        path      := str, csv file (overwritten)
+        columns   := list of str, column names (the index column is unnamed)
+        flush_rows:= int, write the buffer every flush_rows rows
+        flush_secs:= float, ... or when the oldest buffered row is this old
+        fsync     := bool, also fsync on every flush (slower, survives power loss)
+    """
+    def __init__(self, path, columns, flush_rows=100, flush_secs=5.0, fsync=False):
+        self.path       = path
+        self.columns    = list(columns)
+        self.flush_rows = flush_rows
+        self.flush_secs = flush_secs
+        self.fsync      = fsync
+        self.fp         = open(path, 'w')
+        self.buffer     = [','+','.join(format_value(c) for c in self.columns)+'\n']
+        self.rows       = 0 # rows appended so far
+        self.last       = time.time()
+        self.flush()
+
+    def append(self, index, *values):
+        """
+        Appends one row: index followed by one value per column.
+        """
+        self.buffer.append(','.join([format_value(index)]+[format_value(v) for v in values])+'\n')
+        self.rows += 1
+        if len(self.buffer) >= self.flush_rows or time.time()-self.last >= self.flush_secs:
+            self.flush()
+    # append
+
+    def flush(self):
+        if self.buffer:
+            self.fp.write(''.join(self.buffer))
+            self.buffer = []
+        self.fp.flush()
+        if self.fsync:
+            os.fsync(self.fp.fileno())
+        self.last = time.time()
+    # flush
+
+    def close(self):
+        if self.fp is not None:
+            self.flush()
+            self.fp.close()
+            self.fp = None
+    # close
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+#MetadataLog()
+
+
+if __name__ == "__main__":
+    # Benchmark against the pandas DataFrame appends used by the recorders
+    import tempfile
+    import pandas as pd
+    cols   = ["frameN","localtime","servertime"]
+    folder = tempfile.mkdtemp()
+    for n in [360, 3600]:
+        tic = time.time()
+        df  = pd.DataFrame(columns=cols)
+        for c in range(n):
+            df.loc[c] = [c, time.time(), '12:00:00']
+        df.to_csv(os.path.join(folder, 'df.csv'))
+        t_df = time.time() - tic
+
+        tic = time.time()
+        log = MetadataLog(os.path.join(folder, 'log.csv'), cols)
+        for c in range(n):
+            log.append(c, c, time.time(), '12:00:00')
+        log.close()
+        t_log = time.time() - tic
+        print "{} rows: DataFrame {:.1f} us/row, MetadataLog {:.1f} us/row, speedup x{:.0f}".format(
+            n, t_df/n*1e6, t_log/n*1e6, t_df/t_log)
+
+    back = pd.read_csv(os.path.join(folder, 'log.csv'), index_col=0)
+    assert list(back.columns) == cols and len(back) == 3600 and back.index[-1] == 3599
+    stamp = time.strftime("%a, %d %b %Y %H:%M:%S +0000")
+    with MetadataLog(os.path.join(folder, 'quoted.csv'), cols) as log:
+        log.append(0, 0, 1.5, stamp)
+    back = pd.read_csv(os.path.join(folder, 'quoted.csv'), index_col=0)
+    assert list(back.columns) == cols and back['servertime'][0] == stamp
+    print "pandas read_csv round trip OK"
@@ -7,6 +7,7 @@ Created on Nov 6, 2013
 import cv2
 import numpy as np
 import os
+import session_file
 
 def get_nat_list(path, name="file", ext = ".txt"):
     """ 
@@ -35,9 +36,10 @@ def get_nat_list(path, name="file", ext = ".txt"):
 
 def gen_video(p_src, p_dst, vidname='test', imtype="rgb_", fps=10, text=False):
     """
-    Generates a .avi video file using the images in the path folder.
+    Generates a .avi video file using the images in the path folder or in a
+    session container file (session_file.py).
     inputs:
-        p_src:= str, path to images/frames folder
+        p_src:= str, path to images/frames folder or to a .micu session file
         p_dst:= str, path to folder where avi will be stored
         imtype:= str, one of 2 types {rgb, depth}
         fps:= int, video speed in frames per second
@@ -49,10 +51,14 @@ def gen_video(p_src, p_dst, vidname='test', imtype="rgb_", fps=10, text=False):
     green  = (0,255,0)
     winName = 'Input With frame Number'
     
-    # use the narturalsorted images to generated video:
-    paths,idxs = get_nat_list(p_src, name=imtype, ext='.png' )
-    
-    im = cv2.imread(paths[0])
+    if session_file.is_session(p_src):
+        frames = session_file.iter_display(p_src, modality=imtype.strip('_'), stop=2850)
+    else:
+        # use the narturalsorted images to generated video:
+        paths,idxs = get_nat_list(p_src, name=imtype, ext='.png' )
+        frames = ((p.split('/')[-1].split('.')[0].split('_')[1], cv2.imread(p)) for p in paths)
+    frames = iter(frames)
+    idx, im = next(frames)
     w, h, l = im.shape
     
     # object that contains the properties of the avi
@@ -69,16 +75,18 @@ def gen_video(p_src, p_dst, vidname='test', imtype="rgb_", fps=10, text=False):
 ##    video = cv2.VideoWriter(vidname+".avi",
 ##        fourcc=cv2.cv.CV_FOURCC('M','J','P','G'), fps=fps, frameSize=(h,w))
 
-    for p in paths[:2850]:
-#        print p 
-        n, idx = p.split('/')[-1].split('.')[0].split('_')
+    for n in range(2850):
+        if n > 0:
+            try:
+                idx, im = next(frames)
+            except StopIteration:
+                break
         #print "frame: {}, idx: {}".format(n,idx)
-        im = cv2.imread(p)
         im4display = im.copy()
 
         # Captions and circle
         if text:
-            cv2.putText(im4display,"frame_"+idx,(20,220), cv2.FONT_HERSHEY_PLAIN, 1.5, green,
+            cv2.putText(im4display,"frame_"+str(idx),(20,220), cv2.FONT_HERSHEY_PLAIN, 1.5, green,
                         thickness=1, lineType=cv2.CV_AA)
         # if_text
         # Display images
@@ -31,6 +31,7 @@ import numpy as np
 import cv2
 from primesense import openni2#, nite2
 from primesense import _openni2 as c_api
+import depth_display
 
 
 ## Path of the OpenNI redistribution OpenNI2.so or OpenNI2.dll
@@ -92,6 +93,10 @@ ir_stream.start()
 
 ##help(dev.set_image_registration_mode)
 
+## Depth for display through a lookup table, reused output buffer
+colorizer  = depth_display.DepthColorizer(colormap='gray')
+d4d_buffer = np.zeros((h,w,3), dtype=np.uint8)
+
 
 def get_rgb():
     """
@@ -120,9 +125,7 @@ def get_depth():
                 Requires .set_video_mode
     """
     dmap = np.fromstring(depth_stream.read_frame().get_buffer_as_uint16(),dtype=np.uint16).reshape(h,w)  # Works & It's FAST
-    d4d = np.uint8(dmap.astype(float) *255/ 2**12-1) # Correct the range. Depth images are 12bits
-    #d4d = 255 - cv2.cvtColor(d4d,cv2.COLOR_GRAY2RGB)
-    d4d = np.dstack((d4d,d4d,d4d)) #faster than cv2 conversion
+    d4d = colorizer.colorize(dmap, out=d4d_buffer) # 12bit depth -> 3L uint8 (lut)
     return dmap, d4d
 #get_depth
 
@@ -31,6 +31,8 @@ import numpy as np
 import cv2
 from primesense import openni2#, nite2
 from primesense import _openni2 as c_api
+import frame_ring
+import depth_display
 
 
 ## Path of the OpenNI redistribution OpenNI2.so or OpenNI2.dll
@@ -83,35 +85,41 @@ dev.set_image_registration_mode(openni2.IMAGE_REGISTRATION_DEPTH_TO_COLOR)
 ##help(dev.set_image_registration_mode)
 
 
-def get_rgb():
+## Preallocated frames and scratch buffers (display only, one slot)
+ring = frame_ring.FrameRing(nslots=1,
+                            rgb   = ((240,320,3), np.uint8),
+                            depth = ((240,320),   np.uint16),
+                            d4d   = ((240,320,3), np.uint8))
+colorizer = depth_display.DepthColorizer(colormap='gray_inv') # near=white
+
+
+def get_rgb(rgb):
     """
-    Returns numpy 3L ndarray to represent the rgb image.
+    Fills the preallocated numpy 3L ndarray rgb with the rgb image.
     """
-    bgr   = np.fromstring(rgb_stream.read_frame().get_buffer_as_uint8(),dtype=np.uint8).reshape(240,320,3)
-    rgb   = cv2.cvtColor(bgr,cv2.COLOR_BGR2RGB)
+    frame_ring.frame_to_array(rgb_stream.read_frame().get_buffer_as_uint8(), rgb, swap_rb=True)
     return rgb    
 #get_rgb
 
 
 
 
-def get_depth():
+def get_depth(dmap, d4d):
     """
-    Returns numpy ndarrays representing the raw and ranged depth images.
+    Fills the preallocated ndarrays with the raw and ranged depth images.
     Outputs:
         dmap:= distancemap in mm, 1L ndarray, dtype=uint16, min=0, max=2**12-1
         d4d := depth for dislay, 3L ndarray, dtype=uint8, min=0, max=255    
     Note1: 
-        fromstring is faster than asarray or frombuffer
+        the OpenNI buffer is copied once into dmap; d4d is computed in place
     Note2:     
         .reshape(120,160) #smaller image for faster response 
                 OMAP/ARM default video configuration
         .reshape(240,320) # Used to MATCH RGB Image (OMAP/ARM)
                 Requires .set_video_mode
     """
-    dmap = np.fromstring(depth_stream.read_frame().get_buffer_as_uint16(),dtype=np.uint16).reshape(240,320)  # Works & It's FAST
-    d4d = np.uint8(dmap.astype(float) *255/ 2**12-1) # Correct the range. Depth images are 12bits
-    d4d = 255 - cv2.cvtColor(d4d,cv2.COLOR_GRAY2RGB)
+    frame_ring.frame_to_array(depth_stream.read_frame().get_buffer_as_uint16(), dmap)
+    colorizer.colorize(dmap, out=d4d) # Correct the range. Depth images are 12bits
     return dmap, d4d
 #get_depth
 
@@ -138,11 +146,12 @@ done = False
 while not done:
 
     ## Streams
+    slot = ring.next()
     #RGB
-    rgb = get_rgb()
+    rgb = get_rgb(slot.rgb)
     
     #DEPTH
-    dmap,d4d = get_depth()
+    dmap,d4d = get_depth(slot.depth, slot.d4d)
     
     # Overlay rgb over the depth stream
     rgbd  = mask_rgbd(d4d,rgb, th=100)
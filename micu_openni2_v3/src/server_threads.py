@@ -14,12 +14,33 @@ python server_threads.py
 
 NOTE:
     Try changin the list structures for sets - to speed up the process
+
+Persistent connections (see client.ClientConnect): a connection may carry
+any number of newline terminated requests, every reply ends with a newline.
+"watch" is a "check" that the server holds (at most HOLD seconds) until the
+state changes, so 'save'/'terminate' are pushed to the waiting clients.
+"start" is held the same way until all devices are connected, then answered
+"start_<instant>_<session length>": the instant is LEAD s after the first
+all connected (client.ClientConnect.next_start, same reply as coordinator.py).
+Each connection has its own handler thread; the shared state is guarded by
+lock.
+
+Devices are not listed here any more (device_registry.py): a device registers
+itself ("<devid> register res=640x480,fps=30") or on its first request, every
+request is a heartbeat, and a device silent for registry.timeout s is
+evicted. Save when every live device is connected (MIN_DEVICES live before
+the first save). Any device may use any of PORTS.
     
 @author: carlos
 """
 import SocketServer
 import threading
+import signal
+import socket
+import select
+import os
 import time, sys
+import device_registry
 from time import strftime, localtime
 
 devs = []
@@ -29,22 +50,85 @@ disc = False # flag to disconnect
 done = False # flag to terminate
 save = False # flag to save
 
-# Add/Remove devices to/from dev_list
-dev_list = ['dev1', 'dev2', 'dev3', 'dev4'] # Allowed devices
+started = False # first save done (MIN_DEVICES no longer needed)
+start_at = None # scheduled start (server time), set when started
 
-terminate_list= dev_list[:]
+# Devices register at run time; DEVICES limits them (None: any device id)
+DEVICES     = None # e.g. ['dev1', 'dev2', 'dev3', 'dev4']
+MIN_DEVICES = 4    # live devices needed before the first save
+registry    = device_registry.DeviceRegistry(DEVICES, min_devices=MIN_DEVICES)
+PORTS       = [50007, 50008, 50009, 50010] # one server thread each, shared state
+
+terminate_list= set() # live devices not yet told to terminate
 terminate = False # termiantion flag
+finished  = threading.Event() # set when the last device closed (or on a signal)
 
+HOLD     = 0.5   # s, longest wait of a "watch" request
+IDLE     = 120.0 # s, a silent connection is closed
+LEAD     = 0.5    # s, from the first all connected to the scheduled start
+SESSION_SECS = 3600.0 # s, announced session length (0: no rollover)
+lock     = threading.RLock() # guards the state above
+watchers = set() # wake-up pipes of the held "watch" requests
 
-dev_dict = {'dev1':{'PORT':50007},
-            'dev2':{'PORT':50008},
-            'dev3':{'PORT':50009},
-            'dev4':{'PORT':50010}
-            }
 
-roll = {}
-for d in dev_list:
-    roll[d] = 'n'
+def notify():
+    """
+    Wakes the held "watch" requests up (state changed).
+    """
+    for w in list(watchers):
+        try:
+            os.write(w, 'x')
+        except OSError:
+            pass
+#notify
+
+
+def update_state():
+    """
+    Connecting/saving flags from the live set of devices (call under lock).
+    """
+    global conc, disc, save, started, start_at
+    if registry.all_connected(devs, started):
+        if not save:
+            print "All CONNECTED: {}".format(sorted(devs))
+        if start_at is None:
+            start_at = time.time() + LEAD
+        conc = False # done connecting all devs
+        disc = True  # allows to disconnect
+        save = True
+        started = True
+    elif len(devs)==0:
+        if save:
+            print "All DISCONNECTED"
+        conc = True   # can begin connecting devices
+        disc = False  # done disconnecting all devices
+        save = False
+#update_state
+
+
+def evict(now=None):
+    """
+    Drops the devices without heartbeat; wakes the held "watch" requests up
+    when the state changed. Returns the evicted devices.
+    """
+    global done
+    with lock:
+        gone = registry.evict(now)
+        if not gone:
+            return gone
+        state = (save, terminate, done)
+        for dev in gone:
+            if dev in devs:
+                devs.remove(dev)
+            terminate_list.discard(dev)
+        if terminate and len(terminate_list) == 0:
+            done = True
+            finished.set()
+        update_state()
+        if (save, terminate, done) != state:
+            notify()
+    return gone
+#evict
 
 
     
@@ -56,36 +140,98 @@ class MyTCPHandler(SocketServer.BaseRequestHandler):
     override the handle() method to implement communication to the
     client.
     
-    Add new devices to dev_list
+    Devices register themselves (see device_registry.py)
     
     """
     def handle(self):
+        """
+        Serves the requests of one connection until the client closes it.
+        """
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.request.settimeout(IDLE)
+        wake_r, wake_w = os.pipe()
+        buf = ''
+        try:
+            while True:
+                while '\n' not in buf:
+                    data = self.request.recv(1024)
+                    if not data:
+                        if buf.strip(): # old clients without a newline
+                            self.request.sendall(self.reply(buf)+'\n')
+                        return
+                    buf += data
+                line, buf = buf.split('\n', 1)
+                if not line.strip():
+                    continue
+                watch = line.split()[-1].lower() in ('watch', 'start')
+                with lock:
+                    watchers.add(wake_w)
+                    msg = self.reply(line)
+                if watch and msg.startswith('wait') and not buf:
+                    # hold until the state changes or the client sends again
+                    ready = select.select([self.request, wake_r], [], [], HOLD)[0]
+                    with lock:
+                        watchers.discard(wake_w)
+                        if wake_r in ready:
+                            os.read(wake_r, 1024)
+                        msg = self.reply(line)
+                with lock:
+                    watchers.discard(wake_w)
+                self.request.sendall(msg+'\n')
+        except (socket.timeout, socket.error):
+            pass
+        finally:
+            with lock:
+                watchers.discard(wake_w)
+            os.close(wake_r)
+            os.close(wake_w)
+    # handle
+
+    def reply(self, line):
+        """
+        Answers one request "<devid> <cmd>"; "watch" is answered as "check".
+        """
         global done, roll, conc, disc, terminate, devs, save
+        with lock:
+            state = (save, terminate)
+            msg   = self.answer(line)
+            if (save, terminate) != state:
+                notify()
+        return msg
+    # reply
+
+    def answer(self, line):
+        global done, roll, conc, disc, terminate, devs, save, terminate_list
         
         # self.request is the TCP socket connected to the client
-        self.data  = self.request.recv(1024).strip().split(" ")
+        self.data  = line.strip().split(" ")
+        if len(self.data) < 2:
+            return "unknown="+strftime("%a, %d %b %Y %H:%M:%S +0000", localtime())
         self.devid = self.data[0]
         self.cmd   = self.data[1]
+        if self.cmd.lower() == "watch":
+            self.cmd = "check"
         self.msg   = ""
         self.tic   = time.time() # server time tic
-        self.time  = strftime("%a, %d %b %Y %H:%M:%S +0000", localtime())
-
 
         dev = "dev{}".format(self.devid)
 
-#        print " ====== SERVER -- RUNNING ====== "
-        print "{} wrote:".format(self.client_address[0])
-        print "\t", self.data
-        print "\t at local time {}".format(self.tic) 
-
-        # Check device is on the list of allowed devices:
-        if dev in dev_list:
-            print "Device {} recognized." .format(dev)
+        # No printing per request (it limits the request rate): state changes only.
+        # Every request is a heartbeat (unknown devices are registered if allowed):
+        if self.cmd.lower() == "register": # with its capabilities "register res=640x480,fps=30"
+            caps  = device_registry.parse_capabilities(" ".join(self.data[2:]))
+            known = registry.register(dev, caps, self.tic, self.client_address[0])
+        else:
+            known = registry.heartbeat(dev, self.tic, self.client_address[0])
+        if known:
             if not terminate:
                 
+                # --- Registered above
+                if self.cmd.lower() == "register":
+                    self.msg = "dev{} registered_{}".format(self.devid, self.tic)
+
                 # --- Connect the device <dev1#> "connect" command
-                if conc and self.cmd.lower() == "connect":
-                    print "\tAttempting to {} {}".format(self.cmd, dev)
+                elif conc and self.cmd.lower() == "connect":
                     if dev in devs:
                         self.msg = "dev{} ready_{}".format(self.devid, self.tic)
                     else:
@@ -93,9 +239,17 @@ class MyTCPHandler(SocketServer.BaseRequestHandler):
                         self.msg = "dev{} connected_{}".format(self.devid, self.tic)
                    
                 # --- Get server time stamp: laxed synchronization
-                elif self.cmd.lower() =="sync": # get server time stamp
+                elif self.cmd.lower() in ("sync", "heartbeat", "metrics"): # get server time stamp
+                        # (metrics are aggregated by coordinator.py only)
                         self.msg = "sync_{}".format(self.tic)                                    
             
+                # --- Scheduled start: held (like "watch") until all devices are connected
+                elif self.cmd.lower() == "start":
+                    if start_at is None:
+                        self.msg = "wait_{}".format(self.tic)
+                    else:
+                        self.msg = "start_{!r}_{!r}".format(start_at, SESSION_SECS)
+
                 # --- Strict synchronization: "check" server has registered all dev
                 elif self.cmd.lower() == "check":
                     if (save) and (dev in devs):
@@ -110,47 +264,49 @@ class MyTCPHandler(SocketServer.BaseRequestHandler):
                 # --- Allow the clients to request termination using "close"
                 elif self.cmd.lower() == "close":
                     print "Terminating all threads"
-                    terminate_list.remove(dev)
+                    terminate_list = registry.live() - set([dev])
                     self.msg = "close_{}".format(self.tic)                     
-                    done = True
                     terminate = True
+                    if len(terminate_list) == 0:
+                        done = True
+                        finished.set()
                 
                 
                 else: # unknown command
-                    print "Unknown command {}. Use connect, check, or close".format(self.cmd)                
+                    print "Unknown command {}. Use register, connect, check, start, or close".format(self.cmd)                
             
-            else: # terminate
-                if dev in devs:
+            else: # terminate: every device is told once, the last one ends the server
+                if dev in terminate_list:
                     terminate_list.remove(dev)
                     self.msg = "terminate"
                 if len(terminate_list) ==0:
                     done = True
+                    finished.set()
 
             
-        else: # dev not in list
+        else: # dev not in DEVICES
             print "Unknown device {}. Please check devid try again!".format(dev)
             self.msg = "dev{} -Not recognized by the server!!".format(self.devid)
 
 
-        print "The registered devices are {}".format(devs)
-        
-        if len(devs) == len(dev_list): #roll.values().count('y') == len(dev_list):
-            conc = False # done connecting all devs
-            disc = True  # allows to disconnect
-            save = True
-            print "All CONNECTED"
-        elif len(devs)==0: # roll.values().count('y') == 0:
-            conc = True   # can begin connecting devices
-            disc = False  # done disconnecting all devices
-            save = False
-            print "All DISCONNECTED"
+        update_state()
     
         #print 'msg: ', self.msg
-        self.request.sendall(self.msg.lower()+'='+ strftime("%a, %d %b %Y %H:%M:%S +0000", localtime()))
+        return self.msg.lower()+'='+ strftime("%a, %d %b %Y %H:%M:%S +0000", localtime())
         # print'Devices ready: ', devs
+    # answer
 #MyTCPHandler()
 
 
+class CoordinatorServer(SocketServer.ThreadingTCPServer):
+    """
+    One thread per connection: persistent clients do not block the port.
+    """
+    daemon_threads      = True
+    allow_reuse_address = True
+#CoordinatorServer()
+
+
 
 class ServerThread(threading.Thread):
     #HOST = "localhost"
@@ -159,7 +315,7 @@ class ServerThread(threading.Thread):
     def __init__(self,serverid='dev1', HOST=HOST, PORT=50007):      
         print 'serving %s'%serverid
         threading.Thread.__init__(self)
-        self.server = SocketServer.TCPServer((HOST, PORT), MyTCPHandler)
+        self.server = CoordinatorServer((HOST, PORT), MyTCPHandler)
         
     def run(self):
         self.server.serve_forever()
@@ -179,16 +335,24 @@ if __name__ == "__main__":
 
 #    dev_list1 = ['dev1']
     server_thread_list=[]
-    for d in dev_dict:
-        server_thread = ServerThread(d, HOST=HOST, PORT=dev_dict[d]['PORT'])
+    for port in PORTS:
+        server_thread = ServerThread('port {}'.format(port), HOST=HOST, PORT=port)
         #server_thread.daemon = True
         server_thread.start()
         server_thread_list.append(server_thread)
     
-    try:
-        while not done: pass
-        raise KeyboardInterrupt
-    except KeyboardInterrupt:
-        for s in server_thread_list:
-            s.server.shutdown()
-        sys.exit(0)
+    # Block (no busy wait) until the last device closes or ctrl+c / kill.
+    # python2 cannot interrupt Event.wait() without a timeout, hence the 1 s wait
+    def stop(signum, frame):
+        print "Signal {}: shutting down".format(signum)
+        finished.set()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    while not finished.wait(1.0):
+        evict() # devices without heartbeat
+    for s in server_thread_list:
+        s.server.shutdown()     # serve_forever() returns
+        s.server.server_close()
+        s.join()
+    print "All devices closed"
+    sys.exit(0)
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 05Oct2016
+
+session_catalog.py
+
+SQLite catalog of the recorded data, i.e., the folders made by
+createActorFolder/createSessionFolders:
+    <root>/icudata<devN>/<patient>/session_<n>/{rgb,depth,dmap,csv,preroll}
+                                              dev<N>.micu   (session_file.py)
+Tables:
+    devices  (id, name)                           dev1, dev2, ...
+    sessions (id, device_id, patient, session, path, storage, signature,
+              nframes, t_start, t_end)
+    frames   (session_id, device_id, frame, t, server_t)
+Frame times come from the session time stamp journal (csv/*.tsj), or from
+the older per-frame csv files (csv/dev<N>_data<n>.csv).
+
+Indexing is incremental: a session is re-read only when its signature (size
+and mtime of its csv files and container) changed. Sessions are read by a
+pool of worker processes; the catalog itself has a single writer.
+
+usage:
+    catalog = SessionCatalog('icudata.db')
+    catalog.update(['/home/carlos/Documents/Python/MICU/micu_openni2_v3/'], workers=4)
+    for row in catalog.frames('dev2', t0, t1): print row  # (dev, patient, session, frame, t, location)
+
+    python session_catalog.py <db> update <root> [<root> ...]
+    python session_catalog.py <db> query <devN> <t0> <t1>
+    python session_catalog.py                # benchmark on a synthetic tree
+
+@author: carlos
+"""
+import os
+import re
+import csv
+import sqlite3
+import multiprocessing
+
+import timestamp_journal
+
+SESSION_RE = re.compile(r'icudata(\d+)/([^/]+)/session_(\d+)$')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices  (id INTEGER PRIMARY KEY, name TEXT UNIQUE);
+CREATE TABLE IF NOT EXISTS sessions (id INTEGER PRIMARY KEY, device_id INTEGER,
+                                     patient TEXT, session INTEGER, path TEXT UNIQUE,
+                                     storage TEXT, signature TEXT, nframes INTEGER,
+                                     t_start REAL, t_end REAL);
+CREATE TABLE IF NOT EXISTS frames   (session_id INTEGER, device_id INTEGER,
+                                     frame INTEGER, t REAL, server_t REAL);
+CREATE INDEX IF NOT EXISTS frames_device_t ON frames (device_id, t);
+CREATE INDEX IF NOT EXISTS frames_session  ON frames (session_id, frame);
+CREATE INDEX IF NOT EXISTS sessions_device ON sessions (device_id, t_start, t_end);
+"""
+
+
+def find_sessions(roots):
+    """
+    Yields (devN, patient, session, path) for every session folder under
+    roots; the walk does not descend into the session folders.
+    """
+    for root in roots:
+        for path, dirs, files in os.walk(root):
+            m = SESSION_RE.search(path.replace(os.sep, '/'))
+            if m:
+                del dirs[:] # do not list rgb/ depth/ ...
+                yield int(m.group(1)), m.group(2), int(m.group(3)), path
+#find_sessions
+
+
+def session_files(path):
+    """
+    The files that describe a session: csv/ (journals, csv) and containers.
+    """
+    files = [os.path.join(path, f) for f in os.listdir(path) if f.endswith('.micu')]
+    csvdir = os.path.join(path, 'csv')
+    if os.path.isdir(csvdir):
+        files += [os.path.join(csvdir, f) for f in os.listdir(csvdir)
+                  if f.endswith('.tsj') or f.endswith('.csv')]
+    return sorted(files)
+#session_files
+
+
+def signature(files):
+    return ';'.join("{}:{}:{}".format(os.path.basename(f), os.path.getsize(f), int(os.path.getmtime(f)))
+                    for f in files)
+
+
+def read_csv_times(path):
+    """
+    (frame, t, server_t) rows of an older per-frame csv:
+        ,frameN,localtime,servertime
+    localtime is the run time (or a date string), so the server time stamp
+    is used as t unless localtime is an absolute time.
+    """
+    rows = []
+    with open(path) as fp:
+        reader = csv.reader(fp)
+        next(reader, None)
+        for r in reader:
+            if len(r) < 4:
+                continue
+            try:
+                frame = int(float(r[1]))
+            except ValueError:
+                continue
+            server_t = timestamp_journal.parse_server_time(r[3])
+            try:
+                local = float(r[2])
+            except ValueError:
+                local = float('nan')
+            t = local if local > 1e9 else server_t
+            rows.append((frame, t, server_t))
+    return rows
+#read_csv_times
+
+
+def scan_session(item):
+    """
+    Worker: reads the frame times of one session.
+    input:
+        (devN, patient, session, path, signature)
+    output:
+        (devN, patient, session, path, signature, storage, rows)
+        rows:= list of (frame, t, server_t)
+    """
+    devN, patient, session, path, sig = item
+    files    = session_files(path)
+    journals = [f for f in files if f.endswith('.tsj')]
+    csvs     = [f for f in files if f.endswith('.csv')]
+    rows     = []
+    if journals:
+        for j in journals:
+            data = timestamp_journal.read_journal(j)
+            rows.extend(zip(data['frame'].tolist(), (data['wall_ns']*1e-9).tolist(),
+                            data['server_ts'].tolist()))
+    else:
+        for c in csvs:
+            rows.extend(read_csv_times(c))
+    storage = 'session' if any(f.endswith('.micu') for f in files) else 'pngs'
+    # sqlite stores nan as NULL
+    rows = [(f, None if t != t else t, None if s != s else s) for f, t, s in rows]
+    return devN, patient, session, path, sig, storage, rows
+#scan_session
+
+
+def frame_location(path, storage, devN, frame):
+    """
+    Where a frame is stored: the session container or the rgb png.
+    """
+    if storage == 'session':
+        return os.path.join(path, "dev{}.micu".format(devN))
+    return os.path.join(path, 'rgb', "rgb_{}.png".format(frame))
+#frame_location
+
+
+class SessionCatalog(object):
+    """
+    SQLite catalog of devices, patients, sessions and frame times.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.db      = sqlite3.connect(db_path)
+        self.db.executescript(SCHEMA)
+
+    def device_id(self, name):
+        self.db.execute("INSERT OR IGNORE INTO devices (name) VALUES (?)", (name,))
+        return self.db.execute("SELECT id FROM devices WHERE name = ?", (name,)).fetchone()[0]
+    # device_id
+
+    def update(self, roots, workers=4):
+        """
+        Scans roots and (re)indexes new or changed sessions; sessions whose
+        folder is gone are removed.
+        output:
+            (indexed, unchanged, removed) session counts
+        """
+        known = dict(self.db.execute("SELECT path, signature FROM sessions"))
+        todo, seen = [], set()
+        for devN, patient, session, path in find_sessions(roots):
+            seen.add(path)
+            sig = signature(session_files(path))
+            if known.get(path) != sig:
+                todo.append((devN, patient, session, path, sig))
+        gone = [p for p in known if p not in seen and any(p.startswith(r) for r in roots)]
+        if workers > 1 and len(todo) > 1:
+            pool    = multiprocessing.Pool(workers)
+            results = pool.imap_unordered(scan_session, todo)
+        else:
+            pool    = None
+            results = (scan_session(item) for item in todo)
+        with self.db: # one transaction
+            for path in gone:
+                self.remove(path)
+            for devN, patient, session, path, sig, storage, rows in results:
+                self.remove(path)
+                dev_id = self.device_id("dev{}".format(devN))
+                times  = [t for f, t, s in rows if t is not None]
+                cur = self.db.execute(
+                    "INSERT INTO sessions (device_id, patient, session, path, storage, signature,"
+                    " nframes, t_start, t_end) VALUES (?,?,?,?,?,?,?,?,?)",
+                    (dev_id, patient, session, path, storage, sig, len(rows),
+                     min(times) if times else None, max(times) if times else None))
+                sid = cur.lastrowid
+                self.db.executemany("INSERT INTO frames VALUES (?,?,?,?,?)",
+                                    ((sid, dev_id, f, t, s) for f, t, s in rows))
+        if pool:
+            pool.close()
+            pool.join()
+        return len(todo), len(seen)-len(todo), len(gone)
+    # update
+
+    def remove(self, path):
+        row = self.db.execute("SELECT id FROM sessions WHERE path = ?", (path,)).fetchone()
+        if row:
+            self.db.execute("DELETE FROM frames WHERE session_id = ?", row)
+            self.db.execute("DELETE FROM sessions WHERE id = ?", row)
+    # remove
+
+    def frames(self, device, t0, t1):
+        """
+        Frames of device ('dev2' or 2) with t0 <= t < t1, in time order.
+        output:
+            list of (device, patient, session, frame, t, location)
+        """
+        name = device if isinstance(device, str) else "dev{}".format(device)
+        devN = int(name[3:])
+        rows = self.db.execute(
+            "SELECT s.patient, s.session, s.path, s.storage, f.frame, f.t"
+            " FROM frames f JOIN sessions s ON s.id = f.session_id"
+            " WHERE f.device_id = (SELECT id FROM devices WHERE name = ?)"
+            " AND f.t >= ? AND f.t < ? ORDER BY f.t", (name, t0, t1))
+        return [(name, patient, session, frame, t, frame_location(path, storage, devN, frame))
+                for patient, session, path, storage, frame, t in rows]
+    # frames
+
+    def sessions(self, device=None):
+        """
+        (device, patient, session, path, nframes, t_start, t_end) rows.
+        """
+        q = ("SELECT d.name, s.patient, s.session, s.path, s.nframes, s.t_start, s.t_end"
+             " FROM sessions s JOIN devices d ON d.id = s.device_id")
+        if device is None:
+            return self.db.execute(q+" ORDER BY d.name, s.t_start").fetchall()
+        name = device if isinstance(device, str) else "dev{}".format(device)
+        return self.db.execute(q+" WHERE d.name = ? ORDER BY s.t_start", (name,)).fetchall()
+    # sessions
+
+    def close(self):
+        self.db.close()
+#SessionCatalog()
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    if len(sys.argv) > 2 and sys.argv[2] == 'update':
+        catalog = SessionCatalog(sys.argv[1])
+        tic = time.time()
+        print "indexed {}, unchanged {}, removed {} sessions".format(*catalog.update(sys.argv[3:]))
+        print "in {:.1f} s".format(time.time()-tic)
+        sys.exit(0)
+    if len(sys.argv) > 2 and sys.argv[2] == 'query':
+        catalog = SessionCatalog(sys.argv[1])
+        for row in catalog.frames(sys.argv[3], float(sys.argv[4]), float(sys.argv[5])):
+            print ",".join(str(x) for x in row)
+        sys.exit(0)
+
+    # Benchmark: synthetic tree, 4 devices x 2 patients x 10 sessions x 3600 frames
+    import shutil
+    import tempfile
+    root  = tempfile.mkdtemp()
+    start = 1475000000.0
+    for dev in range(1, 5):
+        for p in range(2):
+            for s in range(10):
+                folder = os.path.join(root, "icudata{}".format(dev), "patient_{}".format(p),
+                                      "session_{}".format(s), 'csv')
+                os.makedirs(folder)
+                t0 = start + (p*10+s)*3600
+                with timestamp_journal.TimestampJournal(os.path.join(folder, "dev{}_times{}.tsj".format(dev, s)),
+                                                        sync_every=3600) as journal:
+                    for f in range(3600):
+                        journal.append(f, t0+f, wall_ns=int((t0+f)*1e9))
+    db  = os.path.join(root, 'catalog.db')
+    catalog = SessionCatalog(db)
+    tic = time.time()
+    res = catalog.update([root], workers=4)
+    t_full = time.time()-tic
+    tic = time.time()
+    res2 = catalog.update([root], workers=4)
+    t_incr = time.time()-tic
+    tic = time.time()
+    rows = catalog.frames('dev2', start+5*3600+100, start+5*3600+700)
+    t_query = time.time()-tic
+    assert res == (80, 0, 0) and res2 == (0, 80, 0) and len(rows) == 600, (res, res2, len(rows))
+    print "{} frames: full index {:.1f} s, incremental rescan {:.2f} s, 600 frame query {:.1f} ms".format(
+        80*3600, t_full, t_incr, t_query*1e3)
+    catalog.close()
+    shutil.rmtree(root)
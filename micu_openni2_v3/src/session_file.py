@@ -0,0 +1,713 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 26Sep2016
+
+session_file.py
+
+Single-file session container (.micu). Replaces the three per-frame pngs
+in rgb/, depth/ and dmap/ with one append-only file per session.
+
+Layout (little endian):
+    file header   64 bytes   magic, version, flags (finalized), record
+                             alignment, creation time, index offset/count
+    records       each record starts on a multiple of align bytes (fixed
+                  size chunks) and is a 64 byte record header followed by
+                  the payload:
+                      magic, modality, codec, dtype, frame, timestamp,
+                      height, width, channels, payload length, crc32
+    frame index   written by close(): one INDEX_DTYPE entry per record
+                  (frame, modality, codec, shape, timestamp, payload
+                  offset/length, crc32)
+    footer        32 bytes   magic, index offset, index count, index crc32
+
+Crash safety:
+    Records are self describing and checksummed. close() writes the index
+    and footer, fsyncs, and only then flags the header as finalized. A file
+    that was not finalized (power loss, kill -9) is still readable: the
+    reader rebuilds the index by scanning the records and stops at the first
+    truncated or corrupt one. SessionWriter(path, mode='a') does the same,
+    truncates the partial tail and keeps appending.
+
+Codecs: 'raw' (uncompressed), 'zlib' (level 0-9), 'png' (level 0-9)
+Modalities: rgb, depth (raw uint16 mm), dmap, d4d, mask, skel
+
+usage:
+    writer = SessionWriter(folder4frames+'/dev1_session0.micu')
+    writer.append(f, 'rgb',   rgb,   stamp=run_time, codec='png')
+    writer.append(f, 'depth', depth, stamp=run_time, codec='raw')
+    writer.close()
+
+    reader = SessionReader(folder4frames+'/dev1_session0.micu')
+    for frame, stamp, rgb in reader.iter_frames('rgb'): ...
+    depth  = reader['depth'][250000]   # mmap lookup, see SessionStream
+
+    for frame, d4d in iter_display(path, 'depth'): video.write(d4d)
+
+@author: carlos
+"""
+import os
+import mmap
+import struct
+import threading
+import time
+import zlib
+import numpy as np
+import cv2
+
+import depth_codec
+import depth_display
+
+VERSION      = 1
+FILE_MAGIC   = 'MICUSES\0'
+RECORD_MAGIC = 'FRM1'
+FOOTER_MAGIC = 'MICUIDX\0'
+
+HEADER_FMT  = '<8sHHIdQQ24x'         # 64 bytes
+RECORD_FMT  = '<4sBBBBqdIIIQI16x'    # 64 bytes
+FOOTER_FMT  = '<8sQQI4x'             # 32 bytes
+HEADER_SIZE = struct.calcsize(HEADER_FMT)
+RECORD_SIZE = struct.calcsize(RECORD_FMT)
+FOOTER_SIZE = struct.calcsize(FOOTER_FMT)
+FINALIZED   = 1
+
+MODALITIES = ['rgb', 'depth', 'dmap', 'd4d', 'mask', 'skel']
+CODECS     = ['raw', 'zlib', 'png']
+DTYPES     = [np.dtype(np.uint8), np.dtype(np.uint16)]
+
+INDEX_DTYPE = np.dtype([('frame',    '<i8'),
+                        ('modality', 'u1'),
+                        ('codec',    'u1'),
+                        ('dtype',    'u1'),
+                        ('pad',      'u1'),
+                        ('h',        '<u4'),
+                        ('w',        '<u4'),
+                        ('c',        '<u4'),
+                        ('stamp',    '<f8'),
+                        ('offset',   '<u8'), # payload offset in the file
+                        ('length',   '<u8'), # payload length in bytes
+                        ('crc',      '<u4')])
+
+PNG_COMPRESSION = getattr(cv2, 'IMWRITE_PNG_COMPRESSION', 16)
+
+
+def is_session(path):
+    """
+    True if path is a session container file.
+    """
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as fp:
+        return fp.read(len(FILE_MAGIC)) == FILE_MAGIC
+#is_session
+
+
+def encode(image, codec='raw', level=1):
+    """
+    Returns the payload bytes of image for the given codec.
+    """
+    if codec == 'raw':
+        return np.ascontiguousarray(image).tobytes()
+    elif codec == 'zlib':
+        return zlib.compress(np.ascontiguousarray(image).tobytes(), level)
+    elif codec == 'png':
+        ok, buf = cv2.imencode('.png', image, [PNG_COMPRESSION, level])
+        if not ok:
+            raise IOError("png encoding failed")
+        return buf.tobytes()
+    raise ValueError("Unknown codec {}. Use one of {}".format(codec, CODECS))
+#encode
+
+
+def decode(payload, entry):
+    """
+    Returns the image stored in payload (bytes or buffer) for index entry.
+    """
+    codec = CODECS[entry['codec']]
+    if codec == 'png':
+        return cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), -1)
+    if codec == 'zlib':
+        payload = zlib.decompress(payload)
+    return np.frombuffer(payload, dtype=DTYPES[entry['dtype']]).reshape(entry_shape(entry))
+#decode
+
+
+def entry_shape(entry):
+    """
+    (h,w) or (h,w,c) of an index entry; c == 0 marks a 2D image.
+    """
+    if entry['c'] == 0:
+        return (int(entry['h']), int(entry['w']))
+    return (int(entry['h']), int(entry['w']), int(entry['c']))
+#entry_shape
+
+
+def padded(size, align):
+    return ((size + align - 1) // align) * align
+
+
+def read_header(fp):
+    fp.seek(0)
+    data = fp.read(HEADER_SIZE)
+    if len(data) < HEADER_SIZE:
+        raise IOError("Not a session file (too short)")
+    magic, version, flags, align, created, index_offset, index_count = struct.unpack(HEADER_FMT, data)
+    if magic != FILE_MAGIC:
+        raise IOError("Not a session file (bad magic)")
+    if version > VERSION:
+        raise IOError("Session file version {} is newer than {}".format(version, VERSION))
+    return {'version': version, 'flags': flags, 'align': align, 'created': created,
+            'index_offset': index_offset, 'index_count': index_count}
+#read_header
+
+
+def read_index(fp, header, size):
+    """
+    Returns the stored frame index of a finalized file, or None if the
+    index/footer are missing or corrupt.
+    """
+    if not header['flags'] & FINALIZED or size < HEADER_SIZE + FOOTER_SIZE:
+        return None
+    fp.seek(size - FOOTER_SIZE)
+    magic, offset, count, crc = struct.unpack(FOOTER_FMT, fp.read(FOOTER_SIZE))
+    if magic != FOOTER_MAGIC or offset != header['index_offset'] or count != header['index_count']:
+        return None
+    fp.seek(offset)
+    data = fp.read(count*INDEX_DTYPE.itemsize)
+    if len(data) != count*INDEX_DTYPE.itemsize or (zlib.crc32(data) & 0xffffffff) != crc:
+        return None
+    return np.frombuffer(data, dtype=INDEX_DTYPE).copy()
+#read_index
+
+
+def scan_records(fp, align, size, verify=True):
+    """
+    Rebuilds the frame index by walking the records from the start of the
+    file. Stops at the first truncated or corrupt record.
+    Returns (index, end) where end is the offset after the last good record.
+    """
+    entries = []
+    offset  = padded(HEADER_SIZE, align)
+    while offset + RECORD_SIZE <= size:
+        fp.seek(offset)
+        rec = struct.unpack(RECORD_FMT, fp.read(RECORD_SIZE))
+        magic, modality, codec, dtype, _, frame, stamp, h, w, c, length, crc = rec
+        if magic != RECORD_MAGIC or offset + RECORD_SIZE + length > size:
+            break
+        if verify and (zlib.crc32(fp.read(length)) & 0xffffffff) != crc:
+            break
+        entries.append((frame, modality, codec, dtype, 0, h, w, c, stamp,
+                        offset + RECORD_SIZE, length, crc))
+        offset += padded(RECORD_SIZE + length, align)
+    return np.array(entries, dtype=INDEX_DTYPE), offset
+#scan_records
+
+
+class SessionWriter(object):
+    """
+    Appends frames of any modality to one session file. Thread-safe:
+    encoding runs in the calling (writer) thread, only the file append is
+    serialized.
+    inputs:
+        path      := str, session file
+        align     := int, record alignment in bytes (fixed size chunks)
+        mode      := 'w' create/overwrite, 'a' recover and append
+        sync_every:= int, fsync every n records (0 := only on close)
+    """
+    def __init__(self, path, align=512, mode='w', sync_every=0):
+        self.path       = path
+        self.lock       = threading.Lock()
+        self.sync_every = sync_every
+        self.entries    = []
+        if mode == 'a' and os.path.isfile(path):
+            self.fp     = open(path, 'r+b')
+            header      = read_header(self.fp)
+            self.align  = header['align']
+            index, end  = scan_records(self.fp, self.align, os.path.getsize(path))
+            self.entries = [tuple(e) for e in index]
+            self.created = header['created']
+            self.fp.truncate(end) # drop the partial tail and the old index
+            self.end    = end
+            self.write_header(flags=0)
+        else:
+            self.fp      = open(path, 'wb')
+            self.align   = align
+            self.created = time.time()
+            self.end     = padded(HEADER_SIZE, align)
+            self.write_header(flags=0)
+    # __init__
+
+    def write_header(self, flags, index_offset=0, index_count=0):
+        self.fp.seek(0)
+        self.fp.write(struct.pack(HEADER_FMT, FILE_MAGIC, VERSION, flags, self.align,
+                                  self.created, index_offset, index_count))
+    # write_header
+
+    def append(self, frame, modality, image, stamp=0.0, codec='raw', level=1):
+        """
+        Encodes image and appends it as one record.
+        """
+        m       = MODALITIES.index(modality)
+        k       = CODECS.index(codec)
+        d       = DTYPES.index(image.dtype)
+        h, w    = image.shape[:2]
+        c       = image.shape[2] if image.ndim == 3 else 0
+        payload = encode(image, codec, level)
+        crc     = zlib.crc32(payload) & 0xffffffff
+        rec     = struct.pack(RECORD_FMT, RECORD_MAGIC, m, k, d, 0, frame, stamp,
+                              h, w, c, len(payload), crc)
+        size    = padded(RECORD_SIZE + len(payload), self.align)
+        with self.lock:
+            if self.fp is None:
+                raise ValueError("Session file {} is closed".format(self.path))
+            offset = self.end
+            self.fp.seek(offset)
+            self.fp.write(rec)
+            self.fp.write(payload)
+            self.fp.write('\0'*(size - RECORD_SIZE - len(payload)))
+            self.end = offset + size
+            self.entries.append((frame, m, k, d, 0, h, w, c, stamp,
+                                 offset + RECORD_SIZE, len(payload), crc))
+            if self.sync_every and len(self.entries) % self.sync_every == 0:
+                self.fp.flush()
+                os.fsync(self.fp.fileno())
+        return offset
+    # append
+
+    def close(self):
+        """
+        Writes the frame index and footer, then flags the file as finalized.
+        """
+        with self.lock:
+            if self.fp is None:
+                return
+            index = np.array(self.entries, dtype=INDEX_DTYPE)
+            data  = index.tobytes()
+            self.fp.seek(self.end)
+            self.fp.write(data)
+            self.fp.write(struct.pack(FOOTER_FMT, FOOTER_MAGIC, self.end, len(index),
+                                      zlib.crc32(data) & 0xffffffff))
+            self.fp.flush()
+            os.fsync(self.fp.fileno())
+            self.write_header(FINALIZED, self.end, len(index))
+            self.fp.flush()
+            os.fsync(self.fp.fileno())
+            self.fp.close()
+            self.fp = None
+    # close
+#SessionWriter()
+
+
+class SessionStream(object):
+    """
+    Frames of one modality in frame order, backed by the reader's mmap.
+        stream[i]        := image of the i-th stored frame (raw records are
+                            zero-copy read-only views into the file)
+        stream[i:j:k]    := (n,h,w[,c]) strided view when the records are
+                            raw and evenly spaced, else a list of images
+        stream.find(f)   := position of frame number f (None if missing)
+        stream.between(t0, t1) := frames with t0 <= stamp < t1
+    Lookups go through the in-memory index: seeking never reads or decodes
+    the frames before the requested one.
+    """
+    def __init__(self, reader, modality):
+        self.reader   = reader
+        self.modality = modality
+        self.entries  = reader.entries(modality)
+        self.frames   = self.entries['frame']
+        self.stamps   = self.entries['stamp']
+        # contiguous frame numbers: position = frame - first (no search)
+        self.dense    = len(self.frames) > 0 and \
+                        self.frames[-1] - self.frames[0] == len(self.frames) - 1
+        self.sorted_stamps = len(self.stamps) < 2 or bool(np.all(np.diff(self.stamps) >= 0))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.stack(self.entries[key])
+        return self.reader.read_entry(self.entries[key])
+    # __getitem__
+
+    def __iter__(self):
+        for entry in self.entries:
+            yield self.reader.read_entry(entry)
+
+    def stack(self, entries):
+        """
+        One strided (n,h,w[,c]) view for evenly spaced raw records of the
+        same shape (e.g., a single raw modality), else a list of images.
+        """
+        if len(entries) > 1 and np.all(entries['codec'] == CODECS.index('raw')) \
+                and len(np.unique(entries['h'])) == len(np.unique(entries['w'])) == \
+                    len(np.unique(entries['c'])) == len(np.unique(entries['dtype'])) == 1:
+            steps = np.diff(entries['offset'].astype(np.int64))
+            if np.all(steps == steps[0]) and steps[0] > 0:
+                first = self.reader.read_entry(entries[0])
+                clip  = np.lib.stride_tricks.as_strided(first, shape=(len(entries),)+first.shape,
+                                                        strides=(int(steps[0]),)+first.strides)
+                clip.flags.writeable = False # the mapping is read-only
+                return clip
+        return [self.reader.read_entry(e) for e in entries]
+    # stack
+
+    def find(self, frame):
+        """
+        Position of frame number frame, None if it was not stored.
+        """
+        n = len(self.frames)
+        if n == 0:
+            return None
+        if self.dense:
+            i = frame - int(self.frames[0])
+            return i if 0 <= i < n else None
+        i = int(np.searchsorted(self.frames, frame))
+        return i if i < n and self.frames[i] == frame else None
+    # find
+
+    def frame(self, frame):
+        """
+        Image of frame number frame, None if it was not stored.
+        """
+        i = self.find(frame)
+        return None if i is None else self[i]
+    # frame
+
+    def span(self, t0, t1):
+        """
+        (start, stop) positions of the frames with t0 <= stamp < t1.
+        """
+        if not self.sorted_stamps:
+            raise ValueError("time stamps of {} are not monotonic".format(self.modality))
+        return (int(np.searchsorted(self.stamps, t0, side='left')),
+                int(np.searchsorted(self.stamps, t1, side='left')))
+    # span
+
+    def between(self, t0, t1):
+        """
+        Frame numbers, stamps and images (see stack) with t0 <= stamp < t1.
+        """
+        start, stop = self.span(t0, t1)
+        return self.frames[start:stop], self.stamps[start:stop], self[start:stop]
+    # between
+#SessionStream()
+
+
+class SessionReader(object):
+    """
+    Reads a session file through a read-only memory map; unfinished files
+    are indexed by scanning.
+    Attributes:
+        index     := INDEX_DTYPE ndarray, one entry per record
+        recovered := bool, True if the index was rebuilt by scanning
+        data      := uint8 ndarray over the whole mapped file
+    usage:
+        session = SessionReader(path)       # session[i] uses modality='rgb'
+        rgb     = session[250000]           # i-th stored rgb frame
+        depth   = session['depth']          # SessionStream
+        clip    = depth[1000:1300]          # (300,h,w) uint16 view (raw records)
+        frames, stamps, ims = depth.between(3600.0, 3660.0)
+    NOTE: views returned by the reader keep the mapping alive; close() only
+          drops the reader's own references.
+    """
+    def __init__(self, path, modality='rgb'):
+        self.path     = path
+        self.modality = modality
+        self.fp       = open(path, 'rb')
+        self.header   = read_header(self.fp)
+        size          = os.path.getsize(path)
+        self.index    = read_index(self.fp, self.header, size)
+        self.recovered = self.index is None
+        if self.recovered:
+            self.index, _ = scan_records(self.fp, self.header['align'], size)
+        self.mm       = mmap.mmap(self.fp.fileno(), size, access=mmap.ACCESS_READ)
+        self.data     = np.frombuffer(self.mm, dtype=np.uint8)
+        self.streams  = {} # modality -> SessionStream
+    # __init__
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.stream(key)
+        return self.stream(self.modality)[key]
+    # __getitem__
+
+    def __len__(self):
+        return len(self.stream(self.modality))
+
+    def stream(self, modality):
+        if modality not in self.streams:
+            self.streams[modality] = SessionStream(self, modality)
+        return self.streams[modality]
+    # stream
+
+    def entries(self, modality):
+        """
+        Index entries of one modality sorted by frame number.
+        """
+        sub = self.index[self.index['modality'] == MODALITIES.index(modality)]
+        return sub[np.argsort(sub['frame'], kind='mergesort')]
+    # entries
+
+    def modalities(self):
+        return [MODALITIES[m] for m in np.unique(self.index['modality'])]
+
+    def read_entry(self, entry):
+        """
+        Image of one index entry: a zero-copy view for raw records, decoded
+        from the mapped payload otherwise.
+        """
+        start   = int(entry['offset'])
+        payload = self.data[start:start + int(entry['length'])]
+        if CODECS[entry['codec']] == 'raw':
+            return payload.view(DTYPES[entry['dtype']]).reshape(entry_shape(entry))
+        return decode(payload, entry)
+    # read_entry
+
+    def read(self, frame, modality='rgb'):
+        """
+        Returns the image of frame number frame, or None if not stored.
+        """
+        return self.stream(modality).frame(frame)
+    # read
+
+    def iter_frames(self, modality='rgb'):
+        """
+        Yields (frame, stamp, image) in frame order.
+        """
+        for entry in self.stream(modality).entries:
+            yield int(entry['frame']), float(entry['stamp']), self.read_entry(entry)
+    # iter_frames
+
+    def close(self):
+        self.streams = {}
+        self.data    = None
+        self.mm      = None # unmapped once the returned views are released
+        self.fp.close()
+    # close
+#SessionReader()
+
+
+class SessionStore(object):
+    """
+    Thread-safe recorder front end: one session file per session folder.
+    At a session rollover the previous file stays open for the frames still
+    queued in the writer threads; it is finalized when the session after
+    arrives (or on close()), once its last append is done (writers are
+    reference counted). Later frames of a finalized session are dropped
+    (counted in self.late) instead of re-opening its file.
+    inputs:
+        name  := str, file name inside the session folder
+        codecs:= dict, modality -> (codec, level)
+    """
+    def __init__(self, name='session.micu', codecs=None, align=512, sync_every=0):
+        self.name       = name
+        self.codecs     = codecs or {'rgb': ('png', 3), 'depth': ('raw', 0)}
+        self.align      = align
+        self.sync_every = sync_every
+        self.writers    = {} # folder -> SessionWriter (current and previous session)
+        self.order      = [] # folders of self.writers, oldest first
+        self.users      = {} # SessionWriter -> appends in progress
+        self.retired    = set() # writers of past sessions, closed by their last user
+        self.closed     = set() # finalized folders
+        self.late       = 0     # frames dropped for a finalized folder
+        self.lock       = threading.Lock()
+
+    def acquire(self, folder):
+        """
+        Writer of folder with one more user (None if the folder was
+        finalized); at a rollover the writers older than the previous
+        session are retired. Call release() when done.
+        """
+        with self.lock:
+            if folder in self.closed:
+                self.late += 1
+                return None
+            if folder not in self.writers:
+                while len(self.order) > 1: # session rollover: keep the previous one
+                    self.retire(self.order[0])
+                path = os.path.join(folder, self.name)
+                self.writers[folder] = SessionWriter(path, self.align, mode='a',
+                                                     sync_every=self.sync_every)
+                self.order.append(folder)
+            writer = self.writers[folder]
+            self.users[writer] = self.users.get(writer, 0) + 1
+            return writer
+    # acquire
+
+    def release(self, writer):
+        with self.lock:
+            self.users[writer] -= 1
+            if self.users[writer] == 0:
+                del self.users[writer]
+                if writer in self.retired: # last append of a past session
+                    self.retired.discard(writer)
+                    writer.close()
+    # release
+
+    def retire(self, folder):
+        """
+        Finalizes the file of folder now, or after its last append (call
+        under lock).
+        """
+        writer = self.writers.pop(folder)
+        self.order.remove(folder)
+        self.closed.add(folder)
+        if writer in self.users:
+            self.retired.add(writer)
+        else:
+            writer.close()
+    # retire
+
+    def save(self, folder, frame, stamp, images):
+        """
+        images:= dict, modality -> ndarray; modalities without a codec in
+                 self.codecs are skipped
+        Returns False if the frame was dropped (session already finalized).
+        """
+        writer = self.acquire(folder)
+        if writer is None:
+            return False
+        try:
+            for modality, image in images.items():
+                if modality in self.codecs and image is not None:
+                    codec, level = self.codecs[modality]
+                    writer.append(frame, modality, image, stamp, codec, level)
+        finally:
+            self.release(writer)
+        return True
+    # save
+
+    def close(self):
+        """
+        Finalizes the current file (appends in progress finish first).
+        """
+        with self.lock:
+            for folder in list(self.order):
+                self.retire(folder)
+        if self.late:
+            print "{} late frames of finalized sessions dropped".format(self.late)
+    # close
+#SessionStore()
+
+
+def iter_display(path, modality='rgb', colorizer=None, start=0, stop=None):
+    """
+    Yields (frame, image) with 3-channel uint8 images ready for a
+    VideoWriter. 'depth' and 'd4d' are colorized from the raw depth, 'dmap'
+    is packed with depth_codec when only the raw depth was stored.
+    start, stop:= stored frame positions (no frame before start is read)
+    NOTE: rgb frames stored raw are read-only views into the file
+    """
+    reader = SessionReader(path)
+    stored = reader.modalities()
+    source = modality
+    if modality == 'depth' or (modality in ('d4d', 'dmap') and modality not in stored):
+        source = 'depth'
+    if colorizer is None:
+        colorizer = depth_display.DepthColorizer()
+    try:
+        stream = reader[source]
+        for i in range(*slice(start, stop).indices(len(stream))):
+            frame, im = int(stream.frames[i]), stream[i]
+            if source == 'depth' and modality == 'dmap':
+                im = depth_codec.encode_dmap(im)
+            elif source == 'depth':
+                im = colorizer.colorize(im)
+            elif im.ndim == 2:
+                im = cv2.cvtColor(im, cv2.COLOR_GRAY2BGR)
+            yield frame, im
+    finally:
+        reader.close()
+#iter_display
+
+
+if __name__ == "__main__":
+    # Round trip, crash recovery and append checks
+    import tempfile
+    path  = os.path.join(tempfile.mkdtemp(), 'test.micu')
+    rgbs  = [np.random.randint(0, 256, size=(48,64,3)).astype(np.uint8) for _ in range(10)]
+    depth = [np.random.randint(0, 2**12, size=(48,64)).astype(np.uint16) for _ in range(10)]
+    writer = SessionWriter(path, align=512)
+    for f in range(10):
+        writer.append(f, 'rgb',   rgbs[f],  stamp=f/30.0, codec='png')
+        writer.append(f, 'depth', depth[f], stamp=f/30.0, codec=CODECS[f % 2 and 2 or 1])
+    writer.close()
+    reader = SessionReader(path)
+    assert not reader.recovered and len(reader.index) == 20
+    assert all(np.array_equal(reader.read(f, 'depth'), depth[f]) for f in range(10))
+    assert all(np.array_equal(im, rgbs[f]) for f, t, im in reader.iter_frames('rgb'))
+    reader.close()
+
+    # simulated crash: no index/footer and a torn last record
+    with open(path, 'r+b') as fp:
+        fp.truncate(int(np.array(reader.index['offset']).max()) + 10)
+    reader = SessionReader(path)
+    assert reader.recovered and len(reader.index) == 19
+    reader.close()
+    writer = SessionWriter(path, mode='a') # resume: drops the torn record
+    writer.append(9, 'depth', depth[9], stamp=9/30.0)
+    writer.close()
+    reader = SessionReader(path)
+    assert not reader.recovered and len(reader.index) == 20
+    assert np.array_equal(reader.read(9, 'depth'), depth[9])
+    reader.close()
+
+    # mmap streams: zero-copy views, slices and time ranges
+    reader = SessionReader(path)
+    stream = reader['depth']
+    assert len(stream) == 10 and np.array_equal(stream[3], depth[3])
+    assert stream.find(7) == 7 and stream.find(11) is None
+    frames, stamps, ims = stream.between(2/30.0, 5/30.0 - 1e-6)
+    assert list(frames) == [2, 3, 4] and all(np.array_equal(im, depth[f]) for f, im in zip(frames, ims))
+    assert np.array_equal(reader[4], rgbs[4])
+    reader.close()
+    print "session_file round trip and recovery OK"
+
+    # Store: rollover while appends are in progress, late frames
+    root   = tempfile.mkdtemp()
+    folders = [os.path.join(root, 's{}'.format(i)) for i in range(3)]
+    for folder in folders:
+        os.makedirs(folder)
+    store  = SessionStore(codecs={'depth': ('raw', 0)})
+    writer = store.acquire(folders[0])       # an append in progress on session 0
+    assert store.save(folders[1], 0, 0.0, {'depth': depth[0]})
+    assert store.save(folders[0], 9, 0.3, {'depth': depth[9]}) # queued frame: still open
+    assert store.save(folders[2], 0, 0.0, {'depth': depth[0]}) # session 0 retired...
+    assert writer.fp is not None             # ...but closed by its last user
+    store.release(writer)
+    assert writer.fp is None and not store.save(folders[0], 10, 0.4, {'depth': depth[0]})
+    try:
+        writer.append(11, 'depth', depth[0])
+        assert False, "append on a closed writer"
+    except ValueError:
+        pass
+    store.close()
+    for folder, n in zip(folders, (1, 1, 1)):
+        reader = SessionReader(os.path.join(folder, store.name))
+        assert not reader.recovered and len(reader.index) == n
+        reader.close()
+    assert store.late == 1
+    print "session_store rollover OK"
+
+    # Seek benchmark: last frame of a long raw depth session
+    n      = 5000
+    path   = os.path.join(tempfile.mkdtemp(), 'long.micu')
+    writer = SessionWriter(path, align=512)
+    for f in range(n):
+        writer.append(f, 'depth', depth[f % 10], stamp=f/30.0)
+    writer.close()
+    tic    = time.time()
+    reader = SessionReader(path)
+    stream = reader['depth']
+    t_open = time.time() - tic
+    tic    = time.time()
+    for f in range(n-1000, n):
+        im = stream.frame(f)
+    t_seek = (time.time() - tic)/1000
+    tic    = time.time()
+    clip   = stream[n-300:n]
+    t_clip = time.time() - tic
+    assert isinstance(clip, np.ndarray) and np.array_equal(clip[-1], depth[(n-1) % 10])
+    print "{} frames: open+index {:.1f} ms, seek {:.1f} us/frame, 300 frame slice {:.1f} us".format(
+        n, t_open*1e3, t_seek*1e6, t_clip*1e6)
+    reader.close()
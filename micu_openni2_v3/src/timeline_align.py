@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 07Oct2016
+
+timeline_align.py
+
+Joins the recordings of several devices (one Pi each) into synchronized
+frame tuples. Every device timeline (frame times from the session journals
+or csv files) is loaded into sorted numpy arrays and the frames of each
+device are matched to a reference device by nearest time stamp with
+np.searchsorted: no python loop over frames, days of 30 fps data from 4+
+devices align in seconds.
+
+Matching:
+    ref frame i <-> device frame j, nearest in time, |t_ref - t_dev| <= tol
+    one to one: when two ref frames pick the same device frame only the
+    closer keeps it, the other is unmatched (-1)
+Report: matched/unmatched frames per device and the time error.
+
+Clock: the server time stamps (coordinator clock estimated on every device,
+see clock_sync.py) by default. A frame without one (nan, before the first
+estimate) is left out of the timeline and counted as unmatched
+(Timeline.missing); its wall time is in another clock domain and would be
+matched against server time. The local clocks of the Pis are not
+synchronized, use clock='wall_ns' only for devices that share one.
+
+usage:
+    timelines = [load_timeline(root+'icudata{}/'.format(d), t0, t1) for d in (1,2,3,4)]
+    result    = align(timelines, tol=0.05)
+    result.frames   # (n, ndev) device frame numbers, -1 := no match
+    print report(result, names=['dev1','dev2','dev3','dev4'])
+
+    python timeline_align.py [--clock=server_ts|wall_ns] <tol> <dev folder or journal> ...
+    python timeline_align.py                 # benchmark, simulated devices
+
+@author: carlos
+"""
+import os
+import numpy as np
+
+import timestamp_journal
+import session_catalog
+
+CLOCKS = ('server_ts', 'wall_ns')
+
+
+class Timeline(object):
+    """
+    Frames of one device in time order.
+        t      := (n,) float64 seconds
+        frames := (n,) int64 frame numbers (per session)
+        session:= (n,) int32 index into paths
+        paths  := list of str, the journal/csv file of each session
+        missing:= int, frames left out without a time stamp in the clock
+                  (never matched; not windowed, they have no time)
+    """
+    def __init__(self, t, frames, session=None, paths=None, missing=0):
+        order        = np.argsort(t, kind='mergesort')
+        self.t       = np.asarray(t, dtype=np.float64)[order]
+        self.frames  = np.asarray(frames, dtype=np.int64)[order]
+        self.session = (np.zeros(len(t), np.int32) if session is None
+                        else np.asarray(session, dtype=np.int32)[order])
+        self.paths   = paths or []
+        self.missing = int(missing)
+
+    def __len__(self):
+        return len(self.t)
+
+    def window(self, t0=None, t1=None):
+        """
+        Sub timeline with t0 <= t < t1 (two binary searches, no copy of the
+        rest).
+        """
+        a = 0 if t0 is None else np.searchsorted(self.t, t0, side='left')
+        b = len(self.t) if t1 is None else np.searchsorted(self.t, t1, side='left')
+        sub = Timeline.__new__(Timeline)
+        sub.t, sub.frames, sub.session, sub.paths = (self.t[a:b], self.frames[a:b],
+                                                     self.session[a:b], self.paths)
+        sub.missing = self.missing
+        return sub
+    # window
+#Timeline()
+
+
+def load_timeline(src, t0=None, t1=None, clock='server_ts'):
+    """
+    Loads a device timeline from a journal (.tsj), a csv, or a folder
+    (all the sessions below it, see session_catalog.py).
+    inputs:
+        clock:= 'server_ts' (server time stamps; frames without one are
+                dropped and counted in Timeline.missing) or
+                'wall_ns' (local clock only)
+    """
+    if clock not in CLOCKS:
+        raise ValueError("Unknown clock {}. Use one of {}".format(clock, CLOCKS))
+    if os.path.isdir(src):
+        files = []
+        for devN, patient, session, path in session_catalog.find_sessions([src]):
+            found = session_catalog.session_files(path)
+            tsj   = [f for f in found if f.endswith('.tsj')]
+            files += tsj or [f for f in found if f.endswith('.csv')]
+    else:
+        files = [src]
+    ts, frames, sessions, missing = [], [], [], 0
+    for i, path in enumerate(files):
+        if path.endswith('.tsj'):
+            data = timestamp_journal.read_journal(path)
+            wall, server = data['wall_ns']*1e-9, data['server_ts']
+            f    = data['frame']
+        else:
+            rows = np.array(session_catalog.read_csv_times(path), dtype=np.float64).reshape(-1, 3)
+            wall, server = rows[:, 1], rows[:, 2]
+            f    = rows[:, 0]
+        t  = wall if clock == 'wall_ns' else server
+        ok = ~np.isnan(t)
+        missing += int(len(t) - ok.sum())
+        ts.append(t[ok])
+        frames.append(f[ok])
+        sessions.append(np.full(ok.sum(), i, dtype=np.int32))
+    if not files:
+        return Timeline(np.zeros(0), np.zeros(0))
+    timeline = Timeline(np.concatenate(ts), np.concatenate(frames), np.concatenate(sessions), files,
+                        missing)
+    return timeline.window(t0, t1)
+#load_timeline
+
+
+def nearest(ref, t, tol):
+    """
+    For every time in ref the index of the nearest time in t (sorted), -1
+    when none is within tol; one to one (see module doc).
+    output:
+        idx := (len(ref),) int64
+        err := (len(ref),) float64, t[idx] - ref (nan when unmatched)
+    """
+    n = len(t)
+    if n == 0:
+        return np.full(len(ref), -1, np.int64), np.full(len(ref), np.nan)
+    right = np.clip(np.searchsorted(t, ref), 0, n-1)
+    left  = np.clip(right-1, 0, n-1)
+    pick  = np.where(np.abs(t[left]-ref) <= np.abs(t[right]-ref), left, right)
+    err   = t[pick] - ref
+    ok    = np.abs(err) <= tol
+    # one to one: among the ref frames that picked the same frame keep the closest
+    cand  = np.nonzero(ok)[0]
+    order = cand[np.lexsort((np.abs(err[cand]), pick[cand]))]
+    dup   = np.zeros(len(order), bool)
+    dup[1:] = pick[order][1:] == pick[order][:-1]
+    ok[order[dup]] = False
+    idx   = np.where(ok, pick, -1)
+    return idx, np.where(ok, err, np.nan)
+#nearest
+
+
+class Alignment(object):
+    """
+    Result of align():
+        t      := (n,) reference times
+        index  := (n, ndev) timeline indices, -1 := unmatched
+        frames := (n, ndev) device frame numbers, -1 := unmatched
+        error  := (n, ndev) time error to the reference (s)
+        unmatched:= list (per device) of timeline indices never matched
+                    (plus timelines[d].missing frames without a time stamp)
+    """
+    def __init__(self, t, index, frames, error, unmatched, timelines):
+        self.t, self.index, self.frames = t, index, frames
+        self.error, self.unmatched, self.timelines = error, unmatched, timelines
+
+    def complete(self):
+        """
+        Rows where every device has a frame.
+        """
+        return np.all(self.index >= 0, axis=1)
+#Alignment()
+
+
+def align(timelines, tol=0.05, ref=0, t0=None, t1=None):
+    """
+    Aligns every timeline to timelines[ref] by nearest time stamp.
+    inputs:
+        timelines:= list of Timeline (4+ devices)
+        tol      := float, max time difference in seconds
+        t0, t1   := optional time window
+    """
+    timelines = [tl.window(t0, t1) for tl in timelines]
+    t_ref = timelines[ref].t
+    n, ndev = len(t_ref), len(timelines)
+    index  = np.full((n, ndev), -1, np.int64)
+    frames = np.full((n, ndev), -1, np.int64)
+    error  = np.full((n, ndev), np.nan)
+    unmatched = []
+    for d, tl in enumerate(timelines):
+        if d == ref:
+            idx, err = np.arange(n, dtype=np.int64), np.zeros(n)
+        else:
+            idx, err = nearest(t_ref, tl.t, tol)
+        ok = idx >= 0
+        index[:, d]      = idx
+        frames[ok, d]    = tl.frames[idx[ok]]
+        error[:, d]      = err
+        used             = np.zeros(len(tl), bool)
+        used[idx[ok]]    = True
+        unmatched.append(np.nonzero(~used)[0])
+    return Alignment(t_ref, index, frames, error, unmatched, timelines)
+#align
+
+
+def report(result, names=None):
+    """
+    Text summary: matched/unmatched frames and time error per device; the
+    unmatched count includes the frames without a time stamp.
+    """
+    names = names or ["dev{}".format(d+1) for d in range(result.index.shape[1])]
+    lines = ["{} reference frames, {} complete tuples".format(len(result.t), int(result.complete().sum()))]
+    for d, name in enumerate(names):
+        ok  = result.index[:, d] >= 0
+        err = np.abs(result.error[ok, d])
+        tl  = result.timelines[d]
+        lines.append("\t{}: {} frames, {} matched, {} unmatched ({} without a time stamp), "
+                     "error mean {:.1f} ms max {:.1f} ms".format(
+            name, len(tl) + tl.missing, int(ok.sum()), len(result.unmatched[d]) + tl.missing, tl.missing,
+            err.mean()*1e3 if len(err) else 0.0, err.max()*1e3 if len(err) else 0.0))
+    return "\n".join(lines)
+#report
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    args  = [a for a in sys.argv[1:] if not a.startswith('--clock=')]
+    clock = ([a.split('=', 1)[1] for a in sys.argv[1:] if a.startswith('--clock=')] or ['server_ts'])[-1]
+    if len(args) > 1: # align the given devices
+        tol = float(args[0])
+        timelines = [load_timeline(src, clock=clock) for src in args[1:]]
+        result = align(timelines, tol=tol)
+        print "clock:", clock
+        print report(result, names=[os.path.basename(os.path.normpath(s)) for s in args[1:]])
+        out = 'aligned_frames.csv'
+        np.savetxt(out, np.column_stack((result.t, result.frames)), delimiter=',',
+                   fmt=['%.6f']+['%d']*len(timelines))
+        print "aligned frame tuples written to", out
+        sys.exit(0)
+
+    # Benchmark: 4 devices, 2 days at 30 fps, clock offsets, jitter and drops
+    rng   = np.random.RandomState(0)
+    n     = 2*24*3600*30
+    tic   = time.time()
+    timelines = []
+    for d in range(4):
+        t = 1475000000.0 + np.arange(n)/30.0 + d*0.004 + rng.normal(0, 0.003, n)
+        keep = rng.rand(n) > 0.01 # 1% dropped frames
+        timelines.append(Timeline(t[keep], np.arange(n)[keep]))
+    t_sim = time.time()-tic
+    tic    = time.time()
+    result = align(timelines, tol=1/60.0)
+    t_align = time.time()-tic
+    print "simulated {} frames x 4 devices in {:.1f} s".format(n, t_sim)
+    print report(result)
+    print "aligned in {:.2f} s".format(t_align)
+    both = result.index[:, 1] >= 0
+    assert np.mean(result.frames[both, 1] == result.frames[both, 0]) > 0.99
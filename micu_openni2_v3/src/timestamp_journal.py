@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 30Sep2016
+
+timestamp_journal.py
+
+Binary append-only per-session timestamp journal (.tsj). One fixed 72 byte
+little endian record per frame:
+    frame        int64    frame number
+    mono_ns      int64    monotonic clock (CLOCK_MONOTONIC), ns
+    wall_ns      int64    wall clock (time.time), ns
+    server_ts    float64  server time of the frame (client.server_time()), or the
+                          stamp of the last reply (nan if none)
+    device_ts    int64    depth frame device time stamp (VideoFrame.timestamp, us)
+    device_index int64    depth frame device counter (VideoFrame.frameIndex)
+    rgb_ts       int64    rgb frame device time stamp, us
+    rgb_index    int64    rgb frame device counter
+    server_err   float64  error bound of server_ts, s (nan if unknown)
+Records are packed with struct (no strftime/str formatting per frame),
+buffered and written + fsynced every sync_every records. A torn last record
+(crash) is ignored by the reader.
+
+Reading and text export are offline steps:
+    journal = read_journal(path)        # numpy structured array, one call
+    export_csv(path, path[:-4]+'.csv')  # pandas compatible csv
+    python timestamp_journal.py <journal.tsj> [<out.csv>]
+
+usage:
+    journal = TimestampJournal(folder4csv+'dev1_times0.tsj')
+    journal.append(f, server_ts=parse_server_time(server_time))
+    ...
+    journal.close()
+
+benchmark (no arguments):
+    python timestamp_journal.py
+
+@author: carlos
+"""
+import os
+import struct
+import time
+import numpy as np
+
+MAGIC       = 'MICUTSJ1'
+HEADER_FMT  = '<8sII'   # magic, version, record size
+RECORD_FMT  = '<qqqdqqqqd'
+HEADER_SIZE = struct.calcsize(HEADER_FMT)
+RECORD_SIZE = struct.calcsize(RECORD_FMT)
+VERSION     = 1
+
+JOURNAL_DTYPE = np.dtype([('frame',        '<i8'),
+                          ('mono_ns',      '<i8'),
+                          ('wall_ns',      '<i8'),
+                          ('server_ts',    '<f8'),
+                          ('device_ts',    '<i8'),
+                          ('device_index', '<i8'),
+                          ('rgb_ts',       '<i8'),
+                          ('rgb_index',    '<i8'),
+                          ('server_err',   '<f8')])
+assert JOURNAL_DTYPE.itemsize == RECORD_SIZE
+
+
+def _monotonic_clock():
+    """
+    Returns a function giving CLOCK_MONOTONIC in seconds (float).
+    python2 has no time.monotonic: clock_gettime through ctypes, time.time
+    as the last resort.
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        import ctypes, ctypes.util
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        ts = timespec()
+        def monotonic():
+            if clock_gettime(1, ctypes.pointer(ts)) != 0: # 1 := CLOCK_MONOTONIC
+                raise OSError(ctypes.get_errno(), "clock_gettime failed")
+            return ts.tv_sec + ts.tv_nsec*1e-9
+        monotonic()
+        return monotonic
+    except (OSError, AttributeError):
+        return time.time
+#_monotonic_clock
+
+monotonic = _monotonic_clock()
+
+
+def parse_server_time(server_time):
+    """
+    Server reply time stamp as a float, e.g. '1475000000.12=Mon, 26 ...'
+    from 'save_1475000000.12=Mon, 26 ...'; nan when there is none.
+    """
+    try:
+        return float(str(server_time).split('=')[0])
+    except ValueError:
+        return float('nan')
+#parse_server_time
+
+
+class TimestampJournal(object):
+    """
+    Appends one struct record per frame.
+    inputs:
+        path      := str, journal file (appended to if it exists)
+        sync_every:= int, write + fsync every n records
+    """
+    def __init__(self, path, sync_every=30):
+        self.path       = path
+        self.sync_every = sync_every
+        size            = os.path.getsize(path) if os.path.isfile(path) else 0
+        if size < HEADER_SIZE:
+            self.fp = open(path, 'wb')
+            self.fp.write(struct.pack(HEADER_FMT, MAGIC, VERSION, RECORD_SIZE))
+        else: # keep appending after the last whole record
+            self.fp = open(path, 'r+b')
+            magic, version, rsize = struct.unpack(HEADER_FMT, self.fp.read(HEADER_SIZE))
+            if magic != MAGIC or version != VERSION:
+                self.fp.close()
+                raise IOError("{} is not a version {} journal".format(path, VERSION))
+            self.fp.truncate(HEADER_SIZE + (size-HEADER_SIZE)//RECORD_SIZE*RECORD_SIZE)
+            self.fp.seek(0, os.SEEK_END)
+        self.pack       = struct.Struct(RECORD_FMT).pack
+        self.buffer     = []
+        self.records    = 0
+
+    def append(self, frame, server_ts=float('nan'), device_ts=0, device_index=-1,
+               rgb_ts=0, rgb_index=-1, mono_ns=None, wall_ns=None, server_err=float('nan')):
+        """
+        Appends one frame record; the clocks are read now unless given.
+        device_*/rgb_*:= depth and rgb frame_gaps.frame_info() values
+        server_err    := error bound of server_ts (client.server_time())
+        """
+        if mono_ns is None:
+            mono_ns = int(monotonic()*1e9)
+        if wall_ns is None:
+            wall_ns = int(time.time()*1e9)
+        self.buffer.append(self.pack(frame, mono_ns, wall_ns, server_ts, device_ts,
+                                     device_index, rgb_ts, rgb_index, server_err))
+        self.records += 1
+        if len(self.buffer) >= self.sync_every:
+            self.sync()
+    # append
+
+    def sync(self):
+        if self.buffer:
+            self.fp.write(''.join(self.buffer))
+            self.buffer = []
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+    # sync
+
+    def close(self):
+        if self.fp is not None:
+            self.sync()
+            self.fp.close()
+            self.fp = None
+    # close
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+#TimestampJournal()
+
+
+def read_journal(path):
+    """
+    Loads a whole journal in one call.
+    output:
+        JOURNAL_DTYPE ndarray, one entry per frame (a torn last record is
+        dropped)
+    """
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    magic, version, size = struct.unpack(HEADER_FMT, data[:HEADER_SIZE])
+    if magic != MAGIC:
+        raise IOError("{} is not a timestamp journal".format(path))
+    if version != VERSION or size != RECORD_SIZE:
+        raise IOError("{}: unknown version {} (record size {})".format(path, version, size))
+    n = (len(data) - HEADER_SIZE)//size
+    return np.frombuffer(data, dtype=JOURNAL_DTYPE, count=n, offset=HEADER_SIZE)
+#read_journal
+
+
+def export_csv(path, csv_path):
+    """
+    Writes a journal as csv (index column first, pandas read_csv friendly):
+        frameN, localtime (wall, s), servertime, monotonic (s), devicetime (us),
+        deviceindex, rgbtime (us), rgbindex, servererr (s)
+    """
+    import metadata_log
+    journal = read_journal(path)
+    cols    = ["frameN","localtime","servertime","monotonic","devicetime",
+               "deviceindex","rgbtime","rgbindex","servererr"]
+    with metadata_log.MetadataLog(csv_path, cols, flush_rows=10000) as log:
+        for i, r in enumerate(journal):
+            log.append(i, int(r['frame']), r['wall_ns']*1e-9, float(r['server_ts']),
+                       r['mono_ns']*1e-9, int(r['device_ts']), int(r['device_index']),
+                       int(r['rgb_ts']), int(r['rgb_index']), float(r['server_err']))
+    return len(journal)
+#export_csv
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1: # offline export
+        src = sys.argv[1]
+        dst = sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(src)[0]+'.csv'
+        print "{} records written to {}".format(export_csv(src, dst), dst)
+        sys.exit(0)
+
+    # Benchmark: per frame cost vs. the csv text row, and the reader
+    import tempfile
+    folder = tempfile.mkdtemp()
+    n      = 100000
+    stamp  = 'save_1475000000.123=Mon, 26 Sep 2016 12:00:00 +0000'.split('_')[1]
+    tic = time.time()
+    with open(os.path.join(folder, 'text.csv'), 'w') as fp:
+        for f in range(n):
+            fp.write("{},{},{},{}\n".format(f, f, time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime()), stamp))
+    t_text = time.time() - tic
+
+    path = os.path.join(folder, 'test.tsj')
+    tic  = time.time()
+    with TimestampJournal(path, sync_every=1000) as journal:
+        server_ts = parse_server_time(stamp)
+        for f in range(n):
+            journal.append(f, server_ts, device_ts=f*33333)
+    t_journal = time.time() - tic
+
+    tic  = time.time()
+    data = read_journal(path)
+    t_read = time.time() - tic
+    assert len(data) == n and data['frame'][-1] == n-1 and data['server_ts'][0] == 1475000000.123
+    assert np.all(np.diff(data['mono_ns']) >= 0)
+    with open(path, 'ab') as fp: # torn record
+        fp.write('\0'*7)
+    assert len(read_journal(path)) == n
+    print "{} frames: strftime csv rows {:.2f} us/frame, journal {:.2f} us/frame, read {:.1f} ms ({:.0f} MB/s)".format(
+        n, t_text/n*1e6, t_journal/n*1e6, t_read*1e3, n*RECORD_SIZE/2.0**20/max(t_read, 1e-9))
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 13Oct2016
+
+wire_protocol.py
+
+Length prefixed binary messages between the recorders (client.py) and the
+coordinator (coordinator.py). Fixed 20 byte little endian header:
+    magic    2s       'MC'
+    version  uint8    VERSION
+    type     uint8    request/reply type (below)
+    dev      uint32   device number
+    stamp    float64  sender time (s); server time in the replies
+    length   uint32   payload bytes that follow (<= MAX_PAYLOAD)
+so a reader never depends on how TCP splits or joins the messages, and time
+stamps travel as numbers instead of "save_<tic>=<date>" strings.
+
+A TRIGGER (sent over UDP multicast by trigger.py, one datagram per message)
+carries a sequence number so the listeners can count missed triggers.
+
+A REGISTER request carries the device capabilities as payload
+("res=640x480,fps=30", device_registry.py); a HEARTBEAT is answered like a
+SYNC (server time). A METRICS request is a heartbeat with the recorder
+numbers as payload ("fps=29.8,queue=3", device_metrics.py).
+
+A START reply announces the recording start in server time (stamp) and the
+session length (payload): session k starts at stamp + k*length.
+
+The legacy text commands ("<dev> <cmd>\\n", replies "<msg>_<tic>=<date>")
+map one to one onto the message types: from_text()/to_text() convert, and
+the coordinator speaks both (the first bytes of a connection tell which).
+
+usage:
+    sock.sendall(pack(CHECK, 2, time.time()))
+    decoder = Decoder()
+    for msg in decoder.feed(sock.recv(4096)):
+        if msg.type == SAVE: ...          # msg.stamp := server time
+
+benchmark:
+    python wire_protocol.py
+
+@author: carlos
+"""
+import struct
+from collections import namedtuple
+from time import strftime, localtime
+
+MAGIC       = 'MC'
+VERSION     = 1
+HEADER      = struct.Struct('<2sBBIdI')
+HEADER_SIZE = HEADER.size
+MAX_PAYLOAD = 1 << 16
+
+## Requests (recorder -> coordinator)
+CONNECT, SYNC, CHECK, WATCH, CLOSE, SCHEDULE, REGISTER, HEARTBEAT, METRICS = 1, 2, 3, 4, 5, 6, 7, 8, 9
+## Replies (coordinator -> recorder)
+CONNECTED, READY, SYNCED, SAVE, WAIT, CLOSED, TERMINATE, UNKNOWN, REJECTED, START, TRIGGER, REGISTERED = \
+    range(16, 28)
+
+REQUESTS = {'connect': CONNECT, 'sync': SYNC, 'check': CHECK, 'watch': WATCH, 'close': CLOSE,
+            'start': SCHEDULE, 'register': REGISTER, 'heartbeat': HEARTBEAT,
+            'metrics': METRICS}
+REPLIES  = {'connected': CONNECTED, 'ready': READY, 'sync': SYNCED, 'save': SAVE, 'wait': WAIT,
+            'close': CLOSED, 'terminate': TERMINATE, 'unknown': UNKNOWN, 'rejected': REJECTED,
+            'start': START, 'trigger': TRIGGER, 'registered': REGISTERED}
+## START payload: session length (s, 0 := no rollover); stamp := start instant
+SESSION = struct.Struct('<d')
+## TRIGGER payload (UDP datagram, trigger.py): sequence number; stamp := server time
+SEQUENCE = struct.Struct('<Q')
+NAMES    = dict((v, k) for k, v in REQUESTS.items()+REPLIES.items())
+
+Message = namedtuple('Message', ['type', 'dev', 'stamp', 'payload'])
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def pack(mtype, dev, stamp, payload=''):
+    """
+    One framed message (str).
+    """
+    return HEADER.pack(MAGIC, VERSION, mtype, dev, stamp, len(payload)) + payload
+#pack
+
+
+class Decoder(object):
+    """
+    Splits a byte stream into Messages; partial messages are kept until the
+    rest arrives.
+    """
+    def __init__(self):
+        self.buffer = ''
+
+    def feed(self, data):
+        """
+        Adds received bytes; returns the list of complete Messages.
+        """
+        buf  = self.buffer + data if self.buffer else data
+        out  = []
+        pos  = 0
+        size = len(buf)
+        while size - pos >= HEADER_SIZE:
+            magic, version, mtype, dev, stamp, length = HEADER.unpack_from(buf, pos)
+            if magic != MAGIC:
+                raise ProtocolError("bad magic {!r}".format(magic))
+            if version > VERSION:
+                raise ProtocolError("unsupported protocol version {}".format(version))
+            if length > MAX_PAYLOAD:
+                raise ProtocolError("payload too long ({} bytes)".format(length))
+            end = pos + HEADER_SIZE + length
+            if end > size:
+                break
+            out.append(Message(mtype, dev, stamp, buf[pos+HEADER_SIZE:end]))
+            pos = end
+        self.buffer = buf[pos:]
+        return out
+    # feed
+#Decoder()
+
+
+def is_binary(data):
+    """
+    True when a connection starts with a framed message (vs. a text command).
+    """
+    return data[:len(MAGIC)] == MAGIC
+#is_binary
+
+
+## --- legacy text shim --------------------------------------------------------
+def from_text(line, stamp=0.0):
+    """
+    "<dev> <cmd> [payload]" -> Message; type 0 when the command is not known.
+    """
+    data = line.strip().split(" ")
+    try:
+        dev = int(data[0])
+    except ValueError:
+        dev = 0
+    cmd = data[1].lower() if len(data) > 1 else ''
+    return Message(REQUESTS.get(cmd, 0), dev, stamp, " ".join(data[2:]))
+#from_text
+
+
+def to_text(msg, date=True):
+    """
+    Reply Message -> legacy text reply, e.g. "save_1475000000.12=Mon, ...".
+    """
+    name  = NAMES.get(msg.type, 'unknown')
+    stamp = repr(msg.stamp) # str() keeps 12 digits only (10 ms)
+    if name in ('connected', 'ready', 'registered'):
+        text = "dev{} {}_{}".format(msg.dev, name, stamp)
+    elif name == 'terminate':
+        text = "terminate"
+    elif name == 'unknown':
+        text = ""
+    elif name == 'rejected':
+        text = "dev{} -not recognized by the server!!".format(msg.dev)
+    elif name == 'start': # "start_<instant>_<session length>"
+        text = "start_{}_{!r}".format(stamp, SESSION.unpack(msg.payload)[0] if msg.payload else 0.0)
+    else:
+        text = "{}_{}".format(name, stamp)
+    if date:
+        text += '=' + strftime("%a, %d %b %Y %H:%M:%S +0000", localtime())
+    return text
+#to_text
+
+
+def parse_text_reply(text):
+    """
+    Legacy text reply -> (type, server time); (UNKNOWN, nan) if unparsable.
+    """
+    head = text.strip().split('=')[0]
+    if head.startswith('start_'):
+        return START, float(head.split('_')[1])
+    name, _, stamp = head.rpartition('_')
+    name = name.split(' ')[-1]
+    try:
+        return REPLIES.get(name, UNKNOWN), float(stamp)
+    except ValueError:
+        return REPLIES.get(head.split(' ')[-1], UNKNOWN), float('nan')
+#parse_text_reply
+
+
+def text_payload(text):
+    """
+    Payload of a legacy text reply (the session length of a START).
+    """
+    head = text.strip().split('=')[0].split('_')
+    if head[0] == 'start' and len(head) > 2:
+        return SESSION.pack(float(head[2]))
+    return ''
+#text_payload
+
+
+if __name__ == "__main__":
+    import time
+    # Round trip, split and concatenated reads
+    msgs   = [pack(CHECK, d, 1475000000.0+d, 'x'*(d % 3)) for d in range(1, 65)]
+    stream = ''.join(msgs)
+    dec    = Decoder()
+    got    = []
+    for i in range(0, len(stream), 7): # 7 byte pieces
+        got += dec.feed(stream[i:i+7])
+    assert [(m.type, m.dev, m.stamp, m.payload) for m in got] == \
+           [(CHECK, d, 1475000000.0+d, 'x'*(d % 3)) for d in range(1, 65)]
+    assert from_text("2 watch\n") == Message(WATCH, 2, 0.0, '')
+    reply = to_text(Message(SAVE, 2, 1475000000.125, ''))
+    assert parse_text_reply(reply) == (SAVE, 1475000000.125), reply
+    assert parse_text_reply(to_text(Message(CONNECTED, 2, 1.5, ''))) == (CONNECTED, 1.5)
+    assert parse_text_reply(to_text(Message(REGISTERED, 5, 2.5, ''))) == (REGISTERED, 2.5)
+    assert from_text("5 register res=640x480,fps=30\n") == Message(REGISTER, 5, 0.0, 'res=640x480,fps=30')
+    start = to_text(Message(START, 2, 1475000000.25, SESSION.pack(600.0)))
+    assert parse_text_reply(start) == (START, 1475000000.25) and text_payload(start) == SESSION.pack(600.0)
+    try:
+        Decoder().feed('2 check\n'+'\0'*20)
+        raise AssertionError("text accepted as binary")
+    except ProtocolError:
+        pass
+
+    # Codec benchmark: reply encode + decode, binary vs. text
+    n   = 200000
+    tic = time.time()
+    for i in range(n):
+        data = pack(SAVE, 2, 1475000000.125+i)
+        dec.feed(data)
+    t_bin = time.time()-tic
+    tic = time.time()
+    for i in range(n):
+        text = "save_{}".format(1475000000.125+i)+'='+strftime("%a, %d %b %Y %H:%M:%S +0000", localtime())
+        response, server_time = text.split("_")
+        float(server_time.split('=')[0])
+    t_text = time.time()-tic
+    tic = time.time()
+    blob = ''.join(pack(SAVE, 2, 1475000000.125+i) for i in range(n))
+    t_pack = time.time()-tic
+    tic = time.time()
+    assert len(Decoder().feed(blob)) == n
+    t_feed = time.time()-tic
+    print "{} replies: binary {:.2f} us/msg, text {:.2f} us/msg; {} B vs {} B per reply".format(
+        n, t_bin/n*1e6, t_text/n*1e6, HEADER_SIZE, len(text))
+    print "batched: pack {:.2f} us/msg, decode {:.2f} us/msg".format(t_pack/n*1e6, t_feed/n*1e6)
@@ -2,13 +2,23 @@
 arctable.py
 ARCtable_class. description and paramaters for the hdf5 file and tables used
 during icu data collection for training.
+Frame arrays (rgb, depth, mask) can be stored in the same file, chunked one
+frame per chunk and compressed (see createFrameArrays).
+Long recordings: size the table from the expected duration (createARCtable,
+expectedRows), flush in batches (H5Flusher) and build CS indexes on
+timestamp/globalframe at close (indexARCtable).
+
+benchmark:
+    python arctable.py
 
 created 09may2014
 
 author: carlos
 '''
 import tables as tb
+import numpy as np
 import os
+import time
 
 
 class ARCtable(tb.IsDescription):
@@ -25,3 +35,181 @@ class ARCtable(tb.IsDescription):
     actionname      = tb.StringCol (itemsize=(20), shape=(),   dflt=0, pos=9)  # action string name
     actorname       = tb.StringCol  (itemsize=(20), shape=(),   dflt=0, pos=10) # actor string name
     timestring      = tb.StringCol  (itemsize=(40), shape=(),   dflt=0, pos=11) # time as str
+
+
+## ===========================================================================
+# Frame arrays stored next to the ARCtable in the same .h5 file
+## ---------------------------------------------------------------------------
+# one extendable array per modality, one frame per chunk (per-frame access)
+FRAME_ATOMS = {'rgb'  : ((480,640,3), tb.UInt8Atom()),
+               'depth': ((480,640),   tb.UInt16Atom()), # raw depth in mm
+               'mask' : ((480,640),   tb.UInt8Atom())}
+
+
+def frameFilters(complevel=5, complib='blosc'):
+    '''Compression filters for the frame arrays: blosc when pytables was
+    built with it, zlib otherwise. Shuffle helps the uint16 depth.'''
+    if complib == 'blosc' and tb.whichLibVersion('blosc') is None:
+        complib = 'zlib'
+    return tb.Filters(complevel=complevel, complib=complib, shuffle=True)
+#frameFilters
+
+
+def createFrameArrays(h5file, group, name, modalities=('rgb','depth','mask'),
+                      filters=None, expectedrows=100000):
+    '''Creates the group <group>/<name>_frames with one EArray per modality
+    plus a globalframe EArray. Row i of every array belongs to the ARCtable
+    row with globalframe == frames.globalframe[i].
+    input:
+        h5file: open tables.File
+        group: group (or path) that holds the ARCtable
+        name: str, usually the table (actor) name
+    output:
+        dict modality -> EArray (and 'globalframe')'''
+    if filters is None:
+        filters = frameFilters()
+    where  = h5file.createGroup(group, name+"_frames", name+" frames")
+    arrays = {'globalframe': h5file.createEArray(where, 'globalframe', tb.Int32Atom(), (0,),
+                                                 "globalframe of each frame row",
+                                                 expectedrows=expectedrows)}
+    for m in modalities:
+        shape, atom = FRAME_ATOMS[m]
+        arrays[m] = h5file.createEArray(where, m, atom, (0,)+shape, m+" frames",
+                                        filters=filters, expectedrows=expectedrows,
+                                        chunkshape=(1,)+shape)
+    return arrays
+#createFrameArrays
+
+
+def appendFrames(arrays, globalframe, **images):
+    '''Appends one frame of every modality, e.g.
+        appendFrames(arrays, globalframe, rgb=rgb, depth=depth, mask=mask)'''
+    arrays['globalframe'].append(np.array([globalframe], dtype=np.int32))
+    for m, image in images.items():
+        arrays[m].append(image[np.newaxis])
+#appendFrames
+
+
+def readFrame(framegroup, globalframe, modality='rgb', index=None):
+    '''Returns the frame of the given globalframe (None if not stored).
+    input:
+        framegroup: the <name>_frames group node
+        index: framegroup.globalframe.read(), pass it when reading many frames'''
+    if index is None:
+        index = framegroup.globalframe.read()
+    i = np.searchsorted(index, globalframe)
+    if i == len(index) or index[i] != globalframe:
+        return None
+    return getattr(framegroup, modality)[i]
+#readFrame
+
+
+## ===========================================================================
+# ARCtable sizing, flush cadence and indexes
+## ---------------------------------------------------------------------------
+def expectedRows(minutes, fps=30):
+    '''Rows expected for a recording of the given length (one row per frame);
+    pytables sizes the table chunks from it.'''
+    return int(minutes*60*fps)
+#expectedRows
+
+
+def createARCtable(h5file, group, name, expectedrows=100000):
+    '''Creates the ARCtable sized for expectedrows (chunkshape and buffers).'''
+    return h5file.createTable(group, name, ARCtable, name, expectedrows=expectedrows)
+#createARCtable
+
+
+class H5Flusher(object):
+    '''Flushes the hdf5 file every n rows or every t seconds, whichever comes
+    first, so the I/O buffers stay bounded and a crash loses at most one
+    batch. Call tick() once per appended row.'''
+    def __init__(self, h5file, rows=1000, secs=10.0):
+        self.h5file  = h5file
+        self.rows    = rows
+        self.secs    = secs
+        self.pending = 0
+        self.flushes = 0
+        self.last    = time.time()
+
+    def tick(self, n=1):
+        self.pending += n
+        if self.pending >= self.rows or time.time()-self.last >= self.secs:
+            self.flush()
+    # tick
+
+    def flush(self):
+        self.h5file.flush()
+        self.pending  = 0
+        self.flushes += 1
+        self.last     = time.time()
+    # flush
+#H5Flusher()
+
+
+def indexARCtable(table, columns=('timestamp','globalframe')):
+    '''Builds completely sorted indexes (CSI) on the query columns; call it
+    once at close, indexing while recording slows every append.'''
+    for name in columns:
+        col = getattr(table.cols, name)
+        if col.is_indexed:
+            col.reIndex()
+        else:
+            col.createCSIndex()
+    table.flush()
+#indexARCtable
+
+
+if __name__ == "__main__":
+    # Benchmark: append speed (default vs sized table + flush cadence) and
+    # timestamp/globalframe queries before and after the CS indexes.
+    import tempfile
+    n      = 200000
+    folder = tempfile.mkdtemp()
+    conf   = np.ones((15,1), dtype=np.float32)
+    jnts   = np.ones((15,3), dtype=np.float32)
+
+    def record(path, sized):
+        h5file = tb.openFile(path, mode="w")
+        group  = h5file.createGroup("/", "bench", "actions")
+        if sized:
+            table   = createARCtable(h5file, group, "actor", expectedRows(n/30.0/60))
+            flusher = H5Flusher(h5file, rows=1000, secs=10.0)
+        else:
+            table   = h5file.createTable(group, "actor", ARCtable, "actor")
+            flusher = None
+        row = table.row
+        tic = time.time()
+        for f in range(n):
+            row['globalframe'] = f
+            row['confidence']  = conf
+            row['realworld']   = jnts
+            row['projective']  = jnts
+            row['timestamp']   = f/30.0
+            row.append()
+            if flusher:
+                flusher.tick()
+        h5file.flush()
+        return h5file, table, time.time()-tic
+
+    def queries(table, k=20):
+        tic = time.time()
+        for i in range(k):
+            t0 = (i*n/k)/30.0
+            table.readWhere('(timestamp >= t0) & (timestamp < t1)', {'t0': t0, 't1': t0+60})
+            table.readWhere('globalframe == g', {'g': i*n/k})
+        return (time.time()-tic)/(2*k)
+
+    h5file, table, t_default = record(folder+'/default.h5', sized=False)
+    h5file.close()
+    h5file, table, t_sized   = record(folder+'/sized.h5', sized=True)
+    t_scan = queries(table)
+    tic    = time.time()
+    indexARCtable(table)
+    t_index = time.time()-tic
+    t_csi  = queries(table)
+    h5file.close()
+    print "{} rows append: default {:.1f} us/row, sized+flush {:.1f} us/row".format(
+        n, t_default/n*1e6, t_sized/n*1e6)
+    print "query: full scan {:.2f} ms, CS index {:.2f} ms (indexing took {:.2f} s)".format(
+        t_scan*1e3, t_csi*1e3, t_index)
@@ -12,10 +12,13 @@ ref:
 import socket
 #import sys
 
+HOST = "192.168.1.10" # Local network
+PORT = 50007 # any device: the server registers devices at run time (device_registry.py)
+
 ## ===========================================================================
 # Check response from tcp server
 # ----------------------------------------------------------------------------
-def check_tcp_server(cmd='check',dev="1"):
+def check_tcp_server(cmd='check',dev="1", host=None, port=None):
     """Check the server (the status of other devices).
     (str, str) -> (str)
     cmd   = str that can take one of three values: check, connect, disconnect
@@ -29,20 +32,10 @@ def check_tcp_server(cmd='check',dev="1"):
 #    HOST = '192.168.1.87'    # Alien WiFi - ECE Net
 #    HOST = "128.111.185.30"  # Alien Wired- ECE Net    PORT = "5007"
 #    HOST = "128.111.185.232" # Desktop Wired ECE Net
-    
-    HOST = "192.168.1.10" # Local network
+    host = host or HOST
+    port = port or PORT # any of server_threads.PORTS
     
     received =""
-    
-    devid = "dev{}".format(dev)
-    dev_dict = {'dev1':{'PORT':50007},
-                'dev2':{'PORT':50008},
-                'dev3':{'PORT':50009},
-                'dev4':{'PORT':50010},               
-                'dev5':{'PORT':50011},                
-                'dev6':{'PORT':50012}                
-                }    
-    PORT = dev_dict[devid]["PORT"] # The same port as used by the server
 #    print "Connecting to PORT: ", PORT
 
     # Create a socket (SOCK_STREAM means a TCP socket)
@@ -51,7 +44,7 @@ def check_tcp_server(cmd='check',dev="1"):
     data = str(dev) + " " + cmd
     try:
         # Connect to server and send data
-        sock.connect((HOST, PORT))
+        sock.connect((host, port))
         sock.sendall(data + "\n")
     
         # Receive data from the server and shut down
@@ -105,7 +105,7 @@ import cv
 import sys
 import cv2
 import time
-import os, csv
+import os
 #import tables as tb
 #import arctable as arc
 from tables import *
@@ -116,6 +116,8 @@ from time import localtime, strftime, gmtime
 
 #import socket
 import client
+import depth_display
+import metadata_log
 
 
 XML_FILE = 'config.xml'
@@ -234,6 +236,10 @@ print "0/4 Starting to detect users. Press Esc to exit."
 
 
 
+## Depth for display through a lookup table, reused output buffer
+colorizer  = depth_display.DepthColorizer(near=0, far=4095, colormap='gray')
+d4d_buffer = np.zeros((480,640,3), dtype=np.uint8)
+
 def capture_depth():
     """ 
     Create np.array from Carmine raw depthmap string using 16 or 8 bits
@@ -241,9 +247,7 @@ def capture_depth():
     max = 255 #=(2**8)-1
     """
     dmap = np.fromstring(depth_generator.get_raw_depth_map(),dtype=np.uint16).reshape(480, 640)
-    max = 4095 # = (2**12)-1
-    depth_norm=(dmap.astype(float) * 255/max).astype(np.uint8)
-    d4d = cv2.cvtColor(depth_norm, cv2.COLOR_GRAY2RGB) # depth4Display
+    d4d = colorizer.colorize(dmap, out=d4d_buffer) # depth4Display, 12bit lut
     return dmap, d4d
 #capture_depth
 
@@ -474,22 +478,15 @@ folder4frames,folder4csv=createFolders(actorname,root = "../data/icudata"+str(de
 # start the device carmine
 context.start_generating_all()
 
-# bufsize = 2**27; #64Mbytes in bits
-## open/create csv file
-with open(folder4csv+actorname+"_dev"+str(dev)+'.csv','w') as fp:#, bufsize) as fp:
-    # Set the writer with comma delimiter
-    writer=csv.writer(fp, delimiter=',')
-    
+## open/create csv file: buffered rows, flushed every 100 rows or 5 secs
+## (see metadata_log.py), index column := frame
+colnames = ['localtic','gmtime','servertic']
+with metadata_log.MetadataLog(folder4csv+actorname+"_dev"+str(dev)+'.csv', colnames) as writer:
     # Get the first timestamp    tic = time.time()
     start_time = time.time() 
     
     # Write zero data point
-    datarow=['start time', tic, ' ', strftime("%a, %d %b %Y %H:%M:%S +0000", gmtime())]
-    writer.writerow(datarow)
-    
-    # Write column names:
-    colnames =['frame','localtic=gmtime','servertic=gmtime']
-    writer.writerow((colnames))
+    writer.append('start', tic, strftime("%a, %d %b %Y %H:%M:%S +0000", gmtime()), ' ')
     print "Done writing the csv headers"
     
     ##--- main loop ---
@@ -551,8 +548,7 @@ with open(folder4csv+actorname+"_dev"+str(dev)+'.csv','w') as fp:#, bufsize) as
             #print 'Saving -- server response!'
             save_frames(f,rgb,dmap,mask,skel,p=folder4frames+'/sync/', msg=True)
             # Write Datarows
-            datarow =[f,run_time, strftime("%a, %d %b %Y %H:%M:%S +0000", gmtime()),server_time]
-            writer.writerow(datarow)
+            writer.append(f, run_time, strftime("%a, %d %b %Y %H:%M:%S +0000", gmtime()), server_time)
             f+=1
         save_frames(global_f,rgb,dmap,mask,skel,p=folder4frames+'/raw/')
         global_f+=1
@@ -570,8 +566,8 @@ with open(folder4csv+actorname+"_dev"+str(dev)+'.csv','w') as fp:#, bufsize) as
     run_time = end_time - start_time
     #Write the last rows
     fps = f/(run_time)
-    datarow=[['fps', fps],['runtime',run_time]]
-    writer.writerows(datarow)
+    writer.append('fps', fps, ' ', ' ')
+    writer.append('runtime', run_time, ' ', ' ')
 # end csv file        
 
 # TERMINATE
@@ -14,14 +14,24 @@ python server_threads.py
 
 NOTE:
     Try changin the list structures for sets - to speed up the process
+
+Devices are not listed here any more (device_registry.py, same as in
+micu_openni2_v3): any device id is registered on its first request (or with
+"<devid> register <capabilities>"), every request is a heartbeat, and a
+device silent for registry.timeout s is evicted. Save when every live
+device is connected (MIN_DEVICES live before the first save). Any device
+may use any of PORTS.
     
 @author: carlos
 """
 import SocketServer
 import threading
+import signal
 import time
 from time import localtime, strftime
 
+import device_registry
+
 
 devs = []
 roll = []
@@ -30,21 +40,57 @@ disc = False # flag to disconnect
 done = False # flag to terminate
 save = False # flag to save
 
-# Add/Remove devices to/from dev_list
-dev_list = ['dev1', 'dev2', 'dev3'] # Allowed devices
+started = False # first save done (MIN_DEVICES no longer needed)
 
-terminate_list= dev_list[:]
+# Devices register at run time; DEVICES limits them (None: any device id)
+DEVICES     = None # e.g. ['dev1', 'dev2', 'dev3']
+MIN_DEVICES = 3    # live devices needed before the first save
+registry    = device_registry.DeviceRegistry(DEVICES, min_devices=MIN_DEVICES)
+PORTS       = [50007, 50008, 50009] # one server thread each, shared state
+
+terminate_list= set() # live devices not yet told to terminate
 terminate = False # termiantion flag
+finished  = threading.Event() # set when the last device closed (or on a signal)
+lock      = threading.RLock()  # guards the state above (one thread per port)
 
 
-dev_dict = {'dev1':{'PORT':50007},
-            'dev2':{'PORT':50008},
-            'dev3':{'PORT':50009}
-            }
+def update_state():
+    """
+    Connecting/saving flags from the live set of devices (call under lock).
+    """
+    global conc, disc, save, started
+    if registry.all_connected(devs, started):
+        conc = False # done connecting all devs
+        disc = True  # allows to disconnect
+        save = True
+        started = True
+        print "All CONNECTED"
+    elif len(devs)==0:
+        conc = True   # can begin connecting devices
+        disc = False  # done disconnecting all devices
+        save = False
+        print "All DISCONNECTED"
+#update_state
 
-roll = {}
-for d in dev_list:
-    roll[d] = 'n'
+
+def evict(now=None):
+    """
+    Drops the devices without heartbeat; returns them.
+    """
+    global done
+    with lock:
+        gone = registry.evict(now)
+        for dev in gone:
+            if dev in devs:
+                devs.remove(dev)
+            terminate_list.discard(dev)
+        if gone and terminate and len(terminate_list) == 0:
+            done = True
+            finished.set()
+        if gone:
+            update_state()
+    return gone
+#evict
 
 
     
@@ -56,11 +102,16 @@ class MyTCPHandler(SocketServer.BaseRequestHandler):
     override the handle() method to implement communication to the
     client.
     
-    Add new devices to dev_list
+    Devices register themselves (see device_registry.py)
     
     """
     def handle(self):
-        global done, roll, conc, disc, terminate, devs, save
+        with lock:
+            self.answer()
+    # handle
+
+    def answer(self):
+        global done, roll, conc, disc, terminate, devs, save, terminate_list
         
         # self.request is the TCP socket connected to the client
         self.data  = self.request.recv(1024).strip().split(" ")
@@ -76,13 +127,22 @@ class MyTCPHandler(SocketServer.BaseRequestHandler):
         print "\t", self.data
         print "\t at local time {}".format(self.tic) 
 
-        # Check device is on the list of allowed devices:
-        if dev in dev_list:
+        # Every request is a heartbeat (unknown devices are registered if allowed):
+        if self.cmd.lower() == "register": # with its capabilities "register res=640x480,fps=30"
+            caps  = device_registry.parse_capabilities(" ".join(self.data[2:]))
+            known = registry.register(dev, caps, self.tic, self.client_address[0])
+        else:
+            known = registry.heartbeat(dev, self.tic, self.client_address[0])
+        if known:
             print "Device recognized:"
             if not terminate:
                 
+                # --- Registered above
+                if self.cmd.lower() == "register":
+                    self.msg = "dev{} registered_{}".format(self.devid, self.tic)
+
                 # --- Connect the device <dev1#> "connect" command
-                if conc and self.cmd.lower() == "connect":
+                elif conc and self.cmd.lower() == "connect":
                     print "\tAttempting to {} {}".format(self.cmd, dev)
                     if dev in devs:
                         self.msg = "dev{} alreadyconnected_{}".format(self.devid, self.tic)
@@ -110,43 +170,37 @@ class MyTCPHandler(SocketServer.BaseRequestHandler):
                 # --- Allow the clients to request termination using "close"
                 elif self.cmd.lower() == "close":
                     print "Terminating all threads"
-                    terminate_list.remove(dev)
-                    done = True
+                    terminate_list = registry.live() - set([dev])
                     terminate = True
+                    if len(terminate_list) == 0:
+                        done = True
+                        finished.set()
                 
                 
                 else: # unknown command
-                    print "Unknown command {}. Use connect, check, or close".format(self.cmd)                
+                    print "Unknown command {}. Use register, connect, check, or close".format(self.cmd)                
             
-            else: # terminate
-                if dev in devs:
+            else: # terminate: every device is told once, the last one ends the server
+                if dev in terminate_list:
                     terminate_list.remove(dev)
                     self.msg = "terminate"
                 if len(terminate_list) ==0:
                     done = True
+                    finished.set()
 
             
-        else: # dev not in list
+        else: # dev not in DEVICES
             print "Unknown device {}. Please check devid try again!".format(dev)
             self.msg = "dev{} -Not recognized by the server!!".format(self.devid)
 
 
         print "There are {} registered devices{}".format(len(devs) , devs)
-        
-        if len(devs) == len(dev_list): #roll.values().count('y') == len(dev_list):
-            conc = False # done connecting all devs
-            disc = True  # allows to disconnect
-            save = True
-            print "All CONNECTED"
-        elif len(devs)==0: # roll.values().count('y') == 0:
-            conc = True   # can begin connecting devices
-            disc = False  # done disconnecting all devices
-            save = False
-            print "All DISCONNECTED"
+        update_state()
     
         #print 'msg: ', self.msg
         self.request.sendall(self.msg.lower())
         # print'Devices ready: ', devs
+    # answer
 #MyTCPHandler()
 
 
@@ -182,15 +236,23 @@ if __name__ == "__main__":
 
 #    dev_list1 = ['dev1']
     server_thread_list=[]
-    for d in dev_dict:
-        server_thread = ServerThread(d, HOST=HOST, PORT=dev_dict[d]['PORT'])
+    for port in PORTS:
+        server_thread = ServerThread('port {}'.format(port), HOST=HOST, PORT=port)
         #server_thread.daemon = True
         server_thread.start()
         server_thread_list.append(server_thread)
     
-    try:
-        while not done: pass
-        raise KeyboardInterrupt
-    except KeyboardInterrupt:
-        for s in server_thread_list:
-            s.server.shutdown()
+    # Block (no busy wait) until the last device closes or ctrl+c / kill.
+    # python2 cannot interrupt Event.wait() without a timeout, hence the 1 s wait
+    def stop(signum, frame):
+        print "Signal {}: shutting down".format(signum)
+        finished.set()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    while not finished.wait(1.0):
+        evict() # devices without heartbeat
+    for s in server_thread_list:
+        s.server.shutdown()     # serve_forever() returns
+        s.server.server_close()
+        s.join()
+    print "All devices closed"
@@ -23,6 +23,8 @@ Status: operational
     display device frames; vis=True
     save current view by pressing spacebar (stored in "../data/screen/" folder
     saves frames in "../data/frames/" folder; requires save_frames_flag=True
+    stores rgb/depth/mask arrays in the hdf5 file; requires save_h5_frames=True
+        (off by default: full rgb/depth/mask frames grow the file fast, see arctable.py)
     generates avi videos "../data/videos/"; requires generate_videos=True
     terminate code by pressing "Esc"
 
@@ -57,6 +59,10 @@ Current features:
             ||globalframe|viewframe|jnt_confidence|realworld[xyz]|...
              |projective[xyz]|timestamp|viewangle|actionlabel|actorlabel|...
              |locatime_stimestamp||
+        frames: '<actor>_frames' group next to the table (optional,
+            save_h5_frames=True; default False, joints/table only)
+            rgb, depth (raw uint16), mask: chunked compressed EArrays
+            globalframe: links each frame row to the table row
     
     6) tcp client
         devid: dev1 (or dev2)
@@ -113,6 +119,8 @@ from time import localtime, strftime
 
 #import socket
 import client
+import depth_display
+import compositor
 
 
 XML_FILE = 'config.xml'
@@ -243,42 +251,39 @@ print "0/4 Starting to detect users. Press Esc to exit."
 
 
 def timeEvent(t=2,d=2):
-    """Uses the computer clock for a global time delay"""
-    c = localtime() # struct
+    """Uses the computer clock for a global time delay
+    Sleeps (no busy loop) until the next t-minute tick about d minutes ahead,
+    so every device started with the same t,d starts at the same minute."""
+    now = time.time()
+    c = localtime(now) # struct
     print 'First executed at time: %d:%d:%.2f\n' %(c.tm_hour, c.tm_min, c.tm_sec)
-    ctrl = False
-    done = False
     v = np.asarray(xrange(0,60,t)) # 1D array of  ticks
-    while not done:
-        c = localtime()
-        m,s = c.tm_min, c.tm_sec/60.0 #min & seconds(converted to minutes
-        dst = np.abs(v-(m+s+d))
-        idx = np.argmin(dst)
-        if (not ctrl):
-            tick = v[idx]
-            mm = tick-m-s
-            print 'Time left: %d mins & %d secs. Looking for tick %d\n'%(np.floor(mm),(mm-np.floor(mm))*60 , tick)
-            ctrl = True
-        if m == tick:
-            c = localtime()
-            print 'Reached tick %dhr:%dmm:%dss\n'%(c.tm_hour, c.tm_min, c.tm_sec)
-            r = 1
-            k = m
-            ctrl = False
-            done = True
+    m,s = c.tm_min, c.tm_sec/60.0 #min & seconds(converted to minutes
+    tick = v[np.argmin(np.abs(v-(m+s+d)))]
+    mm = (tick-m-s) % 60 # minutes left (next hour if the tick is behind)
+    print 'Time left: %d mins & %d secs. Looking for tick %d\n'%(np.floor(mm),(mm-np.floor(mm))*60 , tick)
+    target = now + mm*60
+    while time.time() < target: # sleep may return early on a signal
+        time.sleep(max(0.0, target-time.time())) # the clock may pass target in between
+    c = localtime()
+    print 'Reached tick %dhr:%dmm:%dss\n'%(c.tm_hour, c.tm_min, c.tm_sec)
+    r = 1
+    k = c.tm_min
     print 'Event Timed!'
     return r,k
 #timeEvent()
 
 
+## Depth for display through a lookup table, reused output buffer
+colorizer  = depth_display.DepthColorizer(near=0, far=4095, colormap='gray')
+d4d_buffer = np.zeros((480,640,3), dtype=np.uint8)
+
 def capture_depth():
     """ Create np.array from Carmine raw depthmap string using 16 or 8 bits
     depth = np.fromstring(depth_generator.get_raw_depth_map_8(), "uint8").reshape(480, 640)
     max = 255 #=(2**8)-1"""
     depth = np.fromstring(depth_generator.get_raw_depth_map(),dtype=np.uint16).reshape(480, 640)
-    max = 4095 # = (2**12)-1
-    depth_norm=(depth.astype(float) * 255/max).astype(np.uint8)
-    d4d = cv2.cvtColor(depth_norm, cv2.COLOR_GRAY2RGB) # depth4Display
+    d4d = colorizer.colorize(depth, out=d4d_buffer) # depth4Display, 12bit lut
     return depth, d4d
 #capture_depth
 
@@ -431,6 +436,9 @@ if __name__== "__main__":
 
     ## === hdf5 file: recoding parameters
     minutes     = 300000 # record-time in minutes
+    nominal_fps = 30     # frames per second used to size the table
+    flush_rows  = 1000   # flush the hdf5 file every flush_rows rows...
+    flush_secs  = 10.0   # ...or every flush_secs seconds
     dev         = 5  # device number
     viewframe   = 0
     globalframe = 0
@@ -445,6 +453,11 @@ if __name__== "__main__":
     vis             = True   # display frames
     save_frames_flag= False  # save all frames
     generate_videos = False  # use the saved frames to generate .avi files
+    save_h5_frames  = False  # rgb, depth, mask arrays in the hdf5 file (see arctable.py)
+    preview_fps     = 10     # display refresh rate, independent of capture
+
+    # preview canvas: rgb || skel || depth || mask, 4:1 scale (medium)
+    preview = compositor.Compositor(4, tile_size=(320,240), max_fps=preview_fps)
 
 
     actionname   = sys.argv[1] # actionname = "testing"
@@ -465,7 +478,15 @@ if __name__== "__main__":
     h5file, group  = checkh5exists(h5filename)
 
     #create a new table: devTable
-    devTable = h5file.createTable(group, actorname, arc.ARCtable, actorname)
+    expectedrows = arc.expectedRows(minutes, nominal_fps)
+    devTable = arc.createARCtable(h5file, group, actorname, expectedrows)
+    # frames next to the table, linked by globalframe: <group>/<actorname>_frames
+    if save_h5_frames:
+        frameArrays = arc.createFrameArrays(h5file, group, actorname,
+                                            expectedrows=expectedrows)
+    h5flusher = arc.H5Flusher(h5file, rows=flush_rows, secs=flush_secs)
+    # populate the table one row at a time: devRow
+    devRow = devTable.row
 
     # initialize the arrays for the joint coordinates & confidences
     confidences = np.zeros((15,1), dtype=float)
@@ -498,8 +519,6 @@ if __name__== "__main__":
 
 #            client.check_tcp_server(cmd='disconnect',devid=dev) # disconnect device
 
-        # populate the table one row at a time: devRow
-        devRow = devTable.row
         context.wait_any_update_all()
         tic = time.time()
         # collect images from carmine - even w/o a user detected
@@ -549,19 +568,21 @@ if __name__== "__main__":
         #devRow['timestring']  = ctime(response.tx_time)
 
         devRow.append()
+        if save_h5_frames:
+            arc.appendFrames(frameArrays, globalframe, rgb=rgb, depth=depth, mask=mask)
+        h5flusher.tick()
 
         # check the flags
-        if (vis or save_frames_flag):
-            rgbdm = np.hstack((rgb,skel,d4d,cv2.cvtColor(mask,cv2.COLOR_GRAY2RGB)))
-            #rgbdm_small = rgbdm # orginal size
-            rgbdm_small = cv2.resize(rgbdm,(1280,240)) # medium
-            #rgbdm_small = cv2.resize(rgbdm,(640,120)) # smallest
-            if vis:
-                # display the concatenated images
-                cv2.imshow("4:1 scale", rgbdm_small) # small
-            if save_frames_flag:
-                # Save the frames as png's
-                save_frames(globalframe,rgb,depth, mask, skel, rgbdm_small, p=folder4frames)
+        rgbdm_small = None # composed for the display, or when a frame is saved
+        if vis and preview.due():
+            # display the concatenated images at preview_fps
+            rgbdm_small = preview.compose((rgb,skel,d4d,mask)) # small
+            cv2.imshow("4:1 scale", rgbdm_small)
+        if save_frames_flag:
+            # Save the frames as png's (with the composite of this frame)
+            if rgbdm_small is None:
+                rgbdm_small = preview.compose((rgb,skel,d4d,mask))
+            save_frames(globalframe,rgb,depth, mask, skel, rgbdm_small, p=folder4frames)
         #if vis or save_frames
         key = cv2.waitKey(1)
         if (key == 27):
@@ -573,6 +594,8 @@ if __name__== "__main__":
 #            print "\t do something here to move to next step"
         elif key ==ord('s'): #spacebar to connect to the server
             print "Pressed (s)aving image!"
+            if rgbdm_small is None:
+                rgbdm_small = preview.compose((rgb,skel,d4d,mask))
             save_frames(viewframe,rgb,depth, mask, skel, rgbdm_small, p=folder4screen)
             cv2.waitKey(1000)
             viewframe += 1
@@ -580,6 +603,8 @@ if __name__== "__main__":
         if  client.check_tcp_server(cmd='check',dev=dev) == 'save':
             print "Save using server command!"
             #save_frames_flag= True  # save all frames
+            if rgbdm_small is None:
+                rgbdm_small = preview.compose((rgb,skel,d4d,mask))
             save_frames(viewframe,rgb,depth, mask, skel, rgbdm_small, p=folder4screen)
 #            client.check_tcp_server(cmd='disconnect',dev=dev)
             viewframe += 1
@@ -602,6 +627,9 @@ if __name__== "__main__":
     client.check_tcp_server(cmd='close',dev=dev)
     
     # Close the hdf5 file
+    print "\tIndexing timestamp and globalframe"
+    h5flusher.flush()
+    arc.indexARCtable(devTable)
     print "\tClosing hdf5 file"    
     h5file.close()        
 